@@ -0,0 +1,195 @@
+import asyncio  # Асинхронный интерфейс
+import logging  # Будем вести лог
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor  # Блокирующие запросы к QUIK выполняются в пуле потоков
+
+from backtrader import Order
+
+from BackTraderQuik import QKStore
+
+
+class QKAsyncStore:
+    """Асинхронный интерфейс хранилища QUIK. Работает с тем же хранилищем и подключением к QUIK, что и BackTrader
+    События QUIK передаются в цикл событий asyncio. Ожидающие корутины не занимают потоков
+    Создается внутри работающего цикла событий или с заданным циклом событий
+    """
+    logger = logging.getLogger('QKAsyncStore')  # Будем вести лог
+
+    def __init__(self, store=None, loop=None, max_workers=4):
+        """Инициализация асинхронного интерфейса хранилища
+
+        :param QKStore store: Хранилище QUIK. Если не задано, то берется хранилище процесса
+        :param loop: Цикл событий asyncio. Если не задан, то берется работающий цикл событий
+        :param int max_workers: Кол-во потоков для одновременных запросов к QUIK
+        """
+        self.store = store or QKStore()  # Хранилище QUIK
+        self.loop = loop or asyncio.get_running_loop()  # Цикл событий asyncio
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix='QKAsync')  # Потоки для блокирующих запросов к QUIK
+        self.bar_queues = defaultdict(set)  # Очереди новых бар итераторов по guid подписки
+        self.history_requests = {}  # Выполняющиеся запросы истории. Одинаковые запросы получают один ответ
+        self.dropped = 0  # Кол-во бар, удаленных из переполненных очередей итераторов
+        self.store.bar_listeners.append(self.on_new_bar)  # Получаем новые бары из хранилища
+
+    async def call(self, method, *args, **kwargs):
+        """Запрос к QUIK без блокировки цикла событий"""
+        return await self.loop.run_in_executor(self.executor, lambda: getattr(self.store.provider, method)(*args, **kwargs))
+
+    async def get_history(self, class_code, sec_code, interval, count=0):
+        """История тикера из QUIK. Запросы по разным тикерам выполняются одновременно, одинаковые запросы объединяются
+
+        :param str class_code: Код режима торгов
+        :param str sec_code: Тикер
+        :param int interval: Временной интервал QUIK
+        :param int count: Кол-во последних бар. 0 - все бары
+        :return: Бары из QUIK
+        """
+        key = (class_code, sec_code, interval, count)  # Запрос
+        future = self.history_requests.get(key)  # Такой же выполняющийся запрос
+        if future is None:  # Если такого запроса нет
+            future = self.history_requests[key] = asyncio.ensure_future(self.call('get_candles_from_data_source', class_code, sec_code, interval, count=count))  # то выполняем запрос
+            future.add_done_callback(lambda _: self.history_requests.pop(key, None))  # После ответа запрос убираем
+        return (await asyncio.shield(future))['data']  # Отмена одного ожидающего не отменяет запрос для остальных
+
+    async def bars(self, guid, maxsize=1000):
+        """Асинхронный итератор новых бар по подписке/расписанию
+
+        :param guid: Идентификатор подписки (код режима торгов, тикер, временной интервал QUIK) или данные QKData
+        :param int maxsize: Максимальное кол-во бар в очереди итератора. При переполнении удаляется самый старый бар
+        """
+        guid = getattr(guid, 'guid', guid)  # Для данных берем их идентификатор подписки
+        queue = asyncio.Queue(maxsize)  # Очередь новых бар итератора
+        self.bar_queues[guid].add(queue)
+        try:
+            while True:
+                yield await queue.get()  # Ждем новый бар
+        finally:  # При выходе из итератора
+            self.bar_queues[guid].discard(queue)  # очередь больше не нужна
+            if not self.bar_queues[guid]:  # Если итераторов по подписке не осталось
+                del self.bar_queues[guid]  # то подписку убираем
+
+    def on_new_bar(self, guid, bar) -> None:
+        """Обработчик нового бара из потока событий QUIK"""
+        if guid in self.bar_queues:  # Если по подписке есть итераторы. Иначе не обращаемся к циклу событий
+            self.loop.call_soon_threadsafe(self.put_bar, guid, bar)  # Передаем бар в цикл событий
+
+    def put_bar(self, guid, bar) -> None:
+        """Раздача нового бара итераторам в цикле событий"""
+        for queue in self.bar_queues.get(guid, ()):  # Пробегаемся по всем итераторам подписки
+            if queue.full():  # Если итератор не успевает забирать бары
+                queue.get_nowait()  # то удаляем самый старый бар
+                self.dropped += 1
+                if self.dropped % 1000 == 1:  # Чтобы не перегружать лог, предупреждаем через каждую 1000 удаленных бар
+                    self.logger.warning(f'Итератор новых бар {guid} отстает. Удалено бар: {self.dropped}')
+            queue.put_nowait(bar)
+
+    def close(self) -> None:
+        """Отключение от хранилища"""
+        if self.on_new_bar in self.store.bar_listeners:  # Если получаем новые бары
+            self.store.bar_listeners.remove(self.on_new_bar)  # то больше не получаем
+        self.executor.shutdown(wait=False)  # Выполняющиеся запросы завершатся в своих потоках
+
+
+class QKAsyncBroker:
+    """Асинхронный интерфейс брокера QUIK. Работает с тем же брокером, что и BackTrader
+    Постановка заявки завершается по ответу на транзакцию (on_trans_reply) или по исполнению заявки (on_trade)
+    """
+    logger = logging.getLogger('QKAsyncBroker')  # Будем вести лог
+    final_statuses = (Order.Completed, Order.Canceled, Order.Expired, Order.Margin, Order.Rejected)  # Статусы завершенной заявки
+    wait_statuses = {  # Статусы, при которых заканчивается ожидание заявки
+        'submitted': (Order.Submitted, Order.Accepted, Order.Partial) + final_statuses,  # Заявка отправлена
+        'accepted': (Order.Accepted, Order.Partial) + final_statuses,  # Заявка принята на бирже
+        'completed': final_statuses,  # Заявка завершена
+    }
+
+    def __init__(self, broker, async_store):
+        """Инициализация асинхронного интерфейса брокера
+
+        :param QKBroker broker: Брокер QUIK
+        :param QKAsyncStore async_store: Асинхронный интерфейс хранилища. Его цикл событий и потоки используются брокером
+        """
+        self.broker = broker  # Брокер QUIK
+        self.async_store = async_store  # Асинхронный интерфейс хранилища
+        self.loop = async_store.loop  # Цикл событий asyncio
+        self.waiters = defaultdict(list)  # Ожидающие заявок: статусы и результат по номеру заявки
+        self.notification_queues = set()  # Очереди уведомлений итераторов
+        self.broker.order_listeners.append(self.on_order_notification)  # Получаем уведомления о заявках из брокера
+
+    async def buy(self, owner, data, size, wait='accepted', **kwargs):
+        """Заявка на покупку. Параметры заявки как у брокера BackTrader
+
+        :param str wait: Ожидание заявки: submitted - отправлена, accepted - принята на бирже, completed - завершена
+        :return: Заявка в статусе окончания ожидания
+        """
+        order = await self.loop.run_in_executor(self.async_store.executor, lambda: self.broker.buy(owner, data, size, **kwargs))  # Отправляем заявку, не блокируя цикл событий
+        return await self.wait_order(order, wait)
+
+    async def sell(self, owner, data, size, wait='accepted', **kwargs):
+        """Заявка на продажу. Параметры заявки как у брокера BackTrader
+
+        :param str wait: Ожидание заявки: submitted - отправлена, accepted - принята на бирже, completed - завершена
+        :return: Заявка в статусе окончания ожидания
+        """
+        order = await self.loop.run_in_executor(self.async_store.executor, lambda: self.broker.sell(owner, data, size, **kwargs))  # Отправляем заявку, не блокируя цикл событий
+        return await self.wait_order(order, wait)
+
+    async def cancel(self, order):
+        """Отмена заявки. Ожидание до завершения заявки"""
+        await self.loop.run_in_executor(self.async_store.executor, self.broker.cancel, order)  # Отправляем транзакцию отмены, не блокируя цикл событий
+        return await self.wait_order(order, 'completed')
+
+    def wait_order(self, order, wait='completed'):
+        """Ожидание статуса заявки
+
+        :param Order order: Заявка
+        :param str wait: Ожидание заявки: submitted - отправлена, accepted - принята на бирже, completed - завершена
+        :return: Результат с заявкой в статусе окончания ожидания
+        """
+        statuses = self.wait_statuses[wait]  # Статусы окончания ожидания
+        future = self.loop.create_future()  # Результат ожидания
+        waiter = (statuses, future)  # Ожидающий заявки
+        self.waiters[order.ref].append(waiter)  # Ждем уведомления о заявке до проверки статуса. Иначе изменение статуса между проверкой и ожиданием будет потеряно
+        future.add_done_callback(lambda _: self.remove_waiter(order.ref, waiter))  # Завершенное, отмененное ожидание или ожидание по таймауту сразу удаляем
+        if order.status in statuses:  # Если заявка уже в нужном статусе
+            future.set_result(order.clone())  # то ждать не нужно
+        return future
+
+    def remove_waiter(self, ref, waiter) -> None:
+        """Удаление завершенного ожидания заявки"""
+        waiters = self.waiters.get(ref)  # Ожидающие заявки
+        if waiters and waiter in waiters:  # Если ожидание еще не удалено при уведомлении о заявке
+            waiters.remove(waiter)  # то удаляем его
+            if not waiters:  # Если заявку больше никто не ждет
+                del self.waiters[ref]  # то уведомления о ней в цикл событий не передаем
+
+    async def notifications(self):
+        """Асинхронный итератор уведомлений о заявках"""
+        queue = asyncio.Queue()  # Очередь уведомлений итератора
+        self.notification_queues.add(queue)
+        try:
+            while True:
+                yield await queue.get()  # Ждем уведомление
+        finally:  # При выходе из итератора
+            self.notification_queues.discard(queue)  # очередь больше не нужна
+
+    def on_order_notification(self, order) -> None:
+        """Обработчик уведомления о заявке из потока событий QUIK"""
+        if order.ref in self.waiters or self.notification_queues:  # Если уведомление кто-то ждет. Иначе не обращаемся к циклу событий
+            self.loop.call_soon_threadsafe(self.put_order_notification, order)  # Передаем уведомление в цикл событий
+
+    def put_order_notification(self, order) -> None:
+        """Раздача уведомления о заявке в цикле событий"""
+        for queue in self.notification_queues:  # Пробегаемся по всем итераторам уведомлений
+            queue.put_nowait(order)
+        waiters = self.waiters.pop(order.ref, [])  # Ожидающие заявки
+        for statuses, future in waiters:  # Пробегаемся по всем ожидающим
+            if future.done():  # Если ожидание отменено
+                continue  # то пропускаем его
+            if order.status in statuses:  # Если заявка перешла в нужный статус
+                future.set_result(order)  # то ожидание закончено
+            else:  # Если заявка еще не в нужном статусе
+                self.waiters[order.ref].append((statuses, future))  # то продолжаем ждать
+
+    def close(self) -> None:
+        """Отключение от брокера"""
+        if self.on_order_notification in self.broker.order_listeners:  # Если получаем уведомления о заявках
+            self.broker.order_listeners.remove(self.on_order_notification)  # то больше не получаем
@@ -0,0 +1,95 @@
+import logging  # Будем вести лог
+from collections import deque
+from threading import Condition  # Ожидание места в буфере при блокировке
+
+
+class QKBarBuffer:
+    """Буфер новых бар подписки/расписания ограниченного размера. Пишет поток событий QUIK или поток расписания, читают данные
+    При переполнении буфера работает одна из политик:
+    block - поток, добавляющий бар, ждет освобождения места. Если место не освободилось за block_timeout_sec, то удаляется самый старый бар.
+            Только для потока расписания данных. Поток событий QUIK общий для всех данных и брокера, его ждать нельзя
+    drop_oldest - удаляется самый старый бар
+    coalesce - последний бар в буфере заменяется новым. Данные получат последнее состояние без промежуточных
+    Изменение того же бара (с той же датой и временем открытия) при политике coalesce всегда заменяет последний бар в буфере
+    """
+    policies = ('block', 'drop_oldest', 'coalesce')  # Политики переполнения буфера
+
+    def __init__(self, name, maxlen=1000, policy='drop_oldest', block_timeout_sec=1.0, lag_warning=None):
+        """Инициализация буфера
+
+        :param str name: Название буфера для лога
+        :param int maxlen: Максимальное кол-во бар в буфере
+        :param str policy: Политика переполнения буфера: block, drop_oldest, coalesce
+        :param float block_timeout_sec: Максимальное время ожидания места в буфере в секундах для политики block
+        :param int lag_warning: Кол-во бар в буфере, при котором выдается предупреждение об отставании данных. Если не задано, то 80% от размера буфера
+        """
+        if policy not in self.policies:  # Если политика переполнения задана неверно
+            raise ValueError(f'Политика переполнения буфера {policy} не поддерживается. Поддерживаются: {", ".join(self.policies)}')
+        self.logger = logging.getLogger(f'QKBarBuffer.{name}')  # Будем вести лог
+        self.maxlen = maxlen  # Максимальное кол-во бар в буфере
+        self.policy = policy  # Политика переполнения буфера
+        self.block_timeout_sec = block_timeout_sec  # Максимальное время ожидания места в буфере
+        self.lag_warning = lag_warning or max(1, maxlen * 4 // 5)  # Кол-во бар для предупреждения об отставании
+        self.bars = deque()  # Бары в буфере
+        self.condition = Condition()  # Блокировка буфера и ожидание места в нем
+        self.dropped = 0  # Кол-во удаленных бар
+        self.coalesced = 0  # Кол-во замененных бар
+        self.max_lag = 0  # Максимальное кол-во бар в буфере
+        self.lagging = False  # Данные отстают. Предупреждение уже выдано
+        self.closed = False  # Буфер закрыт. Новые бары не добавляются
+
+    def __len__(self):
+        return len(self.bars)
+
+    def put(self, bar) -> None:
+        """Добавление нового бара"""
+        with self.condition:
+            if self.closed:  # Если буфер закрыт
+                return  # то бар не нужен, выходим, дальше не продолжаем
+            if self.policy == 'coalesce' and self.bars and self.bars[-1]['datetime'] == bar['datetime']:  # Если это изменение последнего бара в буфере
+                self.bars[-1] = bar  # то заменяем его
+                self.coalesced += 1
+                return  # Кол-во бар в буфере не изменилось, выходим, дальше не продолжаем
+            if len(self.bars) >= self.maxlen:  # Если буфер заполнен
+                if self.policy == 'block' and not self.condition.wait_for(lambda: self.closed or len(self.bars) < self.maxlen, self.block_timeout_sec):  # Если место в буфере не освободилось за время ожидания
+                    self.logger.warning(f'Место в буфере не освободилось за {self.block_timeout_sec} с. Самый старый бар удален')
+                if self.closed:  # Если буфер закрыли, пока ждали места
+                    return  # то бар не нужен, выходим, дальше не продолжаем
+                if len(self.bars) >= self.maxlen:  # Если место в буфере так и не освободилось
+                    if self.policy == 'coalesce':  # Для политики замены
+                        self.bars[-1] = bar  # последний бар заменяем новым
+                        self.coalesced += 1
+                        return  # Кол-во бар в буфере не изменилось, выходим, дальше не продолжаем
+                    self.bars.popleft()  # Для остальных политик удаляем самый старый бар
+                    self.dropped += 1
+            self.bars.append(bar)  # Добавляем бар в буфер
+            lag = len(self.bars)  # Кол-во бар в буфере
+            self.max_lag = max(self.max_lag, lag)
+            if lag >= self.lag_warning and not self.lagging:  # Если данные начали отставать
+                self.logger.warning(f'Данные отстают. Бар в буфере: {lag} из {self.maxlen}. Удалено: {self.dropped}, заменено: {self.coalesced}')
+                self.lagging = True  # Предупреждение выдаем 1 раз, пока данные не догонят
+            elif lag <= self.lag_warning // 2:  # Если данные догнали
+                self.lagging = False  # то при следующем отставании снова выдадим предупреждение
+
+    def get(self):
+        """Первый бар из буфера или None, если буфер пуст"""
+        with self.condition:
+            if not self.bars:  # Если буфер пуст
+                return None
+            bar = self.bars.popleft()  # Берем и удаляем первый бар из буфера
+            self.condition.notify()  # Место в буфере освободилось
+            return bar
+
+    def peek(self):
+        """Следующий бар в буфере без удаления или None, если буфер пуст"""
+        with self.condition:
+            return self.bars[0] if self.bars else None
+
+    def close(self) -> None:
+        """Закрытие буфера. Бары удаляются, ожидающие места потоки освобождаются"""
+        with self.condition:
+            self.closed = True
+            self.bars.clear()
+            self.condition.notify_all()
+        if self.dropped or self.coalesced:  # Если бары удалялись или заменялись
+            self.logger.info(f'Удалено бар: {self.dropped}, заменено: {self.coalesced}, максимум бар в буфере: {self.max_lag}')
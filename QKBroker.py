@@ -1,12 +1,19 @@
 import logging  # Будем вести лог
 from collections import defaultdict, OrderedDict, deque  # Словари и очередь
 from datetime import datetime, date
+from itertools import count  # Номера заявок после восстановления из снимка
+from threading import RLock  # Состояние брокера меняется из потока событий QUIK и читается из потока ТС
+from time import monotonic
+import json  # Снимок состояния брокера
+import os.path
 
 from backtrader import BrokerBase, Order, BuyOrder, SellOrder
 from backtrader.position import Position
 from backtrader.utils.py3 import with_metaclass
 
 from BackTraderQuik import QKStore
+from BackTraderQuik.QKLogging import event_logger
+from BackTraderQuik.QKRisk import QKRisk
 
 
 # noinspection PyArgumentList
@@ -21,12 +28,20 @@ class MetaQKBroker(BrokerBase.__class__):
 class QKBroker(with_metaclass(MetaQKBroker, BrokerBase)):
     """Брокер QUIK"""
     logger = logging.getLogger('QKBroker')  # Будем вести лог
+    events = event_logger.getChild('QKBroker')  # Структурированный лог событий QUIK. Ведется, если включен в QKLogging
 
     params = (
         ('lots', True),  # Входящий остаток в лотах (задается брокером)
         ('slippage_steps', 10),  # Кол-во шагов цены для проскальзывания
         # По статье https://zen.yandex.ru/media/id/5e9a612424270736479fad54/bitva-s-finam-624f12acc3c38f063178ca95
         ('client_code_for_orders', None),  # Номер торгового терминала. У брокера Финам требуется для совершения торговых операций
+        ('snapshot_file', None),  # Файл снимка состояния брокера для быстрого перезапуска. None - снимок не ведется
+        ('snapshot_interval_sec', 5),  # Минимальный интервал в секундах между записями снимка
+        ('max_position', None),  # Максимальный размер позиции по тикеру в штуках с учетом незавершенных заявок. None - не проверяется
+        ('max_notional', None),  # Максимальная стоимость позиции по тикеру с учетом незавершенных заявок. None - не проверяется
+        ('max_exposure', None),  # Максимальная стоимость всех позиций с учетом незавершенных заявок. None - не проверяется
+        ('max_orders_per_sec', None),  # Максимальное кол-во новых заявок в секунду. None - не проверяется
+        ('max_daily_loss', None),  # Максимальный убыток по закрытым позициям за день. None - не проверяется
     )
 
     def __init__(self, **kwargs):
@@ -40,6 +55,15 @@ class QKBroker(with_metaclass(MetaQKBroker, BrokerBase)):
         self.orders = OrderedDict()  # Список заявок, отправленных на биржу
         self.ocos = {}  # Список связанных заявок (One Cancel Others)
         self.pcs = defaultdict(deque)  # Очередь всех родительских/дочерних заявок (Parent - Children)
+        self.order_listeners = []  # Функции, которые вызываются для каждого уведомления о заявке. Вызываются из потока обработки событий QUIK
+        self.snapshot_version = 0  # Номер изменения состояния брокера. Увеличивается при каждом уведомлении о заявке
+        self.saved_version = 0  # Номер изменения состояния брокера в последнем снимке
+        self.saved_time = 0.0  # Время записи последнего снимка
+        self.risk = QKRisk(self.p.max_position, self.p.max_notional, self.p.max_exposure, self.p.max_orders_per_sec, self.p.max_daily_loss)  # Предторговые проверки рисков
+        self.lock = RLock()  # Блокировка заявок, цепочек заявок и номеров сделок. Обработчики событий QUIK меняют их, снимок читает из потока ТС
+        self.refs = None  # Номера новых заявок брокера после восстановления из снимка. None - номера заявок BackTrader
+        if self.p.snapshot_file and self.store.address:  # Если снимок ведется через процесс-хранилище
+            raise ValueError('Снимок состояния брокера не поддерживается через процесс-хранилище QKServer. В таблицах заявок QUIK номера транзакций процесса-хранилища, а не номера заявок')
 
         self.store.provider.on_trans_reply = self.on_trans_reply  # Ответ на транзакцию пользователя
         self.store.provider.on_trade = self.on_trade  # Получение новой / изменение существующей сделки
@@ -47,6 +71,9 @@ class QKBroker(with_metaclass(MetaQKBroker, BrokerBase)):
     def start(self):
         super(QKBroker, self).start()
         self.get_all_active_positions()  # Получаем все активные позиции
+        self.risk.reset(self.positions)  # Начальные позиции для проверок рисков
+        if self.p.snapshot_file and os.path.isfile(self.p.snapshot_file):  # Если есть снимок состояния брокера
+            self.load_snapshot()  # то восстанавливаем заявки из снимка и сверяем их с QUIK
 
     def getcash(self, account_id=None):
         """Свободные средства по всем счетам, по счету"""
@@ -124,19 +151,28 @@ class QKBroker(with_metaclass(MetaQKBroker, BrokerBase)):
     def buy(self, owner, data, size, price=None, plimit=None, exectype=None, valid=None, tradeid=0, oco=None, trailamount=None, trailpercent=None, parent=None, transmit=True, **kwargs):
         """Заявка на покупку"""
         order = self.create_order(owner, data, size, price, plimit, exectype, valid, oco, parent, transmit, True, **kwargs)
-        self.notifs.append(order.clone())  # Уведомляем брокера об отправке новой заявки на покупку на биржу
+        self.put_order_notification(order)  # Уведомляем брокера об отправке новой заявки на покупку на биржу
         return order
 
     def sell(self, owner, data, size, price=None, plimit=None, exectype=None, valid=None, tradeid=0, oco=None, trailamount=None, trailpercent=None, parent=None, transmit=True, **kwargs):
         """Заявка на продажу"""
         order = self.create_order(owner, data, size, price, plimit, exectype, valid, oco, parent, transmit, False, **kwargs)
-        self.notifs.append(order.clone())  # Уведомляем брокера об отправке новой заявки на продажу на биржу
+        self.put_order_notification(order)  # Уведомляем брокера об отправке новой заявки на продажу на биржу
         return order
 
     def cancel(self, order):
         """Отмена заявки"""
         return self.cancel_order(order)
 
+    def put_order_notification(self, order):
+        """Уведомление брокера о заявке"""
+        notification = order.clone()  # Копия заявки в текущем статусе
+        self.notifs.append(notification)  # Уведомляем брокера о заявке
+        self.snapshot_version += 1  # Состояние брокера изменилось
+        self.risk.on_order(order)  # По завершенной заявке освобождаем зарезервированные средства
+        for listener in self.order_listeners:  # Пробегаемся по всем функциям получения уведомлений о заявках
+            listener(notification)  # Передаем им уведомление
+
     def get_notification(self):
         if not self.notifs:  # Если в списке уведомлений ничего нет
             return None  # то ничего и возвращаем, выходим, дальше не продолжаем
@@ -144,9 +180,13 @@ class QKBroker(with_metaclass(MetaQKBroker, BrokerBase)):
 
     def next(self):
         self.notifs.append(None)  # Добавляем в список уведомлений пустой элемент
+        if self.p.snapshot_file and self.snapshot_version != self.saved_version and monotonic() - self.saved_time >= self.p.snapshot_interval_sec:  # Если состояние изменилось, и пора записывать снимок
+            self.save_snapshot()  # то записываем снимок
 
     def stop(self):
         super(QKBroker, self).stop()
+        if self.p.snapshot_file and self.snapshot_version != self.saved_version:  # Если состояние изменилось после последнего снимка
+            self.save_snapshot()  # то записываем снимок
         self.store.provider.on_connected = self.store.provider.default_handler  # Соединение терминала с сервером QUIK
         self.store.provider.on_disconnected = self.store.provider.default_handler  # Отключение терминала от сервера QUIK
         self.store.provider.on_trans_reply = self.store.provider.default_handler  # Ответ на транзакцию пользователя
@@ -157,9 +197,12 @@ class QKBroker(with_metaclass(MetaQKBroker, BrokerBase)):
 
     def get_all_active_positions(self):
         """Все активные позиции"""
+        futures_holdings = depo_limits = None  # Позиции получаем из QUIK один раз для всех счетов
         for account in self.store.provider.accounts:  # Пробегаемся по всем счетам (Коды клиента/Фирма/Счет)
             if account['futures']:  # Для фьючерсов
-                active_futures_holdings = [futures_holding for futures_holding in self.store.provider.get_futures_holdings()['data'] if futures_holding['totalnet'] != 0]  # Активные фьючерсные позиции
+                if futures_holdings is None:  # Если фьючерсные позиции еще не получены
+                    futures_holdings = self.store.provider.get_futures_holdings()['data']  # то получаем все фьючерсные позиции
+                active_futures_holdings = [futures_holding for futures_holding in futures_holdings if futures_holding['totalnet'] != 0]  # Активные фьючерсные позиции
                 for active_futures_holding in active_futures_holdings:  # Пробегаемся по всем активным фьючерсным позициям
                     class_code = 'SPBFUT'  # Код режима торгов для фьючерсов
                     sec_code = active_futures_holding['sec_code']  # Код тикера
@@ -170,7 +213,8 @@ class QKBroker(with_metaclass(MetaQKBroker, BrokerBase)):
                     dataname = self.store.provider.class_sec_codes_to_dataname(class_code, sec_code)  # Получаем название тикера по коду режима торгов и тикера
                     self.positions[dataname] = Position(size, price)  # Сохраняем в списке открытых позиций
             else:  # Для остальных фирм
-                depo_limits = self.store.provider.get_all_depo_limits()['data']  # Все лимиты по бумагам (позиции по инструментам)
+                if depo_limits is None:  # Если лимиты по бумагам еще не получены
+                    depo_limits = self.store.provider.get_all_depo_limits()['data']  # то получаем все лимиты по бумагам (позиции по инструментам)
                 account_depo_limits = [depo_limit for depo_limit in depo_limits  # Бумажный лимит
                                        if depo_limit['client_code'] == account['client_code'] and  # выбираем по коду клиента
                                        depo_limit['firmid'] == account['firm_id'] and  # фирме
@@ -185,10 +229,129 @@ class QKBroker(with_metaclass(MetaQKBroker, BrokerBase)):
                     dataname = self.store.provider.class_sec_codes_to_dataname(class_code, sec_code)  # Получаем название тикера по коду режима торгов и тикера
                     self.positions[dataname] = Position(size, price)  # Сохраняем в списке открытых позиций
 
+    def save_snapshot(self) -> None:
+        """Запись снимка состояния брокера: незавершенные заявки с их связанными и родительскими/дочерними заявками, номера сделок, позиции
+        Состояние копируется под блокировкой обработчиков событий QUIK. Файл записывается уже без блокировки
+        """
+        with self.lock:  # Пока копируем состояние, обработчики событий QUIK его не меняют
+            refs = {ref for ref, order in self.orders.items() if order.alive()}  # Незавершенные заявки
+            for parent_ref, pcs in self.pcs.items():  # Пробегаемся по всем цепочкам родительской/дочерних заявок
+                if any(order.ref in refs or order.alive() for order in pcs):  # Если в цепочке есть незавершенная заявка
+                    refs.update(order.ref for order in pcs)  # то сохраняем всю цепочку
+            refs.update(oco_ref for order_ref, oco_ref in self.ocos.items() if order_ref in refs)  # Связанные заявки
+            orders = {order.ref: order for pcs in self.pcs.values() for order in pcs}  # Заявки цепочек могут быть еще не отправлены на биржу
+            orders.update(self.orders)
+            snapshot = dict(
+                dt=datetime.now().isoformat(),  # Дата и время снимка
+                next_ref=max(orders, default=0) + 1,  # Номер следующей заявки
+                orders=[self.order_to_dict(orders[ref]) for ref in sorted(refs) if ref in orders],  # Родительские заявки перед дочерними
+                ocos=[[order_ref, oco_ref] for order_ref, oco_ref in self.ocos.items() if order_ref in refs],  # Связанные заявки
+                pcs={str(parent_ref): [order.ref for order in pcs] for parent_ref, pcs in self.pcs.items() if parent_ref in refs},  # Родительские/дочерние заявки
+                trade_nums={dataname: list(trade_nums) for dataname, trade_nums in self.trade_nums.items()},  # Копии номеров обработанных сделок по тикеру
+                positions={dataname: [position.size, position.price] for dataname, position in self.positions.items() if position.size})  # Позиции
+        with open(f'{self.p.snapshot_file}.tmp', 'w', encoding='utf-8') as file:  # Пишем во временный файл, чтобы снимок не был поврежден при сбое
+            json.dump(snapshot, file, ensure_ascii=False)
+        os.replace(f'{self.p.snapshot_file}.tmp', self.p.snapshot_file)  # Заменяем файл снимка
+        self.saved_version = self.snapshot_version  # Запоминаем записанное состояние
+        self.saved_time = monotonic()
+        self.logger.debug(f'Снимок состояния брокера записан. Заявок: {len(snapshot["orders"])}')
+
+    @staticmethod
+    def order_to_dict(order) -> dict:
+        """Заявка для снимка состояния брокера"""
+        return dict(ref=order.ref, dataname=order.data._name, buy=order.isbuy(), size=abs(order.created.size),  # Номер, тикер, направление и размер заявки
+                    price=order.price, pricelimit=order.pricelimit, exectype=order.exectype, status=order.status,  # Цены, тип и статус
+                    parent=getattr(order.parent, 'ref', None), transmit=order.transmit,  # Родительская заявка
+                    executed_size=order.executed.size, executed_price=order.executed.price,  # Исполненная часть заявки
+                    info={key: value for key, value in order.info.items() if key in ('account', 'account_id', 'min_price_step', 'order_num')})  # Счет, шаг цены, номер заявки на бирже
+
+    def load_snapshot(self) -> None:
+        """Восстановление состояния брокера из снимка и сверка заявок с QUIK"""
+        try:
+            with open(self.p.snapshot_file, encoding='utf-8') as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError) as ex:  # Если снимок не прочитать
+            self.logger.error(f'Снимок состояния брокера {self.p.snapshot_file} не прочитан: {ex!r}')
+            return  # то работаем без него
+        datas = self.store.datas  # Данные тикеров по названию
+        orders = {}  # Восстановленные заявки по номеру
+        for item in snapshot['orders']:  # Пробегаемся по всем заявкам снимка. Родительские заявки идут перед дочерними
+            data = datas.get(item['dataname'])  # Данные тикера заявки
+            if data is None:  # Если тикера нет в ТС
+                self.logger.warning(f'Заявка {item["ref"]} по тикеру {item["dataname"]} из снимка не восстановлена. Тикера нет в ТС')
+                continue  # то заявку не восстанавливаем
+            order_class = BuyOrder if item['buy'] else SellOrder  # Заявка на покупку/продажу
+            order = order_class(owner=None, data=data, size=item['size'], price=item['price'], pricelimit=item['pricelimit'], exectype=item['exectype'],
+                                parent=orders.get(item['parent']), transmit=item['transmit'], simulated=True)  # Данные тикера еще не запущены. Заявку создаем без обращения к ним
+            order.ref = item['ref']  # Номер заявки остается прежним. По нему QUIK присылает ответы на транзакции и сделки
+            order.status = item['status']
+            order.addcomminfo(self.getcommissioninfo(data))  # По тикеру выставляем комиссии в заявку
+            order.addinfo(**item['info'])  # Счет, шаг цены, номер заявки на бирже
+            if item['executed_size']:  # Если заявка исполнена частично
+                order.execute(0.0, item['executed_size'], item['executed_price'], 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)  # то восстанавливаем исполненную часть
+            orders[order.ref] = order
+            if order.status != Order.Created:  # Если заявка была отправлена на биржу
+                self.orders[order.ref] = order  # то ждем по ней ответов на транзакции и сделок
+        self.ocos.update({order_ref: oco_ref for order_ref, oco_ref in snapshot['ocos'] if order_ref in orders and oco_ref in orders})  # Связанные заявки
+        for parent_ref, refs in snapshot['pcs'].items():  # Пробегаемся по всем цепочкам родительской/дочерних заявок
+            self.pcs[int(parent_ref)] = deque(orders[ref] for ref in refs if ref in orders)
+        self.trade_nums.update(snapshot['trade_nums'])  # Сделки из снимка повторно не обрабатываем
+        self.refs = count(max(snapshot['next_ref'], max(orders, default=0) + 1))  # Номера новых заявок брокера не пересекаются с номерами восстановленных заявок. Номера заявок BackTrader не меняем
+        for dataname, (size, price) in snapshot['positions'].items():  # Пробегаемся по всем позициям снимка. Позиции берутся из QUIK
+            if self.positions[dataname].size != size:  # Если позиция изменилась после снимка
+                self.logger.warning(f'Позиция по тикеру {dataname} в снимке {size}, в QUIK {self.positions[dataname].size}')
+        self.logger.info(f'Из снимка от {snapshot["dt"]} восстановлено заявок: {len(orders)}')
+        self.reconcile_orders()  # Сверяем заявки с QUIK
+        for order in orders.values():  # Пробегаемся по всем восстановленным заявкам
+            order.p.simulated = False  # Уведомления о заявках будут приходить в ТС. BackTrader не отправляет в ТС уведомления о заявках с simulated=True
+            if order.alive() and not order.parent:  # Как и при создании, резервируем средства только под незавершенные заявки без родительской
+                self.risk.reserve(order, order.data._name, order.price)  # Остаток заявки учитывается в проверках рисков
+
+    def reconcile_orders(self) -> None:
+        """Сверка восстановленных заявок с таблицами заявок и стоп заявок QUIK. Все заявки сверяются за два запроса"""
+        qk_orders = {int(qk_order['trans_id']): qk_order for qk_order in self.store.provider.get_all_orders()['data']}  # Заявки QUIK по номеру транзакции. После срабатывания стоп заявки номер транзакции переходит в лимитную заявку
+        qk_stop_orders = {int(qk_stop_order['trans_id']): qk_stop_order for qk_stop_order in self.store.provider.get_all_stop_orders()['data']}  # Стоп заявки QUIK по номеру транзакции
+        for order in list(self.orders.values()):  # Пробегаемся по всем восстановленным заявкам
+            if not order.alive():  # Если заявка завершена
+                continue  # то сверять ее не нужно
+            qk_order = qk_orders.get(order.ref) or qk_stop_orders.get(order.ref)  # Заявка в QUIK
+            if qk_order is None:  # Если заявки в QUIK нет
+                self.logger.warning(f'reconcile_orders: Заявка {order.ref} не найдена в QUIK. Переведена в статус отклонена (Order.Rejected)')
+                order.reject(self)  # то заявка не дошла до биржи
+            elif qk_order['flags'] & 0b1:  # Если заявка активна (бит 0)
+                order.addinfo(order_num=int(qk_order['order_num']))  # то запоминаем номер заявки на бирже. У сработавшей стоп заявки это номер лимитной заявки
+                if order.status == Order.Submitted:  # Если ответ на транзакцию не был получен
+                    order.accept(self)  # то заявка принята на бирже (Order.Accepted)
+                    self.put_order_notification(order)  # Уведомляем брокера о заявке
+                continue  # Заявка остается в работе
+            elif qk_order['flags'] & 0b10:  # Если заявка снята (бит 1)
+                self.logger.debug(f'reconcile_orders: Заявка {order.ref} снята в QUIK. Переведена в статус отменена (Order.Canceled)')
+                order.cancel()  # Отменяем заявку (Order.Canceled)
+            else:  # Если заявка исполнена
+                remsize = order.executed.remsize  # Неисполненный остаток
+                price = float(qk_order.get('price', 0)) or order.price or 0.0  # Цена заявки QUIK. Позиции берутся из QUIK, поэтому цена только для уведомления
+                if not order.data.derivative and qk_order.get('price'):  # Для не деривативов
+                    price = self.store.provider.quik_price_to_price(order.data.class_code, order.data.sec_code, price)  # цена в рублях за штуку
+                order.execute(0.0, remsize, price, 0, 0, 0, remsize, 0, 0, 0, 0, 0, 0)  # Исполняем остаток заявки
+                self.logger.debug(f'reconcile_orders: Заявка {order.ref} исполнена в QUIK. Переведена в статус полностью исполнена (Order.Completed)')
+                order.completed()  # Переводим заявку в статус Order.Completed
+            self.put_order_notification(order)  # Уведомляем брокера о заявке
+            self.oco_pc_check(order)  # Проверяем связанные и родительскую/дочерние заявки. Дочерние заявки исполненной родительской заявки будут отправлены на биржу
+
+    @staticmethod
+    def get_last_price(data):
+        """Цена закрытия последнего бара тикера без запроса к QUIK. None, если баров еще нет"""
+        try:
+            return data.close[0]  # Цена закрытия последнего бара
+        except IndexError:  # Если баров еще нет
+            return None
+
     def create_order(self, owner, data, size, price=None, plimit=None, exectype=None, valid=None, oco=None, parent=None, transmit=True, is_buy=True, **kwargs):
         """Создание заявки. Привязка параметров счета и тикера. Обработка связанных и родительской/дочерних заявок"""
         order = BuyOrder(owner=owner, data=data, size=size, price=price, pricelimit=plimit, exectype=exectype, valid=valid, oco=oco, parent=parent, transmit=transmit) if is_buy \
             else SellOrder(owner=owner, data=data, size=size, price=price, pricelimit=plimit, exectype=exectype, valid=valid, oco=oco, parent=parent, transmit=transmit)  # Заявка на покупку/продажу
+        if self.refs is not None:  # Если заявки восстановлены из снимка
+            order.ref = next(self.refs)  # то номер заявки (транзакции) после номеров восстановленных заявок
         order.addcomminfo(self.getcommissioninfo(data))  # По тикеру выставляем комиссии в заявку. Нужно для исполнения заявки в BackTrader
         order.addinfo(**kwargs)  # Передаем в заявку все дополнительные свойства из брокера, в т.ч. account_id
         class_code = data.class_code  # Код режима торгов
@@ -198,6 +361,13 @@ class QKBroker(with_metaclass(MetaQKBroker, BrokerBase)):
             order.reject(self)  # то отклоняем заявку
             self.oco_pc_check(order)  # Проверяем связанные и родительскую/дочерние заявки
             return order  # Возвращаем отклоненную заявку
+        if not parent:  # Дочерние заявки только сокращают позицию после исполнения родительской. Их не проверяем
+            reason = self.risk.check(order, data._name, order.price or self.get_last_price(data))  # Проверяем риски до обращения к QUIK
+            if reason:  # Если заявка не прошла проверку рисков
+                self.logger.warning(f'Постановка заявки {order.ref} по тикеру {class_code}.{sec_code} отклонена. {reason}')
+                order.reject(self)  # то отклоняем заявку
+                self.oco_pc_check(order)  # Проверяем связанные и родительскую/дочерние заявки
+                return order  # Возвращаем отклоненную заявку
         if 'account_id' in order.info:  # Если передали номер счета
             account = next((account for account in self.store.provider.accounts if account['account_id'] == order.info['account_id']), None)  # то получаем счет по номеру
             if account and class_code not in account['class_codes']:  # Если в этом счете нет режима торгов тикера
@@ -230,7 +400,7 @@ class QKBroker(with_metaclass(MetaQKBroker, BrokerBase)):
             if not parent:  # Для обычных заявок
                 return self.place_order(order)  # Отправляем заявку на биржу
             else:  # Если последняя заявка в цепочке родительской/дочерних заявок
-                self.notifs.append(order.clone())  # Удедомляем брокера о создании новой заявки
+                self.put_order_notification(order)  # Удедомляем брокера о создании новой заявки
                 return self.place_order(order.parent)  # Отправляем родительскую заявку на биржу
         # Если не последняя заявка в цепочке родительской/дочерних заявок (transmit=False)
         return order  # то возвращаем созданную заявку со статусом Created. На биржу ее пока не ставим
@@ -347,133 +517,141 @@ class QKBroker(with_metaclass(MetaQKBroker, BrokerBase)):
 
     def on_trans_reply(self, data):
         """Обработчик события ответа на транзакцию пользователя"""
-        self.logger.debug(f'on_trans_reply: data={data}')  # Для отладки
-        qk_trans_reply = data['data']  # Ответ на транзакцию
-        order_num = int(qk_trans_reply['order_num'])  # Номер заявки на бирже
-        trans_id = int(qk_trans_reply['trans_id'])  # Номер транзакции заявки
-        if trans_id == 0:  # Заявки, выставленные не из автоторговли / только что (с нулевыми номерами транзакции)
-            self.logger.debug(f'on_trans_reply: Заявка с номером {order_num} выставлена не из автоторговли / только что. Выход')
-            return  # не обрабатываем, пропускаем
-        if trans_id not in self.orders:  # Пришла заявка не из автоторговли
-            self.logger.debug(f'on_trans_reply: Заявка с номером {order_num}. Номер транзакции {trans_id}. Заявка была выставлена не из торговой системы. Выход')
-            return  # не обрабатываем, пропускаем
-        order: Order = self.orders[trans_id]  # Ищем заявку по номеру транзакции
-        order.addinfo(order_num=order_num)  # Передаем в заявку номер заявки на бирже
-        self.logger.debug(f'on_trans_reply: Заявка {order.ref} с номером {order_num}. Номер транзакции {trans_id}. order={order}')
-        # TODO Есть поле flags, но оно не документировано. Лучше вместо текстового результата транзакции разбирать по нему
-        result_msg = str(qk_trans_reply['result_msg']).lower()  # По результату исполнения транзакции (очень плохое решение)
-        status = int(qk_trans_reply['status'])  # Статус транзакции
-        if status == 15 or 'зарегистрирован' in result_msg:  # Если пришел ответ по новой заявке
-            self.logger.debug(f'on_trans_reply: Заявка {order.ref} переведена в статус принята на бирже (Order.Accepted)')
-            order.accept(self)  # Заявка принята на бирже (Order.Accepted)
-        elif 'снят' in result_msg:  # Если пришел ответ по отмене существующей заявки
-            try:
-                self.logger.debug(f'on_trans_reply: Заявка {order.ref} переведена в статус отменена (Order.Canceled)')
-                # В BT очень редко при order.cancel() возникает ошибка:
-                # order.py, line 487, in cancel
-                # self.executed.dt = self.data.datetime[0]
-                # linebuffer.py, line 163, in __getitem__
-                # return self.array[self.idx + ago]
-                # IndexError: array index out of range
-                order.cancel()  # Отменяем существующую заявку (Order.Canceled)
-            except (KeyError, IndexError):  # При ошибке
-                order.status = Order.Canceled  # все равно ставим статус заявки Order.Canceled
-        elif status in (2, 4, 5, 10, 11, 12, 13, 14, 16):  # Транзакция не выполнена (ошибка заявки):
-            # - Не найдена заявка для удаления
-            # - Вы не можете снять данную заявку
-            # - Превышен лимит отправки транзакций для данного логина
-            if status == 4 and 'не найдена заявка' in result_msg or \
-               status == 5 and 'не можете снять' in result_msg or 'превышен лимит' in result_msg:
-                self.logger.debug(f'on_trans_reply: Заявка {order.ref}. Ошибка. Выход')
-                return  # то заявку не отменяем, выходим, дальше не продолжаем
-            try:
-                self.logger.debug(f'on_trans_reply: Заявка {order.ref} переведена в статус отклонена (Order.Rejected)')
-                # В BT очень редко при order.reject() возникает ошибка:
-                # order.py, line 480, in reject
-                # self.executed.dt = self.data.datetime[0]
-                # linebuffer.py, line 163, in __getitem__
-                # return self.array[self.idx + ago]
-                # IndexError: array index out of range
-                order.reject(self)  # Отклоняем заявку (Order.Rejected)
-            except (KeyError, IndexError):  # При ошибке
-                order.status = Order.Rejected  # все равно ставим статус заявки Order.Rejected
-        elif status == 6:  # Транзакция не прошла проверку лимитов сервера QUIK
-            try:
-                self.logger.debug(f'on_trans_reply: Заявка {order.ref} переведена в статус не прошла проверку лимитов (Order.Margin)')
-                # В BT очень редко при order.margin() возникает ошибка:
-                # order.py, line 492, in margin
-                # self.executed.dt = self.data.datetime[0]
-                # linebuffer.py, line 163, in __getitem__
-                # return self.array[self.idx + ago]
-                # IndexError: array index out of range
-                order.margin()  # Для заявки не хватает средств (Order.Margin)
-            except (KeyError, IndexError):  # При ошибке
-                order.status = Order.Margin  # все равно ставим статус заявки Order.Margin
-        self.notifs.append(order.clone())  # Уведомляем брокера о заявке
-        if order.status != Order.Accepted:  # Если новая заявка не зарегистрирована
-            self.logger.debug(f'on_trans_reply: Заявка {order.ref}. Проверка связанных и родительских/дочерних заявок')
-            self.oco_pc_check(order)  # то проверяем связанные и родительскую/дочерние заявки (Canceled, Rejected, Margin)
-        self.logger.debug(f'on_trans_reply: Заявка {order.ref}. Выход')
+        with self.lock:  # Пока обрабатываем ответ на транзакцию, снимок состояния не записывается
+            self.logger.debug('on_trans_reply: data=%s', data)  # Для отладки
+            qk_trans_reply = data['data']  # Ответ на транзакцию
+            if self.events.isEnabledFor(logging.INFO):  # Если ведется лог событий QUIK
+                self.events.info('on_trans_reply', extra=dict(event=qk_trans_reply))  # то записываем в него ответ на транзакцию целиком
+            order_num = int(qk_trans_reply['order_num'])  # Номер заявки на бирже
+            trans_id = int(qk_trans_reply['trans_id'])  # Номер транзакции заявки
+            if trans_id == 0:  # Заявки, выставленные не из автоторговли / только что (с нулевыми номерами транзакции)
+                self.logger.debug('on_trans_reply: Заявка с номером %s выставлена не из автоторговли / только что. Выход', order_num)
+                return  # не обрабатываем, пропускаем
+            if trans_id not in self.orders:  # Пришла заявка не из автоторговли
+                self.logger.debug('on_trans_reply: Заявка с номером %s. Номер транзакции %s. Заявка была выставлена не из торговой системы. Выход', order_num, trans_id)
+                return  # не обрабатываем, пропускаем
+            order: Order = self.orders[trans_id]  # Ищем заявку по номеру транзакции
+            order.addinfo(order_num=order_num)  # Передаем в заявку номер заявки на бирже
+            self.logger.debug('on_trans_reply: Заявка %s с номером %s. Номер транзакции %s. order=%s', order.ref, order_num, trans_id, order)
+            # TODO Есть поле flags, но оно не документировано. Лучше вместо текстового результата транзакции разбирать по нему
+            result_msg = str(qk_trans_reply['result_msg']).lower()  # По результату исполнения транзакции (очень плохое решение)
+            status = int(qk_trans_reply['status'])  # Статус транзакции
+            if status == 15 or 'зарегистрирован' in result_msg:  # Если пришел ответ по новой заявке
+                self.logger.debug('on_trans_reply: Заявка %s переведена в статус принята на бирже (Order.Accepted)', order.ref)
+                order.accept(self)  # Заявка принята на бирже (Order.Accepted)
+            elif 'снят' in result_msg:  # Если пришел ответ по отмене существующей заявки
+                try:
+                    self.logger.debug('on_trans_reply: Заявка %s переведена в статус отменена (Order.Canceled)', order.ref)
+                    # В BT очень редко при order.cancel() возникает ошибка:
+                    # order.py, line 487, in cancel
+                    # self.executed.dt = self.data.datetime[0]
+                    # linebuffer.py, line 163, in __getitem__
+                    # return self.array[self.idx + ago]
+                    # IndexError: array index out of range
+                    order.cancel()  # Отменяем существующую заявку (Order.Canceled)
+                except (KeyError, IndexError):  # При ошибке
+                    order.status = Order.Canceled  # все равно ставим статус заявки Order.Canceled
+            elif status in (2, 4, 5, 10, 11, 12, 13, 14, 16):  # Транзакция не выполнена (ошибка заявки):
+                # - Не найдена заявка для удаления
+                # - Вы не можете снять данную заявку
+                # - Превышен лимит отправки транзакций для данного логина
+                if status == 4 and 'не найдена заявка' in result_msg or \
+                   status == 5 and 'не можете снять' in result_msg or 'превышен лимит' in result_msg:
+                    self.logger.debug('on_trans_reply: Заявка %s. Ошибка. Выход', order.ref)
+                    return  # то заявку не отменяем, выходим, дальше не продолжаем
+                try:
+                    self.logger.debug('on_trans_reply: Заявка %s переведена в статус отклонена (Order.Rejected)', order.ref)
+                    # В BT очень редко при order.reject() возникает ошибка:
+                    # order.py, line 480, in reject
+                    # self.executed.dt = self.data.datetime[0]
+                    # linebuffer.py, line 163, in __getitem__
+                    # return self.array[self.idx + ago]
+                    # IndexError: array index out of range
+                    order.reject(self)  # Отклоняем заявку (Order.Rejected)
+                except (KeyError, IndexError):  # При ошибке
+                    order.status = Order.Rejected  # все равно ставим статус заявки Order.Rejected
+            elif status == 6:  # Транзакция не прошла проверку лимитов сервера QUIK
+                try:
+                    self.logger.debug('on_trans_reply: Заявка %s переведена в статус не прошла проверку лимитов (Order.Margin)', order.ref)
+                    # В BT очень редко при order.margin() возникает ошибка:
+                    # order.py, line 492, in margin
+                    # self.executed.dt = self.data.datetime[0]
+                    # linebuffer.py, line 163, in __getitem__
+                    # return self.array[self.idx + ago]
+                    # IndexError: array index out of range
+                    order.margin()  # Для заявки не хватает средств (Order.Margin)
+                except (KeyError, IndexError):  # При ошибке
+                    order.status = Order.Margin  # все равно ставим статус заявки Order.Margin
+            self.put_order_notification(order)  # Уведомляем брокера о заявке
+            if order.status != Order.Accepted:  # Если новая заявка не зарегистрирована
+                self.logger.debug('on_trans_reply: Заявка %s. Проверка связанных и родительских/дочерних заявок', order.ref)
+                self.oco_pc_check(order)  # то проверяем связанные и родительскую/дочерние заявки (Canceled, Rejected, Margin)
+            self.logger.debug('on_trans_reply: Заявка %s. Выход', order.ref)
 
     def on_trade(self, data):
         """Обработчик события получения новой / изменения существующей сделки.
         Выполняется до события изменения существующей заявки. Нужен для определения цены исполнения заявок.
         """
-        self.logger.debug(f'on_trade: data={data}')  # Для отладки
-        qk_trade = data['data']  # Сделка в QUIK
-        trade_num = int(qk_trade['trade_num'])  # Номер сделки (дублируется 3 раза)
-        order_num = int(qk_trade['order_num'])  # Номер заявки на бирже
-        trans_id = int(qk_trade['trans_id'])  # Номер транзакции из заявки на бирже. Не используем GetOrderByNumber, т.к. он может вернуть 0
-        if trans_id == 0:  # Заявки, выставленные не из автоторговли / только что (с нулевыми номерами транзакции)
-            self.logger.debug(f'on_trade: Заявка с номером {order_num} выставлена не из автоторговли / только что. Выход')
-            return  # выходим, дальше не продолжаем
-        if trans_id not in self.orders:  # Пришла заявка не из автоторговли
-            self.logger.debug(f'on_trade: Заявка с номером {order_num}. Номер транзакции {trans_id}. Заявка была выставлена не из торговой системы. Выход')
-            return  # выходим, дальше не продолжаем
-        order: Order = self.orders[trans_id]  # Ищем заявку по номеру транзакции
-        order.addinfo(order_num=order_num)  # Сохраняем номер заявки на бирже (может быть переход от стоп заявки к лимитной с изменением номера на бирже)
-        self.logger.debug(f'on_trade: Заявка {order.ref} с номером {order_num}. Номер транзакции {trans_id}. Номер сделки {trade_num} order={order}')
-        class_code = qk_trade['class_code']  # Код режима торгов
-        sec_code = qk_trade['sec_code']  # Код тикера
-        dataname = self.store.provider.class_sec_codes_to_dataname(class_code, sec_code)  # Получаем название тикера по коду режима торгов и коду тикера
-        if dataname not in self.trade_nums.keys():  # Если это первая сделка по тикеру
-            self.trade_nums[dataname] = []  # то ставим пустой список сделок
-        elif trade_num in self.trade_nums[dataname]:  # Если номер сделки есть в списке (фильтр для дублей)
-            self.logger.debug(f'on_trade: Заявка {order.ref}. Номер сделки {trade_num} есть в списке сделок (дубль). Выход')
-            return  # то выходим, дальше не продолжаем
-        self.trade_nums[dataname].append(trade_num)  # Запоминаем номер сделки по тикеру, чтобы в будущем ее не обрабатывать (фильтр для дублей)
-        size = int(qk_trade['qty'])  # Абсолютное кол-во
-        if self.p.lots:  # Если входящий остаток в лотах
-            size = self.store.provider.lots_to_size(class_code, sec_code, size)  # то переводим кол-во из лотов в штуки
-        if qk_trade['flags'] & 0b100 == 0b100:  # Если сделка на продажу (бит 2)
-            size *= -1  # то кол-во ставим отрицательным
-        price = self.store.provider.quik_price_to_price(class_code, sec_code, float(qk_trade['price']))  # Переводим цену QUIK в цену в рублях за штуку
-        self.logger.debug(f'on_trade: Заявка {order.ref}. size={size}, price={price}')
-        try:
-            # В BT очень редко возникает ошибка:
-            # linebuffer.py, line 163, in __getitem__
-            # return self.array[self.idx + ago]
-            # IndexError: array index out of range
-            dt = order.data.datetime[0]  # Дата и время исполнения заявки. Последняя известная
-            self.logger.debug(f'on_trade: Заявка {order.ref}. Дата/время исполнения заявки по бару {dt}')
-        except (KeyError, IndexError):  # При ошибке
-            dt = datetime.now(self.store.provider.tz_msk)  # Берем текущее время на бирже из локального
-            self.logger.debug(f'on_trade: Заявка {order.ref}. Дата/время исполнения заявки по текущему {dt}')
-        position = self.getposition(order.data)  # Получаем позицию по тикеру или нулевую позицию если тикера в списке позиций нет
-        psize, pprice, opened, closed = position.update(size, price)  # Обновляем размер/цену позиции на размер/цену сделки
-        order.execute(dt, size, price, closed, 0, 0, opened, 0, 0, 0, 0, psize, pprice)  # Исполняем заявку в BackTrader
-        if order.executed.remsize:  # Если заявка исполнена частично (осталось что-то к исполнению)
-            self.logger.debug(f'on_trade: Заявка {order.ref} исполнилась частично. Остаток к исполнения {order.executed.remsize}')
-            if order.status != order.Partial:  # Если заявка переходит в статус частичного исполнения (может исполняться несколькими частями)
-                self.logger.debug(f'on_trade: Заявка {order.ref} переведена в статус частично исполнена (Order.Partial)')
-                order.partial()  # Переводим заявку в статус Order.Partial
-                self.notifs.append(order.clone())  # Уведомляем брокера о частичном исполнении заявки
-        else:  # Если заявка исполнена полностью (ничего нет к исполнению)
-            self.logger.debug(f'on_trade: Заявка {order.ref} переведена в статус полностью исполнена (Order.Completed)')
-            order.completed()  # Переводим заявку в статус Order.Completed
-            self.notifs.append(order.clone())  # Уведомляем брокера о полном исполнении заявки
-            # Снимаем oco-заявку только после полного исполнения заявки
-            # Если нужно снять oco-заявку на частичном исполнении, то прописываем это правило в ТС
-            self.logger.debug(f'on_trade: Заявка {order.ref}. Проверка связанных и родительских/дочерних заявок')
-            self.oco_pc_check(order)  # Проверяем связанные и родительскую/дочерние заявки (Completed)
-        self.logger.debug(f'on_trade: Заявка {order.ref}. Выход')
+        with self.lock:  # Пока обрабатываем сделку, снимок состояния не записывается
+            self.logger.debug('on_trade: data=%s', data)  # Для отладки
+            qk_trade = data['data']  # Сделка в QUIK
+            if self.events.isEnabledFor(logging.INFO):  # Если ведется лог событий QUIK
+                self.events.info('on_trade', extra=dict(event=qk_trade))  # то записываем в него сделку целиком
+            trade_num = int(qk_trade['trade_num'])  # Номер сделки (дублируется 3 раза)
+            order_num = int(qk_trade['order_num'])  # Номер заявки на бирже
+            trans_id = int(qk_trade['trans_id'])  # Номер транзакции из заявки на бирже. Не используем GetOrderByNumber, т.к. он может вернуть 0
+            if trans_id == 0:  # Заявки, выставленные не из автоторговли / только что (с нулевыми номерами транзакции)
+                self.logger.debug('on_trade: Заявка с номером %s выставлена не из автоторговли / только что. Выход', order_num)
+                return  # выходим, дальше не продолжаем
+            if trans_id not in self.orders:  # Пришла заявка не из автоторговли
+                self.logger.debug('on_trade: Заявка с номером %s. Номер транзакции %s. Заявка была выставлена не из торговой системы. Выход', order_num, trans_id)
+                return  # выходим, дальше не продолжаем
+            order: Order = self.orders[trans_id]  # Ищем заявку по номеру транзакции
+            order.addinfo(order_num=order_num)  # Сохраняем номер заявки на бирже (может быть переход от стоп заявки к лимитной с изменением номера на бирже)
+            self.logger.debug('on_trade: Заявка %s с номером %s. Номер транзакции %s. Номер сделки %s order=%s', order.ref, order_num, trans_id, trade_num, order)
+            class_code = qk_trade['class_code']  # Код режима торгов
+            sec_code = qk_trade['sec_code']  # Код тикера
+            dataname = self.store.provider.class_sec_codes_to_dataname(class_code, sec_code)  # Получаем название тикера по коду режима торгов и коду тикера
+            if dataname not in self.trade_nums.keys():  # Если это первая сделка по тикеру
+                self.trade_nums[dataname] = []  # то ставим пустой список сделок
+            elif trade_num in self.trade_nums[dataname]:  # Если номер сделки есть в списке (фильтр для дублей)
+                self.logger.debug('on_trade: Заявка %s. Номер сделки %s есть в списке сделок (дубль). Выход', order.ref, trade_num)
+                return  # то выходим, дальше не продолжаем
+            self.trade_nums[dataname].append(trade_num)  # Запоминаем номер сделки по тикеру, чтобы в будущем ее не обрабатывать (фильтр для дублей)
+            size = int(qk_trade['qty'])  # Абсолютное кол-во
+            if self.p.lots:  # Если входящий остаток в лотах
+                size = self.store.provider.lots_to_size(class_code, sec_code, size)  # то переводим кол-во из лотов в штуки
+            if qk_trade['flags'] & 0b100 == 0b100:  # Если сделка на продажу (бит 2)
+                size *= -1  # то кол-во ставим отрицательным
+            price = self.store.provider.quik_price_to_price(class_code, sec_code, float(qk_trade['price']))  # Переводим цену QUIK в цену в рублях за штуку
+            self.logger.debug('on_trade: Заявка %s. size=%s, price=%s', order.ref, size, price)
+            try:
+                # В BT очень редко возникает ошибка:
+                # linebuffer.py, line 163, in __getitem__
+                # return self.array[self.idx + ago]
+                # IndexError: array index out of range
+                dt = order.data.datetime[0]  # Дата и время исполнения заявки. Последняя известная
+                self.logger.debug('on_trade: Заявка %s. Дата/время исполнения заявки по бару %s', order.ref, dt)
+            except (KeyError, IndexError):  # При ошибке
+                dt = datetime.now(self.store.provider.tz_msk)  # Берем текущее время на бирже из локального
+                self.logger.debug('on_trade: Заявка %s. Дата/время исполнения заявки по текущему %s', order.ref, dt)
+            position = self.getposition(order.data)  # Получаем позицию по тикеру или нулевую позицию если тикера в списке позиций нет
+            open_price = position.price  # Цена открытия позиции до сделки
+            psize, pprice, opened, closed = position.update(size, price)  # Обновляем размер/цену позиции на размер/цену сделки
+            order.execute(dt, size, price, closed, 0, 0, opened, 0, 0, 0, 0, psize, pprice)  # Исполняем заявку в BackTrader
+            self.risk.on_trade(order, order.data._name, psize, price, -closed * (price - open_price))  # Меняем позицию, прибыль/убыток за день и резерв заявки для проверок рисков
+            if order.executed.remsize:  # Если заявка исполнена частично (осталось что-то к исполнению)
+                self.logger.debug('on_trade: Заявка %s исполнилась частично. Остаток к исполнения %s', order.ref, order.executed.remsize)
+                if order.status != order.Partial:  # Если заявка переходит в статус частичного исполнения (может исполняться несколькими частями)
+                    self.logger.debug('on_trade: Заявка %s переведена в статус частично исполнена (Order.Partial)', order.ref)
+                    order.partial()  # Переводим заявку в статус Order.Partial
+                    self.put_order_notification(order)  # Уведомляем брокера о частичном исполнении заявки
+            else:  # Если заявка исполнена полностью (ничего нет к исполнению)
+                self.logger.debug('on_trade: Заявка %s переведена в статус полностью исполнена (Order.Completed)', order.ref)
+                order.completed()  # Переводим заявку в статус Order.Completed
+                self.put_order_notification(order)  # Уведомляем брокера о полном исполнении заявки
+                # Снимаем oco-заявку только после полного исполнения заявки
+                # Если нужно снять oco-заявку на частичном исполнении, то прописываем это правило в ТС
+                self.logger.debug('on_trade: Заявка %s. Проверка связанных и родительских/дочерних заявок', order.ref)
+                self.oco_pc_check(order)  # Проверяем связанные и родительскую/дочерние заявки (Completed)
+            self.logger.debug('on_trade: Заявка %s. Выход', order.ref)
@@ -1,16 +1,15 @@
 import logging  # Будем вести лог
 from datetime import datetime, timedelta, time, UTC
-from time import sleep
+from time import sleep, monotonic
 from uuid import uuid4  # Номера расписаний должны быть уникальными во времени и пространстве
 from threading import Thread, Event  # Поток и событие остановки потока получения новых бар по расписанию биржи
 import os.path
-import csv
 
 from backtrader.feed import AbstractDataBase
 from backtrader.utils.py3 import with_metaclass
 from backtrader import TimeFrame, date2num
 
-from BackTraderQuik import QKStore
+from BackTraderQuik import QKStore, QKHistory, QKSharedHistory, QKBarBuffer
 
 
 class MetaQKData(AbstractDataBase.__class__):
@@ -26,78 +25,140 @@ class QKData(with_metaclass(MetaQKData, AbstractDataBase)):
         ('four_price_doji', False),  # False - не пропускать дожи 4-х цен, True - пропускать
         ('schedule', None),  # Расписание работы биржи. Если не задано, то берем из подписки
         ('live_bars', False),  # False - только история, True - история и новые бары
+        ('intrabar', False),  # False - только закрытые бары, True - также изменения формирующегося бара (только по подписке)
+        ('partition', None),  # Разделы файла истории по датам: None - один файл, 'year' - по годам, 'month' - по месяцам, 'day' - по дням
+        ('offline', False),  # False - история из файла и QUIK, True - только история из файла без подключения к QUIK
+        ('buffer_size', 1000),  # Максимальное кол-во новых бар, ожидающих отправки в ТС
+        ('overflow', 'drop_oldest'),  # Политика переполнения буфера новых бар: 'block' - ждать (только по расписанию), 'drop_oldest' - удалять самый старый бар, 'coalesce' - заменять последний бар
     )
     datapath = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'Data', 'QUIK', '')  # Путь сохранения файла истории
     delimiter = '\t'  # Разделитель значений в файле истории. По умолчанию табуляция
     dt_format = '%d.%m.%Y %H:%M'  # Формат представления даты и времени в файле истории. По умолчанию русский формат
     sleep_time_sec = 0.000_001  # Время ожидания в секундах, если не пришел новый бар. Для снижения нагрузки/энергопотребления процессора
     delta = 3  # Корректировка в секундах при проверке времени окончания бара
+    quik_time_sec = 1  # Время в секундах, в течение которого текущее время QUIK вычисляется по часам компьютера без запроса к QUIK
 
     def islive(self):
         """Если подаем новые бары, то Cerebro не будет запускать preload и runonce, т.к. новые бары должны идти один за другим"""
-        return self.p.live_bars
+        return self.p.live_bars and not self.p.offline  # Без подключения к QUIK новых бар нет
 
     def __init__(self, **kwargs):
-        self.store = QKStore(**kwargs)  # Хранилище QUIK
-        self.class_code, self.sec_code = self.store.provider.dataname_to_class_sec_codes(self.p.dataname)  # По тикеру получаем код режима торгов и тикер
+        self.store = QKStore(**kwargs)  # Хранилище QUIK. Подключение к QUIK создается при первом обращении к нему
+        if self.p.offline and '.' not in self.p.dataname:  # Без подключения к QUIK код режима торгов по тикеру не найти
+            raise ValueError(f'Тикер {self.p.dataname} без подключения к QUIK нужно задавать в формате <Код режима торгов>.<Тикер>')
+        if self.p.overflow == 'block' and self.p.live_bars and not self.p.schedule:  # Бары по подписке добавляет в буфер единственный поток событий QUIK
+            raise ValueError('Политика переполнения буфера block работает только для новых бар по расписанию. По подписке она остановит поток событий QUIK: ответы на транзакции, сделки, бары и стаканы всех данных')
+        self.class_code, self.sec_code = self.store.dataname_to_class_sec_codes(self.p.dataname)  # По тикеру получаем код режима торгов и тикер
         self.derivative = self.class_code == 'SPBFUT'  # Для деривативов не используем конвертацию цен и кол-ва
         self.quik_timeframe = self.bt_timeframe_to_quik_timeframe(self.p.timeframe, self.p.compression)  # Конвертируем временной интервал из BackTrader в QUIK
         self.tf = self.bt_timeframe_to_tf(self.p.timeframe, self.p.compression)  # Конвертируем временной интервал из BackTrader для имени файла истории и расписания
         self.file = f'{self.class_code}.{self.sec_code}_{self.tf}'  # Имя файла истории
         self.logger = logging.getLogger(f'QKData.{self.file}')  # Будем вести лог
-        self.file_name = f'{self.datapath}{self.file}.txt'  # Полное имя файла истории
+        self.history = QKHistory(self.datapath, self.file, self.p.partition, self.delimiter, self.dt_format)  # История в файле/файлах-разделах
         self.history_bars = []  # Исторические бары из файла и истории после проверки на соответствие условиям выборки
         self.guid = None  # Идентификатор подписки/расписания на историю цен
+        self.bar_buffer = None  # Буфер новых бар подписки/расписания
         self.exit_event = Event()  # Определяем событие выхода из потока
         self.dt_last_open = datetime.min  # Дата и время открытия последнего полученного бара
         self.last_bar_received = False  # Получен последний бар
         self.live_mode = False  # Режим получения баров. False = История, True = Новые бары
+        self.forming_bar = None  # Последнее отправленное в ТС изменение формирующегося бара
+        self.quik_time = None  # Последнее полученное из QUIK текущее время и время его получения по часам компьютера
+        self.shared_name = None  # Имя блока общей памяти с историей. Задается в share_history()
+        self.shared_history = None  # История в общей памяти
+        self.shared_index = 0  # Номер следующего бара из общей памяти
+        if self.p.intrabar:  # Если получаем изменения формирующегося бара
+            self.replaying = True  # то бар будет обновляться на месте, как при воспроизведении (replay)
+
+    def __getstate__(self):
+        """Состояние данных для передачи в процессы оптимизации"""
+        state = self.__dict__.copy()
+        del state['exit_event']  # Событие не передается между процессами
+        state['shared_history'] = None  # К общей памяти процесс подключится сам по имени блока
+        if self.shared_name:  # Если история в общей памяти
+            state['history_bars'] = []  # то бары не копируем
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.exit_event = Event()  # Событие выхода из потока в этом процессе
 
     def setenvironment(self, env):
         """Добавление хранилища QUIK в cerebro"""
         super(QKData, self).setenvironment(env)
         env.addstore(self.store)  # Добавление хранилища QUIK в cerebro
+        self.store.datas[self._name] = self  # Регистрируем данные в хранилище по названию
 
     def start(self):
         super(QKData, self).start()
         self.put_notification(self.DELAYED)  # Отправляем уведомление об отправке исторических (не новых) баров
-        self.get_bars_from_file()  # Получаем бары из файла
-        self.get_bars_from_history()  # Получаем бары из истории
-        if len(self.history_bars) > 0:  # Если был получен хотя бы 1 бар
+        if self.shared_name:  # Если история загружена в общую память
+            if self.is_preloaded_for_optimization():  # Если cerebro загружает данные в родительском процессе и копирует их в процессы оптимизации
+                self.logger.warning('История в общей памяти не экономит память процессов оптимизации при optdatas=True. Запускайте cerebro.run(optdatas=False)')
+            if not self.shared_history:  # Если процесс еще не подключен к общей памяти
+                self.shared_history = QKSharedHistory.attach(self.shared_name)  # то подключаемся к ней без копирования
+            self.shared_index = 0  # Бары будем получать с первого
+        else:  # Если истории в общей памяти нет
+            self.get_bars_from_file()  # Получаем бары из файла
+            if not self.p.offline:  # Если есть подключение к QUIK
+                self.get_bars_from_history()  # то получаем бары из истории
+        if len(self.history_bars) > 0 or self.shared_history and len(self.shared_history) > 0:  # Если был получен хотя бы 1 бар
             self.put_notification(self.CONNECTED)  # то отправляем уведомление о подключении и начале получения исторических бар
-        if self.p.live_bars:  # Если получаем историю и новые бары
+        if self.p.live_bars and self.p.offline:  # Если новые бары заданы без подключения к QUIK
+            self.logger.warning('Без подключения к QUIK новые бары не получаются. Будет отправлена только история из файла')
+        elif self.p.live_bars:  # Если получаем историю и новые бары
             if self.p.schedule:  # Если получаем новые бары по расписанию
                 self.guid = str(uuid4())  # guid расписания
+                self.register_bar_buffer()  # Новые бары будут приходить в буфер
                 Thread(target=self.stream_bars).start()  # Создаем и запускаем получение новых бар по расписанию в потоке
             else:  # Если получаем новые бары по подписке
                 self.guid = (self.class_code, self.sec_code, self.quik_timeframe)  # guid подписки
+                self.register_bar_buffer()  # Новые бары будут приходить в буфер. Буфер нужен до подписки, чтобы не пропустить бары
                 self.logger.debug('Запуск подписки на новые бары')
                 if not self.store.provider.is_subscribed(self.class_code, self.sec_code, self.quik_timeframe)['data']:  # Если не было подписки на тикер/интервал
                     self.store.provider.subscribe_to_candles(self.class_code, self.sec_code, self.quik_timeframe)  # Подписываемся на новые бары
 
     def _load(self):
         """Загрузка бара из истории или нового бара"""
+        if self.shared_history and self.shared_index < len(self.shared_history):  # Если есть исторические данные в общей памяти
+            self.shared_index += 1  # то следующий бар будем получать со следующего номера
+            return self.put_lines(self.shared_history.get_row(self.shared_index - 1))  # Бары в общей памяти уже проверены и переведены в значения линий
         if len(self.history_bars) > 0:  # Если есть исторические данные
             bar = self.history_bars.pop(0)  # Берем и удаляем первый бар из хранилища исторических данных. С ним будем работать
-        elif not self.p.live_bars:  # Если получаем только историю (self.history_bars) и исторических данных нет / все исторические данные получены
+        elif not self.islive():  # Если получаем только историю (self.history_bars) и исторических данных нет / все исторические данные получены
             self.put_notification(self.DISCONNECTED)  # Отправляем уведомление об окончании получения исторических бар
             self.logger.debug('Бары из файла/истории отправлены в ТС. Новые бары получать не нужно. Выход')
             return False  # Больше сюда заходить не будем
-        else:  # Если получаем историю и новые бары (self.store.new_bars)
-            new_bars = [new_bar for new_bar in self.store.new_bars if new_bar['guid'] == self.guid]  # Получаем новые бары из хранилища по guid
-            if len(new_bars) == 0:  # Если новый бар еще не появился
+        else:  # Если получаем историю и новые бары (self.bar_buffer)
+            bar = self.bar_buffer.get()  # Берем и удаляем первый бар из буфера новых бар. С ним будем работать
+            if bar is None:  # Если новый бар еще не появился
                 # self.logger.debug(f'Новых бар нет. Ожидание {self.sleep_time_sec} с')  # Для отладки. Грузит процессор
                 sleep(self.sleep_time_sec)  # Ждем для снижения нагрузки/энергопотребления процессора
                 return None  # то нового бара нет, будем заходить еще
-            self.last_bar_received = len(new_bars) == 1  # Если в хранилище остался 1 бар, то мы будем получать последний возможный бар
+            next_bar = self.bar_buffer.peek()  # Следующий бар в буфере
+            self.last_bar_received = next_bar is None  # Если в буфере больше нет бар, то мы получаем последний возможный бар
             if self.last_bar_received:  # Получаем последний возможный бар
                 self.logger.debug('Получение последнего возможного на данный момент бара')
-            bar = new_bars[0]  # Берем первый бар из хранилища новых бар. С ним будем работать
-            self.store.new_bars.remove(bar)  # Удаляем этот бар из хранилища новых бар
-            bar = bar['data']  # Данные бара
+            if self.p.intrabar and next_bar and next_bar['datetime'] == bar['datetime']:  # Если в буфере уже есть более свежее изменение этого бара
+                return None  # то пропускаем устаревшее изменение без проверок со временем QUIK, будем заходить еще
             if not self.is_bar_valid(bar):  # Если бар не соответствует всем условиям выборки
-                return None  # то пропускаем бар, будем заходить еще
-            self.logger.debug(f'Сохранение нового бара с {bar["datetime"].strftime(self.dt_format)} в файл')
+                if not self.is_forming_bar_update(bar):  # Если это не новое изменение формирующегося бара
+                    return None  # то пропускаем бар, будем заходить еще
+                if self.forming_bar and self.forming_bar[0] == bar['datetime']:  # Если этот бар уже был отправлен в ТС
+                    self.backwards(force=True)  # то обновляем его на месте
+                self.forming_bar = (bar['datetime'], bar['open'], bar['high'], bar['low'], bar['close'], bar['volume'])  # Запоминаем изменение формирующегося бара
+                if self.last_bar_received and not self.live_mode:  # Формирующийся бар может прийти раньше первого закрытого бара в режиме LIVE
+                    self.put_notification(self.LIVE)  # Отправляем уведомление о получении новых бар
+                    self.live_mode = True  # Переходим в режим получения новых бар (LIVE)
+                return self.put_bar(bar)  # Отправляем изменение формирующегося бара в ТС
+            if self.forming_bar and self.forming_bar[0] > bar['datetime']:  # Если бар закрылся, когда в ТС уже отправлены изменения следующего бара
+                self.save_bar_to_file(bar)  # то сохраняем бар в конец файла
+                self.put_closed_bar(bar)  # и заменяем устаревшие значения бара в линиях. ТС уже обработала бар с ними, заново он в ТС не отправляется
+                return None  # Возвращаться назад по времени в ТС нельзя, будем заходить еще
+            if self.forming_bar and self.forming_bar[0] == bar['datetime']:  # Если бар закрылся после отправки в ТС его изменений
+                self.backwards(force=True)  # то закрытый бар заменяет формирующийся на месте
+            self.forming_bar = None  # Формирующегося бара больше нет
+            self.logger.debug('Сохранение нового бара с %s в файл', bar["datetime"])
             self.save_bar_to_file(bar)  # Сохраняем бар в конец файла
             if self.last_bar_received and not self.live_mode:  # Если получили последний бар и еще не находимся в режиме получения новых бар (LIVE)
                 self.put_notification(self.LIVE)  # Отправляем уведомление о получении новых бар
@@ -105,43 +166,90 @@ class QKData(with_metaclass(MetaQKData, AbstractDataBase)):
             elif self.live_mode and not self.last_bar_received:  # Если находимся в режиме получения новых бар (LIVE)
                 self.put_notification(self.DELAYED)  # Отправляем уведомление об отправке исторических (не новых) бар
                 self.live_mode = False  # Переходим в режим получения истории
-        # Все проверки пройдены. Записываем полученный исторический/новый бар
-        self.lines.datetime[0] = date2num(bar['datetime'])  # Переводим в формат хранения даты/времени в BackTrader
-        self.lines.open[0] = bar['open'] if self.derivative else self.store.provider.quik_price_to_price(self.class_code, self.sec_code, bar['open'])  # Для деривативов
-        self.lines.high[0] = bar['high'] if self.derivative else self.store.provider.quik_price_to_price(self.class_code, self.sec_code, bar['high'])  # цена без изменения
-        self.lines.low[0] = bar['low'] if self.derivative else self.store.provider.quik_price_to_price(self.class_code, self.sec_code, bar['low'])  # Для остальных
-        self.lines.close[0] = bar['close'] if self.derivative else self.store.provider.quik_price_to_price(self.class_code, self.sec_code, bar['close'])  # цена в рублях за штуку
-        self.lines.volume[0] = int(bar['volume']) if self.derivative else self.store.provider.lots_to_size(self.class_code, self.sec_code, int(bar['volume']))  # Для деривативов кол-во лотов. Для остальных кол-во штук
-        self.lines.openinterest[0] = 0  # Открытый интерес в QUIK не учитывается
+        return self.put_bar(bar)  # Все проверки пройдены. Записываем полученный исторический/новый бар
+
+    def put_bar(self, bar) -> bool:
+        """Запись бара в линии BackTrader"""
+        return self.put_lines(self.get_bar_lines(bar))
+
+    def get_bar_lines(self, bar) -> tuple:
+        """Значения линий BackTrader из бара"""
+        if self.p.offline:  # Без подключения к QUIK параметры тикера неизвестны
+            return date2num(bar['datetime']), bar['open'], bar['high'], bar['low'], bar['close'], int(bar['volume'])  # Цены QUIK и объем в лотах
+        return (date2num(bar['datetime']),  # Переводим в формат хранения даты/времени в BackTrader
+                bar['open'] if self.derivative else self.store.provider.quik_price_to_price(self.class_code, self.sec_code, bar['open']),  # Для деривативов
+                bar['high'] if self.derivative else self.store.provider.quik_price_to_price(self.class_code, self.sec_code, bar['high']),  # цена без изменения
+                bar['low'] if self.derivative else self.store.provider.quik_price_to_price(self.class_code, self.sec_code, bar['low']),  # Для остальных
+                bar['close'] if self.derivative else self.store.provider.quik_price_to_price(self.class_code, self.sec_code, bar['close']),  # цена в рублях за штуку
+                int(bar['volume']) if self.derivative else self.store.provider.lots_to_size(self.class_code, self.sec_code, int(bar['volume'])))  # Для деривативов кол-во лотов. Для остальных кол-во штук
+
+    def put_lines(self, values, ago=0) -> bool:
+        """Запись значений линий BackTrader"""
+        self.lines.datetime[ago], self.lines.open[ago], self.lines.high[ago], self.lines.low[ago], self.lines.close[ago], self.lines.volume[ago] = values
+        self.lines.openinterest[ago] = 0  # Открытый интерес в QUIK не учитывается
         return True  # Будем заходить сюда еще
 
+    def put_closed_bar(self, bar) -> None:
+        """Запись значений закрытого бара вместо его изменения, уже отправленного в ТС. В линиях после него есть изменения следующего бара"""
+        dt = date2num(bar['datetime'])  # Дата и время бара в формате BackTrader
+        for ago in range(-1, -len(self), -1):  # Пробегаемся по отправленным в ТС барам с последнего. Текущая ячейка [0] заполняется в _load
+            if self.lines.datetime[ago] == dt:  # Если нашли бар
+                self.put_lines(self.get_bar_lines(bar), ago)  # то заменяем его значения
+                return
+            if self.lines.datetime[ago] < dt:  # Если бара в линиях нет (например, его изменения не проходили выборку)
+                return  # то заменять нечего
+
     def stop(self):
         super(QKData, self).stop()
-        if self.p.live_bars:  # Если была подписка/расписание
+        if self.islive():  # Если была подписка/расписание
             if self.p.schedule:  # Если получаем новые бары по расписанию
                 self.exit_event.set()  # то отменяем расписание
             else:  # Если получаем новые бары по подписке
                 self.logger.info(f'Отмена подписки {self.guid} на новые бары')
                 self.store.provider.unsubscribe_from_candles(self.class_code, self.sec_code, self.quik_timeframe)  # то отменяем подписку
+            if self.bar_buffer:  # Если новые бары приходили в буфер
+                self.store.unregister_bar_buffer(self.guid, self.bar_buffer)  # то бары, пришедшие после отмены подписки, больше не сохраняются
+                self.bar_buffer = None
             self.put_notification(self.DISCONNECTED)  # Отправляем уведомление об окончании получения новых бар
+        if self.shared_history and not self.shared_history.owner:  # Если процесс подключался к общей памяти
+            self.shared_history.close()  # то отключаемся от нее
+            self.shared_history = None
         self.store.DataCls = None  # Удаляем класс данных в хранилище
 
+    # История в общей памяти
+
+    def share_history(self) -> QKSharedHistory:
+        """Загрузка истории в общую память. Вызывается в родительском процессе до cerebro.run(optdatas=False) при оптимизации
+        Процессы оптимизации не читают файл и не обращаются к QUIK за историей, а подключаются к общей памяти без копирования
+        После cerebro.run() общую память нужно освободить через unshare_history()
+        """
+        self.get_bars_from_file()  # Получаем бары из файла
+        if not self.p.offline:  # Если есть подключение к QUIK
+            self.get_bars_from_history()  # то получаем бары из истории
+        self.shared_history = QKSharedHistory.create([self.get_bar_lines(bar) for bar in self.history_bars])  # Загружаем готовые значения линий в общую память
+        self.shared_name = self.shared_history.name  # Имя блока передается в процессы оптимизации
+        self.history_bars = []  # Бары теперь в общей памяти
+        return self.shared_history
+
+    def is_preloaded_for_optimization(self) -> bool:
+        """Данные загружаются в родительском процессе оптимизации и передаются в процессы оптимизации вместе с линиями (cerebro с optdatas=True)"""
+        cerebro = getattr(self, '_env', None)  # cerebro, в который добавлены данные
+        return bool(cerebro and cerebro._dooptimize and cerebro.p.maxcpus != 1 and cerebro.p.optdatas and cerebro._dopreload and cerebro._dorunonce)
+
+    def unshare_history(self) -> None:
+        """Освобождение общей памяти с историей"""
+        if self.shared_history:  # Если история в общей памяти
+            self.shared_history.close()  # то освобождаем общую память
+        self.shared_history = self.shared_name = None
+
     # Получение/сохранение бар
 
     def get_bars_from_file(self) -> None:
-        """Получение бар из файла"""
-        if not os.path.isfile(self.file_name):  # Если файл не существует
-            return  # то выходим, дальше не продолжаем
-        self.logger.debug(f'Получение бар из файла {self.file_name}')
-        with open(self.file_name) as file:  # Открываем файл на последовательное чтение
-            reader = csv.reader(file, delimiter=self.delimiter)  # Данные в строке разделены табуляцией
-            next(reader, None)  # Пропускаем первую строку с заголовками
-            for csv_row in reader:  # Последовательно получаем все строки файла
-                bar = dict(datetime=datetime.strptime(csv_row[0], self.dt_format),
-                           open=float(csv_row[1]), high=float(csv_row[2]), low=float(csv_row[3]), close=float(csv_row[4]),
-                           volume=int(csv_row[5]))  # Бар из файла
-                if self.is_bar_valid(bar):  # Если исторический бар соответствует всем условиям выборки
-                    self.history_bars.append(bar)  # то добавляем бар
+        """Получение бар из файла/файлов-разделов"""
+        self.logger.debug('Получение бар из файла')
+        for bar in self.history.get_bars(self.p.fromdate, self.p.todate):  # Пробегаемся по барам из файла/файлов-разделов, пересекающихся с диапазоном
+            if self.is_bar_valid(bar):  # Если исторический бар соответствует всем условиям выборки
+                self.history_bars.append(bar)  # то добавляем бар
         if len(self.history_bars) > 0:  # Если были получены бары из файла
             self.logger.debug(f'Получено бар из файла: {len(self.history_bars)} с {self.history_bars[0]["datetime"].strftime(self.dt_format)} по {self.history_bars[-1]["datetime"].strftime(self.dt_format)}')
         else:  # Бары из файла не получены
@@ -150,51 +258,82 @@ class QKData(with_metaclass(MetaQKData, AbstractDataBase)):
     def get_bars_from_history(self) -> None:
         """Получение бар из истории"""
         file_history_bars_len = len(self.history_bars)  # Кол-во полученных бар из файла для лога
-        self.logger.debug(f'Получение всех бар из истории')
-        history_bars = self.store.provider.get_candles_from_data_source(self.class_code, self.sec_code, self.quik_timeframe)['data']  # Получаем все бары из QUIK
+        count = self.get_history_count()  # Кол-во последних бар, которые нужно получить из QUIK
+        self.logger.debug(f'Получение из истории {f"последних бар: {count}" if count else "всех бар"}')
+        history_bars = self.store.provider.get_candles_from_data_source(self.class_code, self.sec_code, self.quik_timeframe, count=count)['data']  # Получаем бары из QUIK
         for history_bar in history_bars:  # Пробегаемся по всем полученным барам
             bar = dict(datetime=self.store.get_bar_open_date_time(history_bar),  # Собираем дату и время открытия бара
                        open=history_bar['open'], high=history_bar['high'], low=history_bar['low'], close=history_bar['close'],  # Цены QUIK
                        volume=int(history_bar['volume']))  # Объем в лотах. Бар из истории
             if self.is_bar_valid(bar):  # Если исторический бар соответствует всем условиям выборки
                 self.history_bars.append(bar)  # то добавляем бар
-                self.save_bar_to_file(bar)  # и сохраняем бар в конец файла
+        self.history.append(self.history_bars[file_history_bars_len:])  # Сохраняем все бары из истории в конец файла за один раз
         if len(self.history_bars) - file_history_bars_len > 0:  # Если получены бары из истории
             self.logger.debug(f'Получено бар из истории: {len(self.history_bars) - file_history_bars_len} с {self.history_bars[file_history_bars_len]["datetime"].strftime(self.dt_format)} по {self.history_bars[-1]["datetime"].strftime(self.dt_format)}')
         else:  # Бары из истории не получены
             self.logger.debug('Из истории новых бар не получено')
 
+    def get_history_count(self) -> int:
+        """Кол-во последних бар, которые нужно получить из QUIK. Если бары есть в файле, то получаем только бары после последнего бара из файла. 0 - все бары"""
+        if self.dt_last_open == datetime.min:  # Если баров из файла нет
+            return 0  # то получаем все бары
+        if self.p.timeframe == TimeFrame.Months:  # Для месячного временного интервала
+            bar_length = timedelta(days=28)  # берем самый короткий месяц, чтобы не пропустить бары
+        elif self.p.timeframe == TimeFrame.Years:  # Для годового временного интервала
+            bar_length = timedelta(days=365)  # берем самый короткий год
+        else:  # Для остальных временнЫх интервалов
+            bar_length = self.get_bar_close_date_time(self.dt_last_open) - self.dt_last_open  # длительность бара
+        return int((self.get_quik_date_time_now() - self.dt_last_open) / bar_length) + 2  # Кол-во бар с последнего бара из файла с запасом. Неторговое время дает лишние бары, они будут отброшены при проверке
+
     def is_bar_valid(self, bar) -> bool:
         """Проверка бара на соответствие условиям выборки"""
         dt_open = bar['datetime']  # Дата и время открытия бара МСК
         if dt_open <= self.dt_last_open:  # Если пришел бар из прошлого (дата открытия меньше последней даты открытия)
             # self.logger.debug(f'Дата/время открытия бара {dt_open} <= последней даты/времени открытия {self.dt_last_open}')  # Для отладки, т.к. идет замедление при обработке старых бар на возобновлении подписки
             return False  # то бар не соответствует условиям выборки
-        if self.p.fromdate and dt_open < self.p.fromdate or self.p.todate and dt_open > self.p.todate:  # Если задан диапазон, а бар за его границами
-            self.logger.debug(f'Дата/время открытия бара {dt_open} за границами диапазона {self.p.fromdate} - {self.p.todate}')
-            self.dt_last_open = dt_open  # Запоминаем дату/время открытия пришедшего бара для будущих сравнений
-            return False  # то бар не соответствует условиям выборки
-        if self.p.sessionstart != time.min and dt_open.time() < self.p.sessionstart:  # Если задано время начала сессии и открытие бара до этого времени
-            self.logger.debug(f'Дата/время открытия бара {dt_open} до начала торговой сессии {self.p.sessionstart}')
-            self.dt_last_open = dt_open  # Запоминаем дату/время открытия пришедшего бара для будущих сравнений
-            return False  # то бар не соответствует условиям выборки
         dt_close = self.get_bar_close_date_time(dt_open)  # Дата и время закрытия бара
-        if self.p.sessionend != time(23, 59, 59, 999990) and dt_close.time() > self.p.sessionend:  # Если задано время окончания сессии и закрытие бара после этого времени
-            self.logger.debug(f'Дата/время открытия бара {dt_open} после окончания торговой сессии {self.p.sessionend}')
-            self.dt_last_open = dt_open  # Запоминаем дату/время открытия пришедшего бара для будущих сравнений
-            return False  # то бар не соответствует условиям выборки
-        if not self.p.four_price_doji and bar['high'] == bar['low']:  # Если не пропускаем дожи 4-х цен, но такой бар пришел
-            self.logger.debug(f'Бар {dt_open} - дожи 4-х цен')
-            self.dt_last_open = dt_open  # Запоминаем дату/время открытия пришедшего бара для будущих сравнений
-            return False  # то бар не соответствует условиям выборки
         dt_market_now = self.get_quik_date_time_now()  # Текущая дата и время из QUIK
         dt_market_now_corrected = dt_market_now + timedelta(seconds=self.delta)  # Текущая дата и время из QUIK с корректировкой
         if dt_close > dt_market_now_corrected and dt_market_now_corrected.time() < self.p.sessionend:  # Если время закрытия бара еще не наступило на бирже, и сессия еще не закончилась
-            self.logger.debug(f'Дата/время {dt_close:{self.dt_format}} закрытия бара на {dt_open:{self.dt_format}} еще не наступило. Текущее время {dt_market_now:%d.%m.%Y %H:%M:%S}')
+            self.logger.debug('Дата/время %s закрытия бара на %s еще не наступило. Текущее время %s', dt_close, dt_open, dt_market_now)
+            return False  # то бар не соответствует условиям выборки. Дату/время открытия не запоминаем, чтобы получить этот бар после закрытия
+        self.dt_last_open = dt_open  # Бар закрыт. Запоминаем дату/время открытия пришедшего бара для будущих сравнений
+        if not self.is_bar_in_session(dt_open, dt_close):  # Если бар за границами диапазона или торговой сессии
+            return False  # то бар не соответствует условиям выборки
+        if not self.p.four_price_doji and bar['high'] == bar['low']:  # Если не пропускаем дожи 4-х цен, но такой бар пришел
+            self.logger.debug('Бар %s - дожи 4-х цен', dt_open)
             return False  # то бар не соответствует условиям выборки
-        self.dt_last_open = dt_open  # Запоминаем дату/время открытия пришедшего бара для будущих сравнений
         return True  # В остальных случаях бар соответствуем условиям выборки
 
+    def is_bar_in_session(self, dt_open, dt_close) -> bool:
+        """Проверка бара на попадание в диапазон дат и в торговую сессию"""
+        if self.p.fromdate and dt_open < self.p.fromdate or self.p.todate and dt_open > self.p.todate:  # Если задан диапазон, а бар за его границами
+            self.logger.debug('Дата/время открытия бара %s за границами диапазона %s - %s', dt_open, self.p.fromdate, self.p.todate)
+            return False
+        if self.p.sessionstart != time.min and dt_open.time() < self.p.sessionstart:  # Если задано время начала сессии и открытие бара до этого времени
+            self.logger.debug('Дата/время открытия бара %s до начала торговой сессии %s', dt_open, self.p.sessionstart)
+            return False
+        if self.p.sessionend != time(23, 59, 59, 999990) and dt_close.time() > self.p.sessionend:  # Если задано время окончания сессии и закрытие бара после этого времени
+            self.logger.debug('Дата/время открытия бара %s после окончания торговой сессии %s', dt_open, self.p.sessionend)
+            return False
+        return True
+
+    def is_forming_bar_update(self, bar) -> bool:
+        """Проверка бара, не прошедшего условия выборки, на новое изменение формирующегося бара
+        Изменения формирующегося бара не меняют дату/время открытия последнего бара. Дожи 4-х цен проверяется только у закрытого бара
+        """
+        dt_open = bar['datetime']  # Дата и время открытия бара МСК
+        if not self.p.intrabar or dt_open <= self.dt_last_open:  # Если изменения не получаем, или бар из прошлого / закрытый бар не прошел выборку
+            return False  # то это не изменение формирующегося бара
+        if not self.is_bar_in_session(dt_open, self.get_bar_close_date_time(dt_open)):  # Если бар за границами диапазона или торговой сессии
+            return False  # то его изменения не отправляем
+        return self.forming_bar != (dt_open, bar['open'], bar['high'], bar['low'], bar['close'], bar['volume'])  # Повторы изменения пропускаем
+
+    def register_bar_buffer(self) -> None:
+        """Создание и регистрация в хранилище буфера новых бар"""
+        self.bar_buffer = QKBarBuffer(self.file, self.p.buffer_size, self.p.overflow)  # Буфер новых бар ограниченного размера
+        self.store.register_bar_buffer(self.guid, self.bar_buffer)  # Хранилище будет добавлять новые бары в буфер
+
     def stream_bars(self) -> None:
         """Поток получения новых бар по расписанию биржи"""
         self.logger.debug('Запуск получения новых бар по расписанию')
@@ -213,21 +352,12 @@ class QKData(with_metaclass(MetaQKData, AbstractDataBase)):
                        open=stream_bar['open'], high=stream_bar['high'], low=stream_bar['low'], close=stream_bar['close'],  # Цены QUIK
                        volume=int(stream_bar['volume']))  # Объем в лотах. Бар по расписанию
             self.logger.debug('Получен бар по расписанию')
-            self.store.new_bars.append(dict(guid=self.guid, data=bar))  # Добавляем в хранилище новых бар
+            self.store.put_new_bar(self.guid, bar)  # Добавляем в хранилище новых бар
 
     def save_bar_to_file(self, bar) -> None:
         """Сохранение бара в конец файла"""
-        if not os.path.isfile(self.file_name):  # Существует ли файл
-            self.logger.warning(f'Файл {self.file_name} не найден и будет создан')
-            with open(self.file_name, 'w', newline='') as file:  # Создаем файл
-                writer = csv.writer(file, delimiter=self.delimiter)  # Данные в строке разделены табуляцией
-                writer.writerow(bar.keys())  # Записываем заголовок в файл
-        with open(self.file_name, 'a', newline='') as file:  # Открываем файл на добавление в конец. Ставим newline, чтобы в Windows не создавались пустые строки в файле
-            writer = csv.writer(file, delimiter=self.delimiter)  # Данные в строке разделены табуляцией
-            csv_row = bar.copy()  # Копируем бар для того, чтобы изменить формат даты
-            csv_row['datetime'] = csv_row['datetime'].strftime(self.dt_format)  # Приводим дату к формату файла
-            writer.writerow(csv_row.values())  # Записываем бар в конец файла
-            self.logger.debug(f'В файл {self.file_name} записан бар на {csv_row["datetime"]}')
+        self.history.append([bar])  # Добавляем бар в конец файла/файла-раздела
+        self.logger.debug('В файл записан бар на %s', bar["datetime"])
 
     # Функции
 
@@ -292,10 +422,13 @@ class QKData(with_metaclass(MetaQKData, AbstractDataBase)):
         - Если находимся в режиме получения истории, то переводим текущие дату и время с компьютера в МСК
         """
         if not self.live_mode:  # Если не находимся в режиме получения новых баров
-            return datetime.now(self.store.provider.tz_msk).replace(tzinfo=None)  # То время МСК получаем из локального времени
+            return datetime.now(self.store.tz_msk).replace(tzinfo=None)  # То время МСК получаем из локального времени
+        if self.quik_time and monotonic() - self.quik_time[1] < self.quik_time_sec:  # Если время из QUIK получено недавно. Изменения бара приходят чаще, чем раз в секунду
+            return self.quik_time[0] + timedelta(seconds=monotonic() - self.quik_time[1])  # то вычисляем его без запросов к QUIK
         try:  # Проверяем, можно ли привести полученные строки в дату и время
             d = self.store.provider.get_info_param('TRADEDATE')['data']  # Дата на сервере в виде строки dd.mm.yyyy. Может прийти неверная дата
             t = self.store.provider.get_info_param('SERVERTIME')['data']  # Время на сервере в виде строки hh:mi:ss
-            return datetime.strptime(f'{d} {t}', '%d.%m.%Y %H:%M:%S')  # Переводим строки в дату и время и возвращаем ее
+            self.quik_time = (datetime.strptime(f'{d} {t}', '%d.%m.%Y %H:%M:%S'), monotonic())  # Переводим строки в дату и время и запоминаем время получения
+            return self.quik_time[0]
         except ValueError:  # Если нельзя привести полученные строки в дату и время
-            return datetime.now(self.store.provider.tz_msk).replace(tzinfo=None)  # То время МСК получаем из локального времени
+            return datetime.now(self.store.tz_msk).replace(tzinfo=None)  # То время МСК получаем из локального времени без обращения к QUIK
@@ -0,0 +1,165 @@
+import logging  # Будем вести лог
+from array import array  # Массивы фиксированного размера для уровней стакана
+from datetime import datetime
+from math import nan, isnan
+from threading import Lock  # Блокировка стакана на время обновления/чтения
+from time import sleep, monotonic
+
+from backtrader.feed import AbstractDataBase
+from backtrader.utils.py3 import with_metaclass
+from backtrader import date2num
+
+from BackTraderQuik import QKStore
+
+
+class QKOrderBook:
+    """Стакан тикера в массивах цен/количеств фиксированного размера. Обновляется на месте"""
+    def __init__(self, depth=20):
+        self.depth = depth  # Кол-во уровней стакана с каждой стороны
+        self.bid_prices = array('d', [nan]) * depth  # Цены покупки. Лучшая цена первая
+        self.bid_sizes = array('d', [0.0]) * depth  # Количества покупки
+        self.ask_prices = array('d', [nan]) * depth  # Цены продажи. Лучшая цена первая
+        self.ask_sizes = array('d', [0.0]) * depth  # Количества продажи
+        self.bid_count = self.ask_count = 0  # Кол-во заполненных уровней покупки/продажи
+        self.dt = datetime.min  # Дата и время последнего изменения стакана МСК
+        self.version = 0  # Номер изменения стакана. Увеличивается при каждом изменении
+        self.lock = Lock()  # Блокировка стакана
+
+    def resize(self, depth) -> None:
+        """Увеличение кол-ва уровней стакана. Массивы дополняются на месте. Общий стакан тикера нужен данным с наибольшим кол-вом уровней"""
+        with self.lock:
+            if depth <= self.depth:  # Если уровней хватает
+                return  # то стакан не меняем
+            extra = depth - self.depth  # Кол-во новых уровней
+            self.bid_prices.extend(array('d', [nan]) * extra)
+            self.bid_sizes.extend(array('d', [0.0]) * extra)
+            self.ask_prices.extend(array('d', [nan]) * extra)
+            self.ask_sizes.extend(array('d', [0.0]) * extra)
+            self.depth = depth  # Новые уровни заполнятся при следующем изменении стакана
+
+    def update(self, bids, asks, dt) -> None:
+        """Обновление стакана из QUIK
+
+        :param list bids: Уровни покупки из QUIK в порядке возрастания цены
+        :param list asks: Уровни продажи из QUIK в порядке возрастания цены
+        :param datetime dt: Дата и время изменения стакана МСК
+        """
+        with self.lock:
+            self.bid_count = self.fill_levels(self.bid_prices, self.bid_sizes, reversed(bids) if bids else ())  # Лучшая цена покупки в QUIK последняя
+            self.ask_count = self.fill_levels(self.ask_prices, self.ask_sizes, asks if asks else ())  # Лучшая цена продажи в QUIK первая
+            self.dt = dt  # Запоминаем дату и время изменения
+            self.version += 1  # Новое изменение стакана
+
+    def fill_levels(self, prices, sizes, levels) -> int:
+        """Заполнение массивов цен/количеств уровнями стакана. Возвращает кол-во заполненных уровней"""
+        count = 0  # Кол-во заполненных уровней
+        for level in levels:  # Пробегаемся по уровням стакана от лучшей цены
+            if count == self.depth:  # Если массивы заполнены
+                break  # то остальные уровни не нужны
+            prices[count] = float(level['price'])  # Цены и количества QUIK приходят строками
+            sizes[count] = float(level['quantity'])
+            count += 1
+        return count
+
+    def get_metrics(self, levels=5):
+        """Лучшие цены покупки/продажи, средневзвешенная по глубине цена и дисбаланс стакана
+
+        :param int levels: Кол-во лучших уровней для расчета
+        :return: Версия, дата и время, лучшая цена покупки, лучшая цена продажи, средневзвешенная цена, дисбаланс
+        """
+        with self.lock:
+            bid_levels = min(levels, self.bid_count)  # Кол-во уровней покупки для расчета
+            ask_levels = min(levels, self.ask_count)  # Кол-во уровней продажи для расчета
+            bid_size = sum(self.bid_sizes[:bid_levels])  # Объем покупки на лучших уровнях
+            ask_size = sum(self.ask_sizes[:ask_levels])  # Объем продажи на лучших уровнях
+            best_bid = self.bid_prices[0] if self.bid_count else nan  # Лучшая цена покупки
+            best_ask = self.ask_prices[0] if self.ask_count else nan  # Лучшая цена продажи
+            if bid_size and ask_size:  # Если есть объем с обеих сторон стакана
+                bid_vwap = sum(p * s for p, s in zip(self.bid_prices[:bid_levels], self.bid_sizes[:bid_levels])) / bid_size  # Средневзвешенная цена покупки
+                ask_vwap = sum(p * s for p, s in zip(self.ask_prices[:ask_levels], self.ask_sizes[:ask_levels])) / ask_size  # Средневзвешенная цена продажи
+                mid = (bid_vwap * ask_size + ask_vwap * bid_size) / (bid_size + ask_size)  # Цена смещается к стороне с меньшим объемом
+                imbalance = (bid_size - ask_size) / (bid_size + ask_size)  # От -1 (только продавцы) до 1 (только покупатели)
+            else:  # Если одна из сторон стакана пустая
+                mid = imbalance = nan  # то посчитать не можем
+            return self.version, self.dt, best_bid, best_ask, mid, imbalance
+
+
+class MetaQKDepthData(AbstractDataBase.__class__):
+    # noinspection PyMethodParameters
+    def __init__(cls, name, bases, dct):
+        super(MetaQKDepthData, cls).__init__(name, bases, dct)  # Инициализируем класс данных стакана
+        QKStore.DepthDataCls = cls  # Регистрируем класс данных стакана в хранилище QUIK
+
+
+class QKDepthData(with_metaclass(MetaQKDepthData, AbstractDataBase)):
+    """Стакан QUIK. Каждое изменение стакана приходит в ТС как бар с лучшими ценами, средневзвешенной ценой и дисбалансом"""
+    lines = ('bid', 'ask', 'mid', 'imbalance')  # Лучшая цена покупки, лучшая цена продажи, средневзвешенная по глубине цена, дисбаланс
+    params = (
+        ('depth', 20),  # Кол-во уровней стакана с каждой стороны в массивах
+        ('levels', 5),  # Кол-во лучших уровней для расчета средневзвешенной цены и дисбаланса
+        ('throttle_sec', 0),  # Минимальный интервал в секундах между отправками стакана в ТС. Между ними остается только последнее состояние стакана
+    )
+    sleep_time_sec = 0.000_001  # Время ожидания в секундах, если стакан не изменился. Для снижения нагрузки/энергопотребления процессора
+
+    def islive(self):
+        """Стакан есть только в режиме реального времени"""
+        return True
+
+    def __init__(self, **kwargs):
+        self.store = QKStore(**kwargs)  # Хранилище QUIK
+        self.class_code, self.sec_code = self.store.dataname_to_class_sec_codes(self.p.dataname)  # По тикеру получаем код режима торгов и тикер
+        self.derivative = self.class_code == 'SPBFUT'  # Для деривативов не используем конвертацию цен и кол-ва
+        self.logger = logging.getLogger(f'QKDepthData.{self.class_code}.{self.sec_code}')  # Будем вести лог
+        self.guid = (self.class_code, self.sec_code)  # Идентификатор подписки на стакан
+        self.order_book = None  # Стакан тикера
+        self.version = 0  # Номер последнего отправленного в ТС изменения стакана
+        self.last_sent = 0.0  # Время последней отправки стакана в ТС
+        self.live_mode = False  # Стакан отправлен в ТС хотя бы 1 раз
+
+    def setenvironment(self, env):
+        """Добавление хранилища QUIK в cerebro"""
+        super(QKDepthData, self).setenvironment(env)
+        env.addstore(self.store)  # Добавление хранилища QUIK в cerebro
+
+    def start(self):
+        super(QKDepthData, self).start()
+        self.logger.debug('Запуск подписки на стакан')
+        self.order_book = self.store.subscribe_order_book(self.guid, QKOrderBook(self.p.depth))  # Стакан тикера. Если его еще нет, то создаем и подписываемся. Уровней в нем не меньше depth
+        quote = self.store.provider.get_quote_level2(self.class_code, self.sec_code)['data']  # Текущий стакан
+        self.order_book.update(quote.get('bid'), quote.get('offer'), datetime.now(self.store.tz_msk).replace(tzinfo=None))  # Начальное состояние стакана
+        self.put_notification(self.CONNECTED)  # Отправляем уведомление о подключении
+
+    def _load(self):
+        """Загрузка последнего состояния стакана"""
+        if self.order_book.version == self.version or \
+                self.p.throttle_sec and monotonic() - self.last_sent < self.p.throttle_sec:  # Если стакан не изменился, или еще рано отправлять его в ТС
+            sleep(self.sleep_time_sec)  # Ждем для снижения нагрузки/энергопотребления процессора
+            return None  # Стакана нет, будем заходить еще
+        self.version, dt, bid, ask, mid, imbalance = self.order_book.get_metrics(self.p.levels)  # Все изменения стакана до этого момента объединяются в последнее
+        if isnan(bid) or isnan(ask):  # Если одна из сторон стакана пустая
+            return None  # то пропускаем изменение, будем заходить еще
+        self.last_sent = monotonic()  # Запоминаем время отправки стакана в ТС
+        if not self.live_mode:  # Если стакан отправляется в первый раз
+            self.put_notification(self.LIVE)  # Отправляем уведомление о получении новых данных
+            self.live_mode = True
+        if not self.derivative:  # Для деривативов цена без изменения. Для остальных цена в рублях за штуку
+            bid = self.store.provider.quik_price_to_price(self.class_code, self.sec_code, bid)
+            ask = self.store.provider.quik_price_to_price(self.class_code, self.sec_code, ask)
+            if not isnan(mid):  # Если средневзвешенная цена рассчитана
+                mid = self.store.provider.quik_price_to_price(self.class_code, self.sec_code, mid)
+        self.lines.datetime[0] = date2num(dt)  # Переводим в формат хранения даты/времени в BackTrader
+        self.lines.open[0] = self.lines.high[0] = self.lines.low[0] = self.lines.close[0] = (bid + ask) / 2  # Середина спреда
+        self.lines.volume[0] = 0  # Объема у стакана нет
+        self.lines.openinterest[0] = 0  # Открытый интерес в QUIK не учитывается
+        self.lines.bid[0] = bid  # Лучшая цена покупки
+        self.lines.ask[0] = ask  # Лучшая цена продажи
+        self.lines.mid[0] = mid  # Средневзвешенная по глубине цена
+        self.lines.imbalance[0] = imbalance  # Дисбаланс стакана
+        return True  # Будем заходить сюда еще
+
+    def stop(self):
+        super(QKDepthData, self).stop()
+        self.logger.info(f'Отмена подписки {self.guid} на стакан')
+        self.store.unsubscribe_order_book(self.guid)  # Отменяем подписку. В QUIK подписка останется, если стакан тикера получают другие данные
+        self.put_notification(self.DISCONNECTED)  # Отправляем уведомление об окончании получения стакана
+        self.store.DepthDataCls = None  # Удаляем класс данных стакана в хранилище
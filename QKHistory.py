@@ -0,0 +1,266 @@
+import logging  # Будем вести лог
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+import os.path
+import sys
+import csv
+if sys.platform == 'win32':  # Блокировка файла индекса в Windows
+    import msvcrt
+else:  # Блокировка файла индекса в Linux/macOS
+    import fcntl
+
+
+class QKHistory:
+    """История тикера/временнОго интервала в одном файле или в файлах-разделах по датам с индексом диапазонов времени"""
+    partition_formats = {'year': '%Y', 'month': '%Y-%m', 'day': '%Y-%m-%d'}  # Форматы ключей разделов для имен файлов
+    index_file = 'index.txt'  # Имя файла индекса разделов
+    lock_file = 'index.lock'  # Имя файла блокировки индекса разделов между экземплярами истории и процессами
+    header = ('datetime', 'open', 'high', 'low', 'close', 'volume')  # Заголовок файла истории
+
+    def __init__(self, datapath, file, partition=None, delimiter='\t', dt_format='%d.%m.%Y %H:%M'):
+        """Инициализация истории
+
+        :param str datapath: Путь сохранения файлов истории
+        :param str file: Имя файла истории без расширения. Например, TQBR.SBER_M1
+        :param str partition: Разделы по датам: None - один файл, 'year' - по годам, 'month' - по месяцам, 'day' - по дням
+        :param str delimiter: Разделитель значений в файле истории
+        :param str dt_format: Формат представления даты и времени в файле истории
+        """
+        if partition is not None and partition not in self.partition_formats:  # Если задан неизвестный раздел
+            raise ValueError(f'Раздел истории {partition} не поддерживается. Допустимые значения: None, {", ".join(self.partition_formats)}')
+        self.file = file  # Имя файла истории без расширения
+        self.partition = partition  # Разделы по датам
+        self.delimiter = delimiter  # Разделитель значений в файле истории
+        self.dt_format = dt_format  # Формат представления даты и времени в файле истории
+        self.logger = logging.getLogger(f'QKHistory.{file}')  # Будем вести лог
+        self.file_name = f'{datapath}{file}.txt'  # Полное имя файла истории без разделов
+        self.partition_path = os.path.join(f'{datapath}{file}', '')  # Папка файлов-разделов истории
+        self.index = {}  # Индекс разделов. Ключ раздела: first, last - даты и время открытия первого/последнего бара, rows - кол-во бар, sorted - бары упорядочены по времени без дублей
+        self.lock = None  # Открытый файл блокировки индекса. Задается в lock_index()
+        self.lock_depth = 0  # Кол-во вложенных блокировок индекса
+        if self.partition:  # Если история в разделах
+            self.load_index()  # то получаем индекс разделов
+
+    def get_bars(self, dt_from=None, dt_to=None) -> list:
+        """Бары истории в диапазоне дат. Открываются только файлы-разделы, пересекающиеся с диапазоном
+
+        :param datetime dt_from: Дата и время открытия первого бара. None - с начала истории
+        :param datetime dt_to: Дата и время открытия последнего бара. None - до конца истории
+        :return: Бары, упорядоченные по времени
+        """
+        if not self.partition:  # Если история в одном файле
+            return self.read_file(self.file_name, dt_from, dt_to)  # то получаем бары из него
+        bars = []  # Бары из разделов
+        need_sort = os.path.isfile(self.file_name)  # Бары из файла без разделов нужно будет упорядочить вместе с барами из разделов
+        if need_sort:  # Если остался файл без разделов
+            self.logger.warning(f'Найден файл истории без разделов {self.file_name}. Для перевода истории в разделы вызовите compact()')
+            bars.extend(self.read_file(self.file_name, dt_from, dt_to))  # то получаем бары и из него
+        for key in self.get_partition_keys(dt_from, dt_to):  # Пробегаемся по всем разделам, пересекающимся с диапазоном, в порядке времени
+            bars.extend(self.read_file(self.get_partition_file_name(key), dt_from, dt_to))  # Получаем бары из раздела
+            entry = self.index.get(key)  # Раздел в индексе
+            need_sort |= entry is None or not entry['sorted']  # В разделе бары могли быть добавлены не по порядку или с дублями
+        if need_sort:  # Если бары нужно упорядочить
+            bars = sorted({bar['datetime']: bar for bar in bars}.values(), key=lambda bar: bar['datetime'])  # то убираем дубли (остается последний) и упорядочиваем по времени
+        return bars
+
+    def append(self, bars) -> None:
+        """Добавление бар в конец файла/файлов-разделов истории"""
+        if len(bars) == 0:  # Если бар нет
+            return  # то выходим, дальше не продолжаем
+        if not self.partition:  # Если история в одном файле
+            self.append_to_file(self.file_name, bars)  # то добавляем бары в него
+            return  # Индекса нет, дальше не продолжаем
+        partitions = defaultdict(list)  # Бары по разделам
+        for bar in bars:  # Пробегаемся по всем барам
+            partitions[self.get_partition_key(bar['datetime'])].append(bar)  # Раскладываем бары по разделам
+        with self.lock_index():  # Файлы-разделы и индекс могут менять другие экземпляры истории и процессы
+            self.load_index()  # Индекс мог измениться после загрузки. Изменяем последний сохраненный индекс
+            for key, partition_bars in partitions.items():  # Пробегаемся по всем разделам
+                self.append_to_file(self.get_partition_file_name(key), partition_bars)  # Добавляем бары в конец файла раздела
+                entry = self.index.get(key)  # Раздел в индексе
+                is_sorted = all(partition_bars[i]['datetime'] < partition_bars[i + 1]['datetime'] for i in range(len(partition_bars) - 1))  # Добавляемые бары упорядочены без дублей
+                if entry is None:  # Если раздела не было
+                    self.index[key] = dict(first=partition_bars[0]['datetime'], last=partition_bars[-1]['datetime'], rows=len(partition_bars), sorted=is_sorted)
+                else:  # Если раздел был
+                    entry['sorted'] = entry['sorted'] and is_sorted and partition_bars[0]['datetime'] > entry['last']  # Бары добавлены после последнего бара раздела
+                    entry['first'] = min(entry['first'], min(bar['datetime'] for bar in partition_bars))
+                    entry['last'] = max(entry['last'], max(bar['datetime'] for bar in partition_bars))
+                    entry['rows'] += len(partition_bars)
+            self.save_index()  # Сохраняем индекс разделов
+
+    def compact(self) -> int:
+        """Сжатие истории: удаление дублей, упорядочивание по времени, объединение файлов и перевод в текущие разделы.
+        Выполняется отдельно от работы ТС. Бар, записанный позже, заменяет ранее записанный бар с тем же временем
+
+        :return: Кол-во бар в истории после сжатия
+        """
+        sources = [self.file_name] if os.path.isfile(self.file_name) else []  # Файл истории без разделов
+        if os.path.isdir(self.partition_path):  # Если есть папка разделов
+            sources += [os.path.join(self.partition_path, name) for name in sorted(os.listdir(self.partition_path)) if name.endswith('.txt') and name != self.index_file]  # то добавляем все файлы-разделы
+        partitions = defaultdict(dict)  # Бары по разделам без дублей
+        for source in sources:  # Пробегаемся по всем файлам истории
+            self.logger.debug(f'Сжатие файла {source}')
+            for bar in self.read_file(source):  # Пробегаемся по всем барам файла
+                partitions[self.get_partition_key(bar['datetime'])][bar['datetime']] = bar  # Бар с тем же временем заменяем
+        self.index = {}  # Индекс будет построен заново
+        file_names = set()  # Файлы истории после сжатия
+        for key, partition_bars in partitions.items():  # Пробегаемся по всем разделам
+            bars = sorted(partition_bars.values(), key=lambda bar: bar['datetime'])  # Упорядочиваем бары по времени
+            file_name = self.get_partition_file_name(key)  # Файл раздела
+            self.write_file(file_name, bars)  # Перезаписываем файл раздела
+            file_names.add(file_name)
+            self.index[key] = dict(first=bars[0]['datetime'], last=bars[-1]['datetime'], rows=len(bars), sorted=True)
+        for source in sources:  # Пробегаемся по всем файлам истории до сжатия
+            if source not in file_names:  # Если файл не нужен после сжатия (был объединен с другими)
+                self.logger.debug(f'Удаление файла {source}')
+                os.remove(source)  # то удаляем его
+        if self.partition:  # Если история в разделах
+            with self.lock_index():  # Индекс заменяется целиком
+                self.save_index()  # Сохраняем индекс разделов
+        elif os.path.isfile(f'{self.partition_path}{self.index_file}'):  # Если история переведена из разделов в один файл
+            os.remove(f'{self.partition_path}{self.index_file}')  # то индекс разделов больше не нужен
+        rows = sum(entry['rows'] for entry in self.index.values())  # Кол-во бар после сжатия
+        self.logger.info(f'История сжата. Файлов до сжатия: {len(sources)}, после сжатия: {len(file_names)}. Бар: {rows}')
+        return rows
+
+    # Индекс разделов
+
+    def get_partition_keys(self, dt_from=None, dt_to=None) -> list:
+        """Ключи разделов, пересекающихся с диапазоном дат, в порядке времени.
+        Файлы-разделы, которых нет в индексе (записаны другим экземпляром истории или процессом), тоже возвращаются
+        """
+        keys = self.get_partition_file_keys()  # Ключи файлов-разделов
+        if not keys <= self.index.keys():  # Если есть файлы-разделы не из индекса
+            self.load_index()  # то индекс мог быть изменен другим экземпляром истории или процессом
+        partition_keys = []  # Ключи разделов, пересекающихся с диапазоном
+        for key in sorted(keys | self.index.keys()):  # Пробегаемся по всем разделам в порядке времени
+            entry = self.index.get(key)  # Раздел в индексе. Для файла-раздела не из индекса диапазон неизвестен
+            if entry and (dt_from and entry['last'] < dt_from or dt_to and entry['first'] > dt_to):  # Если раздел не пересекается с диапазоном
+                continue  # то файл раздела не открываем
+            partition_keys.append(key)
+        return partition_keys
+
+    def get_partition_file_keys(self) -> set:
+        """Ключи всех файлов-разделов в папке разделов"""
+        if not os.path.isdir(self.partition_path):  # Если папки разделов нет
+            return set()  # то разделов нет
+        prefix = f'{self.file}.'  # Начало имени файла-раздела
+        return {name[len(prefix):-4] for name in os.listdir(self.partition_path) if name.startswith(prefix) and name.endswith('.txt')}
+
+    @contextmanager
+    def lock_index(self):
+        """Блокировка индекса разделов между экземплярами истории и процессами. Блокировки экземпляра могут быть вложенными"""
+        if self.lock_depth == 0:  # Если индекс еще не заблокирован этим экземпляром
+            os.makedirs(self.partition_path, exist_ok=True)  # Создаем папку разделов, если ее нет
+            self.lock = open(f'{self.partition_path}{self.lock_file}', 'a')  # Открываем файл блокировки
+            if sys.platform == 'win32':  # В Windows
+                self.lock.seek(0)  # блокируем первый байт файла
+                while True:  # LK_LOCK ждет только 10 секунд
+                    try:
+                        msvcrt.locking(self.lock.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:  # Если блокировка не получена за 10 секунд
+                        self.logger.warning(f'Ожидание блокировки индекса разделов {self.partition_path}')
+            else:  # В Linux/macOS
+                fcntl.flock(self.lock.fileno(), fcntl.LOCK_EX)  # ждем блокировки всего файла
+        self.lock_depth += 1
+        try:
+            yield
+        finally:
+            self.lock_depth -= 1
+            if self.lock_depth == 0:  # Если вышли из последней блокировки
+                if sys.platform == 'win32':  # В Windows
+                    self.lock.seek(0)
+                    msvcrt.locking(self.lock.fileno(), msvcrt.LK_UNLCK, 1)  # снимаем блокировку первого байта. В Linux/macOS блокировка снимается при закрытии файла
+                self.lock.close()  # Закрываем файл блокировки
+                self.lock = None
+
+    def load_index(self) -> None:
+        """Получение индекса разделов из файла. Если файла индекса нет, то индекс строится по файлам-разделам"""
+        index_file_name = f'{self.partition_path}{self.index_file}'  # Полное имя файла индекса
+        if not os.path.isfile(index_file_name):  # Если файла индекса нет
+            self.rebuild_index()  # то строим индекс по файлам-разделам
+            return
+        with open(index_file_name) as file:  # Открываем файл индекса на последовательное чтение
+            reader = csv.reader(file, delimiter=self.delimiter)
+            next(reader, None)  # Пропускаем первую строку с заголовками
+            self.index = {row[0]: dict(first=datetime.strptime(row[1], self.dt_format), last=datetime.strptime(row[2], self.dt_format), rows=int(row[3]), sorted=row[4] == '1') for row in reader}
+
+    def save_index(self) -> None:
+        """Сохранение индекса разделов в файл. Индекс изменяется и сохраняется под блокировкой lock_index() после загрузки последнего сохраненного индекса"""
+        index_file_name = f'{self.partition_path}{self.index_file}'  # Полное имя файла индекса
+        with open(f'{index_file_name}.tmp', 'w', newline='') as file:  # Пишем во временный файл, чтобы индекс не был поврежден при сбое
+            writer = csv.writer(file, delimiter=self.delimiter)
+            writer.writerow(('partition', 'first', 'last', 'rows', 'sorted'))  # Записываем заголовок в файл
+            for key in sorted(self.index):  # Пробегаемся по всем разделам в порядке времени
+                entry = self.index[key]
+                writer.writerow((key, entry['first'].strftime(self.dt_format), entry['last'].strftime(self.dt_format), entry['rows'], int(entry['sorted'])))
+        os.replace(f'{index_file_name}.tmp', index_file_name)  # Заменяем файл индекса
+
+    def rebuild_index(self) -> None:
+        """Построение индекса разделов по файлам-разделам"""
+        keys = self.get_partition_file_keys()  # Ключи файлов-разделов
+        if not keys:  # Если файлов-разделов нет
+            self.index = {}  # то и разделов нет
+            return  # выходим, дальше не продолжаем
+        with self.lock_index():  # Пока строим индекс, файлы-разделы не должны меняться
+            self.index = {}  # Индекс строим заново
+            for key in self.get_partition_file_keys():  # Пробегаемся по всем файлам-разделам
+                bars = self.read_file(self.get_partition_file_name(key))  # Бары раздела
+                if len(bars) == 0:  # Если в разделе нет бар
+                    continue  # то в индекс его не добавляем
+                dts = [bar['datetime'] for bar in bars]  # Даты и время открытия бар
+                self.index[key] = dict(first=min(dts), last=max(dts), rows=len(dts), sorted=all(dts[i] < dts[i + 1] for i in range(len(dts) - 1)))
+            self.logger.debug(f'Индекс разделов построен. Разделов: {len(self.index)}')
+            self.save_index()  # Сохраняем индекс разделов
+
+    # Файлы
+
+    def get_partition_key(self, dt) -> str:
+        """Ключ раздела по дате и времени открытия бара. Для истории без разделов пустая строка"""
+        return dt.strftime(self.partition_formats[self.partition]) if self.partition else ''
+
+    def get_partition_file_name(self, key) -> str:
+        """Полное имя файла раздела по ключу раздела. Для истории без разделов имя файла истории"""
+        return f'{self.partition_path}{self.file}.{key}.txt' if key else self.file_name
+
+    def read_file(self, file_name, dt_from=None, dt_to=None) -> list:
+        """Получение бар из файла в диапазоне дат"""
+        if not os.path.isfile(file_name):  # Если файл не существует
+            return []  # то бар нет
+        bars = []  # Бары из файла
+        with open(file_name) as file:  # Открываем файл на последовательное чтение
+            reader = csv.reader(file, delimiter=self.delimiter)  # Данные в строке разделены табуляцией
+            next(reader, None)  # Пропускаем первую строку с заголовками
+            for csv_row in reader:  # Последовательно получаем все строки файла
+                dt = datetime.strptime(csv_row[0], self.dt_format)  # Дата и время открытия бара
+                if dt_from and dt < dt_from or dt_to and dt > dt_to:  # Если бар за границами диапазона
+                    continue  # то пропускаем его
+                bars.append(dict(datetime=dt, open=float(csv_row[1]), high=float(csv_row[2]), low=float(csv_row[3]), close=float(csv_row[4]), volume=int(csv_row[5])))  # Бар из файла
+        return bars
+
+    def append_to_file(self, file_name, bars) -> None:
+        """Добавление бар в конец файла. Если файла нет, то он будет создан"""
+        if not os.path.isfile(file_name):  # Существует ли файл
+            self.logger.warning(f'Файл {file_name} не найден и будет создан')
+            os.makedirs(os.path.dirname(file_name), exist_ok=True)  # Создаем папку файла, если ее нет
+            with open(file_name, 'w', newline='') as file:  # Создаем файл
+                writer = csv.writer(file, delimiter=self.delimiter)  # Данные в строке разделены табуляцией
+                writer.writerow(self.header)  # Записываем заголовок в файл
+        with open(file_name, 'a', newline='') as file:  # Открываем файл на добавление в конец. Ставим newline, чтобы в Windows не создавались пустые строки в файле
+            writer = csv.writer(file, delimiter=self.delimiter)  # Данные в строке разделены табуляцией
+            writer.writerows(self.bar_to_row(bar) for bar in bars)  # Записываем бары в конец файла
+
+    def write_file(self, file_name, bars) -> None:
+        """Перезапись файла барами"""
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)  # Создаем папку файла, если ее нет
+        with open(f'{file_name}.tmp', 'w', newline='') as file:  # Пишем во временный файл, чтобы история не была повреждена при сбое
+            writer = csv.writer(file, delimiter=self.delimiter)  # Данные в строке разделены табуляцией
+            writer.writerow(self.header)  # Записываем заголовок в файл
+            writer.writerows(self.bar_to_row(bar) for bar in bars)  # Записываем бары
+        os.replace(f'{file_name}.tmp', file_name)  # Заменяем файл
+
+    def bar_to_row(self, bar) -> tuple:
+        """Строка файла истории из бара"""
+        return bar['datetime'].strftime(self.dt_format), bar['open'], bar['high'], bar['low'], bar['close'], bar['volume']
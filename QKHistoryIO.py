@@ -0,0 +1,420 @@
+import logging  # Будем вести лог
+from concurrent.futures import ThreadPoolExecutor  # Выгрузка/загрузка истории многих тикеров одновременно
+from datetime import datetime
+import os.path
+import warnings
+
+from BackTraderQuik import QKHistory, QKData
+
+
+def import_numpy():
+    """Библиотека NumPy. Подключаем только тогда, когда она нужна"""
+    try:
+        import numpy
+    except ImportError as ex:  # Если библиотека не установлена
+        raise ImportError('Для пакетной выгрузки/загрузки истории установите библиотеку NumPy: pip install numpy') from ex
+    return numpy
+
+
+def import_pyarrow():
+    """Библиотека Apache Arrow для файлов Parquet/Arrow. Подключаем только тогда, когда она нужна"""
+    try:
+        import pyarrow
+        import pyarrow.feather
+        import pyarrow.parquet
+    except ImportError as ex:  # Если библиотека не установлена
+        raise ImportError('Для выгрузки/загрузки истории в файлы Parquet/Arrow установите библиотеку Apache Arrow: pip install pyarrow') from ex
+    return pyarrow
+
+
+class QKHistoryIO:
+    """Пакетная выгрузка/загрузка истории тикера/временнОго интервала в колоночные массивы NumPy и файлы Parquet/Arrow/npz
+    Файлы истории разбираются и записываются целиком массивами, без объектов Python на каждый бар
+    Массивы: datetime - дата и время открытия бара (datetime64[s]), open, high, low, close - цены (float64), volume - объем (int64)
+    """
+    columns = QKHistory.header  # Названия массивов совпадают с заголовком файла истории
+    formats = {'.parquet': 'parquet', '.arrow': 'arrow', '.feather': 'arrow', '.npz': 'npz'}  # Формат по расширению файла
+    dt_widths = {'%Y': 4, '%m': 2, '%d': 2, '%H': 2, '%M': 2, '%S': 2}  # Ширина полей формата даты и времени. Другие поля не поддерживаются
+    partition_units = {'year': 'Y', 'month': 'M', 'day': 'D'}  # Единицы datetime64 по разделам. Строки дат NumPy совпадают с ключами разделов QKHistory
+
+    def __init__(self, history):
+        """Инициализация выгрузки/загрузки истории
+
+        :param QKHistory history: История в файле/файлах-разделах
+        """
+        self.history = history  # История в файле/файлах-разделах
+        self.logger = logging.getLogger(f'QKHistoryIO.{history.file}')  # Будем вести лог
+        self.np = import_numpy()  # Без NumPy выгрузка/загрузка невозможна. Ошибку получаем сразу
+        self.dt_layout = self.get_dt_layout(history.dt_format)  # Поля формата даты и времени
+        self.dt_width = sum(len(item) if offset is None else self.dt_widths[item] for item, offset in self.dt_layout)  # Ширина даты и времени в файле истории
+
+    @classmethod
+    def open(cls, file, datapath=None, partition=None):
+        """Выгрузка/загрузка истории из папки с файлами истории данных QKData
+
+        :param str file: Имя файла истории без расширения. Например, TQBR.SBER_M1
+        :param str datapath: Путь файлов истории. Если не задан, то путь данных QKData
+        :param str partition: Разделы по датам для новой истории. Для существующей истории в разделах берутся ее разделы
+        """
+        datapath = datapath or QKData.datapath  # Путь файлов истории
+        return cls(QKHistory(datapath, file, cls.get_partition(datapath, file) or partition, QKData.delimiter, QKData.dt_format))
+
+    @classmethod
+    def get_partition(cls, datapath, file):
+        """Разделы существующей истории по длине ключей в индексе разделов. None, если история не в разделах"""
+        index_file_name = os.path.join(f'{datapath}{file}', QKHistory.index_file)  # Файл индекса разделов
+        if not os.path.isfile(index_file_name):  # Если индекса разделов нет
+            return None  # то история не в разделах
+        with open(index_file_name) as file:  # Открываем файл индекса на последовательное чтение
+            next(file, None)  # Пропускаем первую строку с заголовками
+            row = next(file, '')  # Первый раздел
+        key_len = len(row.split(QKData.delimiter, 1)[0].strip())  # Длина ключа раздела
+        return next((partition for partition, fmt in QKHistory.partition_formats.items() if len(datetime(2000, 1, 1).strftime(fmt)) == key_len), None)
+
+    # Массивы
+
+    def read_arrays(self, dt_from=None, dt_to=None) -> dict:
+        """Массивы истории в диапазоне дат. Бары упорядочены по времени без дублей
+
+        :param datetime dt_from: Дата и время открытия первого бара. None - с начала истории
+        :param datetime dt_to: Дата и время открытия последнего бара. None - до конца истории
+        """
+        np = self.np
+        history = self.history  # История в файле/файлах-разделах
+        file_names = [history.file_name] if not history.partition or os.path.isfile(history.file_name) else []  # Файл истории без разделов
+        if history.partition:  # Если история в разделах
+            file_names += [history.get_partition_file_name(key) for key in history.get_partition_keys(dt_from, dt_to)]  # то добавляем файлы-разделы, пересекающиеся с диапазоном
+        arrays = self.concat([self.read_file(file_name) for file_name in file_names])  # Массивы из всех файлов
+        dts = arrays['datetime']  # Даты и время открытия бар
+        if np.any(dts[1:] <= dts[:-1]):  # Если бары не упорядочены или есть дубли
+            arrays = self.sort_unique(arrays)  # то убираем дубли (остается последний) и упорядочиваем по времени
+            dts = arrays['datetime']
+        if dt_from or dt_to:  # Если задан диапазон
+            mask = np.ones(len(dts), dtype=bool)  # Бары в диапазоне
+            if dt_from:
+                mask &= dts >= np.datetime64(dt_from, 's')
+            if dt_to:
+                mask &= dts <= np.datetime64(dt_to, 's')
+            arrays = self.select(arrays, mask)
+        return arrays
+
+    def write_arrays(self, arrays) -> int:
+        """Загрузка массивов в историю. Бары с ошибками пропускаются, бары, которые уже есть в истории, не загружаются
+
+        :param dict arrays: Массивы по названию: datetime, open, high, low, close, volume
+        :return: Кол-во новых бар в истории
+        """
+        np = self.np
+        history = self.history  # История в файле/файлах-разделах
+        arrays = self.sort_unique(self.validate(arrays))  # Проверенные бары, упорядоченные по времени без дублей
+        if not history.partition:  # Если история в одном файле
+            return self.merge_file(history.file_name, arrays, np.empty(0, dtype='datetime64[s]'))[0]  # то загружаем бары в него
+        unsorted = self.read_file(history.file_name)['datetime']  # Даты и время бар из оставшегося файла без разделов. Эти бары тоже считаются существующими
+        keys = np.datetime_as_string(arrays['datetime'], unit=self.partition_units[history.partition])  # Ключи разделов бар
+        rows = 0  # Кол-во новых бар
+        with history.lock_index():  # Файлы-разделы и индекс могут менять другие экземпляры истории и процессы
+            history.load_index()  # Изменяем последний сохраненный индекс
+            for key in np.unique(keys).tolist():  # Пробегаемся по всем разделам загружаемых бар
+                added, merged = self.merge_file(history.get_partition_file_name(key), self.select(arrays, keys == key), unsorted)  # Загружаем бары в раздел
+                if not added:  # Если новых бар в разделе нет
+                    continue  # то индекс не меняется
+                rows += added
+                dts = merged['datetime']  # Даты и время открытия бар раздела
+                history.index[key] = dict(first=dts[0].item(), last=dts[-1].item(), rows=len(dts), sorted=True)  # Раздел упорядочен без дублей
+            if rows:  # Если были новые бары
+                history.save_index()  # то сохраняем индекс разделов
+        return rows
+
+    def merge_file(self, file_name, arrays, unsorted) -> tuple:
+        """Загрузка бар в файл истории. Новые бары после последнего бара добавляются в конец файла, иначе файл перезаписывается
+
+        :return: Кол-во новых бар, бары файла после загрузки
+        """
+        np = self.np
+        existing = self.read_file(file_name)  # Бары файла
+        new = self.select(arrays, ~np.isin(arrays['datetime'], np.concatenate((existing['datetime'], unsorted))))  # Бары, которых нет в истории
+        added = len(new['datetime'])  # Кол-во новых бар
+        if not added:  # Если новых бар нет
+            return 0, existing  # то файл не меняем
+        dts = existing['datetime']  # Даты и время открытия бар файла
+        if len(dts) == 0 or new['datetime'][0] > dts.max() and not np.any(dts[1:] <= dts[:-1]):  # Если файл упорядочен, и новые бары после последнего бара
+            self.append_file(file_name, new)  # то добавляем новые бары в конец файла
+            return added, self.concat((existing, new))
+        merged = self.sort_unique(self.concat((existing, new)))  # Иначе упорядочиваем все бары файла
+        self.write_file(file_name, merged)  # и перезаписываем файл
+        return added, merged
+
+    def validate(self, arrays) -> dict:
+        """Проверка массивов. Бары без даты, с пустыми ценами, high/low, не охватывающими open/close, и отрицательным объемом удаляются"""
+        np = self.np
+        missing = [column for column in self.columns if column not in arrays]  # Отсутствующие массивы
+        if missing:  # Если массивов не хватает
+            raise ValueError(f'Нет массивов истории: {", ".join(missing)}')
+        lengths = {len(arrays[column]) for column in self.columns}  # Длины массивов
+        if len(lengths) > 1:  # Если длины разные
+            raise ValueError(f'Массивы истории разной длины: {sorted(lengths)}')
+        dts = np.asarray(arrays['datetime'])  # Даты и время открытия бар
+        if not np.issubdtype(dts.dtype, np.datetime64):  # Если это не даты
+            raise ValueError(f'Массив datetime должен быть типа datetime64, а не {dts.dtype}')
+        arrays = dict(datetime=dts.astype('datetime64[s]'),  # Даты и время открытия бар до секунд
+                      **{column: np.asarray(arrays[column], dtype=np.float64) for column in ('open', 'high', 'low', 'close')},  # Цены
+                      volume=np.asarray(arrays['volume']))  # Объем
+        o, h, l, c, v = arrays['open'], arrays['high'], arrays['low'], arrays['close'], arrays['volume']
+        valid = ~np.isnat(arrays['datetime']) & np.isfinite(o) & np.isfinite(h) & np.isfinite(l) & np.isfinite(c)  # Заданы дата и цены
+        valid &= (h >= np.maximum(o, c)) & (l <= np.minimum(o, c))  # Максимум и минимум охватывают цены открытия и закрытия
+        if np.issubdtype(v.dtype, np.floating):  # Если объем дробный (например, из Parquet с пропусками)
+            valid &= np.isfinite(v) & (v == np.round(v))  # то он должен быть целым
+        valid &= v >= 0  # Объем не отрицательный
+        invalid = len(valid) - int(valid.sum())  # Кол-во бар с ошибками
+        if invalid:  # Если есть бары с ошибками
+            self.logger.warning(f'Пропущено бар с ошибками: {invalid} из {len(valid)}')
+        arrays = self.select(arrays, valid)  # Оставляем бары без ошибок
+        arrays['volume'] = arrays['volume'].astype(np.int64)  # Объем в лотах целый
+        return arrays
+
+    def concat(self, parts) -> dict:
+        """Объединение массивов"""
+        np = self.np
+        parts = list(parts)
+        if not parts:  # Если массивов нет
+            return self.empty()
+        return {column: np.concatenate([part[column] for part in parts]) for column in self.columns}
+
+    def empty(self) -> dict:
+        """Пустые массивы"""
+        np = self.np
+        return dict(datetime=np.empty(0, dtype='datetime64[s]'), **{column: np.empty(0) for column in ('open', 'high', 'low', 'close')}, volume=np.empty(0, dtype=np.int64))
+
+    @staticmethod
+    def select(arrays, index) -> dict:
+        """Выборка бар из массивов по маске или номерам"""
+        return {column: values[index] for column, values in arrays.items()}
+
+    def sort_unique(self, arrays) -> dict:
+        """Упорядочивание бар по времени. Из бар с одинаковым временем остается записанный последним"""
+        np = self.np
+        order = np.argsort(arrays['datetime'], kind='stable')  # Номера бар в порядке времени. Бары с одинаковым временем остаются в порядке записи
+        dts = arrays['datetime'][order]
+        keep = np.ones(len(dts), dtype=bool)  # Бары, которые остаются
+        keep[:-1] = dts[1:] != dts[:-1]  # Из бар с одинаковым временем остается последний
+        return self.select(arrays, order[keep])
+
+    # Файлы истории
+
+    def read_file(self, file_name) -> dict:
+        """Массивы из файла истории. Файл разбирается целиком"""
+        np = self.np
+        if not os.path.isfile(file_name):  # Если файл не существует
+            return self.empty()  # то бар нет
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)  # В файле может быть только заголовок
+            rows = np.loadtxt(file_name, dtype=str, delimiter=self.history.delimiter, skiprows=1, ndmin=2, encoding=None)  # Все строки файла без заголовка
+        if rows.shape[0] == 0:  # Если бар нет
+            return self.empty()
+        if rows.shape[1] != len(self.columns):  # Если кол-во значений в строке не совпадает с заголовком
+            raise ValueError(f'В файле истории {file_name} {rows.shape[1]} значений в строке вместо {len(self.columns)}')
+        return dict(datetime=self.parse_datetimes(rows[:, 0], file_name),  # Дата и время открытия бара
+                    **{column: rows[:, i + 1].astype(np.float64) for i, column in enumerate(('open', 'high', 'low', 'close'))},  # Цены
+                    volume=rows[:, 5].astype(np.int64))  # Объем
+
+    def append_file(self, file_name, arrays) -> None:
+        """Добавление бар в конец файла истории. Если файла нет, то он будет создан"""
+        if not os.path.isfile(file_name):  # Если файла нет
+            os.makedirs(os.path.dirname(file_name), exist_ok=True)  # то создаем папку файла, если ее нет
+            with open(file_name, 'wb') as file:  # Создаем файл
+                file.write(self.get_header())  # Записываем заголовок в файл
+        with open(file_name, 'ab') as file:  # Открываем файл на добавление в конец
+            file.write(self.to_bytes(arrays))  # Записываем бары за один раз
+
+    def write_file(self, file_name, arrays) -> None:
+        """Перезапись файла истории барами"""
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)  # Создаем папку файла, если ее нет
+        with open(f'{file_name}.tmp', 'wb') as file:  # Пишем во временный файл, чтобы история не была повреждена при сбое
+            file.write(self.get_header())  # Записываем заголовок в файл
+            file.write(self.to_bytes(arrays))  # Записываем бары за один раз
+        os.replace(f'{file_name}.tmp', file_name)  # Заменяем файл
+
+    def get_header(self) -> bytes:
+        """Заголовок файла истории. Строки заканчиваются так же, как у csv.writer в QKHistory"""
+        return (self.history.delimiter.join(self.columns) + '\r\n').encode()
+
+    def to_bytes(self, arrays) -> bytes:
+        """Строки файла истории из массивов"""
+        np = self.np
+        count = len(arrays['datetime'])  # Кол-во бар
+        if not count:  # Если бар нет
+            return b''
+        delimiter = self.history.delimiter.encode()  # Разделитель значений
+        lines = self.format_datetimes(arrays['datetime']).view(f'S{self.dt_width}').reshape(count)  # Дата и время открытия бара
+        for column in self.columns[1:]:  # Пробегаемся по всем значениям бара
+            lines = np.char.add(np.char.add(lines, delimiter), arrays[column].astype('S'))  # Значения как у csv.writer: цены repr(float), объем int
+        lines = np.char.add(lines, b'\r\n')  # Конец строки
+        chars = lines.view(np.uint8).reshape(count, lines.dtype.itemsize)  # Строки фиксированной ширины
+        return chars[np.arange(lines.dtype.itemsize) < np.char.str_len(lines)[:, None]].tobytes()  # Убираем заполнение строк до фиксированной ширины
+
+    # Дата и время
+
+    def get_dt_layout(self, dt_format) -> list:
+        """Поля формата даты и времени: поле и его начало в строке, или постоянный текст и None"""
+        layout = []  # Поля формата
+        offset = i = 0  # Начало поля в строке и в формате
+        while i < len(dt_format):  # Пока не разобрали весь формат
+            if dt_format[i] == '%':  # Если это поле
+                field = dt_format[i:i + 2]
+                if field not in self.dt_widths:  # Если поле не фиксированной ширины
+                    raise ValueError(f'Поле {field} формата даты и времени {dt_format} не поддерживается. Поддерживаются: {", ".join(self.dt_widths)}')
+                layout.append((field, offset))
+                offset += self.dt_widths[field]
+                i += 2
+            else:  # Если это постоянный текст
+                layout.append((dt_format[i], None))
+                offset += 1
+                i += 1
+        if not {'%Y', '%m', '%d'} <= {field for field, offset in layout}:  # Если в формате нет даты
+            raise ValueError(f'В формате даты и времени {dt_format} должны быть поля %Y, %m, %d')
+        return layout
+
+    def parse_datetimes(self, values, file_name) -> object:
+        """Разбор строк даты и времени массивом"""
+        np = self.np
+        width = self.dt_width  # Ширина даты и времени
+        valid = np.char.str_len(values) == width  # Строки нужной ширины
+        chars = values.astype(f'S{width}').view(np.uint8).reshape(len(values), width)  # Символы строк
+        fields = {'%H': 0, '%M': 0, '%S': 0}  # Значения полей. Время по умолчанию 00:00:00
+        position = 0  # Позиция в строке
+        for item, offset in self.dt_layout:  # Пробегаемся по всем полям формата
+            if offset is None:  # Если это постоянный текст
+                valid &= chars[:, position] == ord(item)
+                position += 1
+                continue
+            digits = chars[:, offset:offset + self.dt_widths[item]].astype(np.int64) - ord('0')  # Цифры поля
+            valid &= ((digits >= 0) & (digits <= 9)).all(axis=1)
+            fields[item] = digits @ (10 ** np.arange(digits.shape[1] - 1, -1, -1))  # Значение поля
+            position = offset + self.dt_widths[item]
+        year, month, day, hour, minute, second = (fields[field] for field in ('%Y', '%m', '%d', '%H', '%M', '%S'))
+        valid &= (month >= 1) & (month <= 12) & (day >= 1) & (hour < 24) & (minute < 60) & (second < 60)
+        months = ((year - 1970) * 12 + month - 1).astype('datetime64[M]')  # Месяц
+        days = months.astype('datetime64[D]') + (day - 1).astype('timedelta64[D]')  # День
+        valid &= days.astype('datetime64[M]') == months  # День есть в месяце
+        if not valid.all():  # Если есть ошибки
+            row = int(np.argmin(valid))  # Первая строка с ошибкой
+            raise ValueError(f'Файл истории {file_name}, строка {row + 2}: дата и время {values[row]} не в формате {self.history.dt_format}')
+        return days.astype('datetime64[s]') + (hour * 3600 + minute * 60 + second).astype('timedelta64[s]')
+
+    def format_datetimes(self, dts) -> object:
+        """Символы строк даты и времени из массива"""
+        np = self.np
+        days = dts.astype('datetime64[D]')  # День
+        months = dts.astype('datetime64[M]')  # Месяц
+        seconds = (dts - days).astype(np.int64)  # Секунды с начала дня
+        fields = {'%Y': months.astype(np.int64) // 12 + 1970, '%m': months.astype(np.int64) % 12 + 1, '%d': (days - months.astype('datetime64[D]')).astype(np.int64) + 1,
+                  '%H': seconds // 3600, '%M': seconds // 60 % 60, '%S': seconds % 60}  # Значения полей
+        chars = np.empty((len(dts), self.dt_width), dtype=np.uint8)  # Символы строк
+        position = 0  # Позиция в строке
+        for item, offset in self.dt_layout:  # Пробегаемся по всем полям формата
+            if offset is None:  # Если это постоянный текст
+                chars[:, position] = ord(item)
+                position += 1
+                continue
+            width = self.dt_widths[item]  # Ширина поля
+            for i in range(width):  # Пробегаемся по всем цифрам поля
+                chars[:, offset + i] = fields[item] // 10 ** (width - 1 - i) % 10 + ord('0')
+            position = offset + width
+        return chars
+
+    # Выгрузка/загрузка
+
+    def get_format(self, file_name) -> str:
+        """Формат файла по расширению"""
+        fmt = self.formats.get(os.path.splitext(file_name)[1].lower())  # Формат файла
+        if fmt is None:  # Если расширение не поддерживается
+            raise ValueError(f'Формат файла {file_name} не поддерживается. Поддерживаются: {", ".join(self.formats)}')
+        return fmt
+
+    def export(self, file_name, dt_from=None, dt_to=None) -> int:
+        """Выгрузка истории в файл Parquet (.parquet), Arrow (.arrow, .feather) или NumPy (.npz)
+
+        :param str file_name: Имя файла. Формат определяется по расширению
+        :param datetime dt_from: Дата и время открытия первого бара. None - с начала истории
+        :param datetime dt_to: Дата и время открытия последнего бара. None - до конца истории
+        :return: Кол-во выгруженных бар
+        """
+        fmt = self.get_format(file_name)  # Формат файла
+        arrays = self.read_arrays(dt_from, dt_to)  # Массивы истории
+        if fmt == 'npz':  # Для файла NumPy
+            self.np.savez_compressed(file_name, **arrays)  # массивы сжимаем
+        else:  # Для файлов Parquet/Arrow
+            pyarrow = import_pyarrow()
+            table = pyarrow.table(arrays)  # Таблица Arrow из массивов без копирования
+            if fmt == 'parquet':
+                pyarrow.parquet.write_table(table, file_name, compression='zstd')
+            else:
+                pyarrow.feather.write_feather(table, file_name, compression='zstd')
+        rows = len(arrays['datetime'])  # Кол-во выгруженных бар
+        self.logger.debug(f'Выгружено бар в {file_name}: {rows}')
+        return rows
+
+    def import_file(self, file_name) -> int:
+        """Загрузка истории из файла Parquet (.parquet), Arrow (.arrow, .feather) или NumPy (.npz)
+
+        :param str file_name: Имя файла. Формат определяется по расширению
+        :return: Кол-во новых бар в истории
+        """
+        fmt = self.get_format(file_name)  # Формат файла
+        if fmt == 'npz':  # Для файла NumPy
+            with self.np.load(file_name) as npz:
+                arrays = {column: npz[column] for column in npz.files}
+        else:  # Для файлов Parquet/Arrow
+            pyarrow = import_pyarrow()
+            table = pyarrow.parquet.read_table(file_name) if fmt == 'parquet' else pyarrow.feather.read_table(file_name)
+            arrays = {column: table.column(column).to_numpy() for column in table.column_names}  # Массивы из таблицы Arrow
+        rows = self.write_arrays(arrays)  # Кол-во новых бар
+        self.logger.info(f'Загружено новых бар из {file_name}: {rows}')
+        return rows
+
+    @classmethod
+    def get_files(cls, datapath) -> list:
+        """Имена файлов истории без расширения в папке: файлы без разделов и папки разделов"""
+        names = set()  # Имена файлов истории
+        for name in os.listdir(datapath):  # Пробегаемся по всем файлам и папкам
+            if name.endswith('.txt') and os.path.isfile(os.path.join(datapath, name)):  # Файл истории без разделов
+                names.add(name[:-4])
+            elif os.path.isfile(os.path.join(datapath, name, QKHistory.index_file)):  # Папка разделов
+                names.add(name)
+        return sorted(names)
+
+    @classmethod
+    def export_all(cls, path, fmt='parquet', datapath=None, max_workers=4) -> dict:
+        """Выгрузка истории всех тикеров/временнЫх интервалов в папку. Каждая история в свой файл
+
+        :param str path: Папка выгрузки
+        :param str fmt: Формат файлов: parquet, arrow, npz
+        :param str datapath: Путь файлов истории. Если не задан, то путь данных QKData
+        :param int max_workers: Кол-во историй, выгружаемых одновременно
+        :return: Кол-во выгруженных бар по имени файла истории
+        """
+        datapath = datapath or QKData.datapath  # Путь файлов истории
+        files = cls.get_files(datapath)  # Имена файлов истории
+        os.makedirs(path, exist_ok=True)  # Создаем папку выгрузки, если ее нет
+        with ThreadPoolExecutor(max_workers, thread_name_prefix='QKHistoryIO') as executor:  # Разбор и сжатие файлов идут в NumPy/Arrow без блокировки остальных потоков
+            rows = executor.map(lambda file: cls.open(file, datapath).export(os.path.join(path, f'{file}.{fmt}')), files)
+            return dict(zip(files, rows))
+
+    @classmethod
+    def import_all(cls, path, datapath=None, partition=None, max_workers=4) -> dict:
+        """Загрузка истории всех файлов Parquet/Arrow/npz из папки. Имя файла без расширения - имя файла истории
+
+        :param str path: Папка с файлами
+        :param str datapath: Путь файлов истории. Если не задан, то путь данных QKData
+        :param str partition: Разделы по датам для новой истории. Для существующей истории в разделах берутся ее разделы
+        :param int max_workers: Кол-во историй, загружаемых одновременно
+        :return: Кол-во новых бар по имени файла истории
+        """
+        datapath = datapath or QKData.datapath  # Путь файлов истории
+        names = sorted(name for name in os.listdir(path) if os.path.splitext(name)[1].lower() in cls.formats)  # Файлы для загрузки
+        files = [os.path.splitext(name)[0] for name in names]  # Имена файлов истории
+        if len(set(files)) != len(files):  # Если история задана несколькими файлами
+            raise ValueError(f'В папке {path} несколько файлов для одной истории')
+        with ThreadPoolExecutor(max_workers, thread_name_prefix='QKHistoryIO') as executor:
+            rows = executor.map(lambda item: cls.open(item[0], datapath, partition).import_file(os.path.join(path, item[1])), zip(files, names))
+            return dict(zip(files, rows))
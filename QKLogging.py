@@ -0,0 +1,78 @@
+import json  # Структурированный лог событий в формате JSON lines
+import logging  # Будем вести лог
+from logging.handlers import QueueHandler, QueueListener  # Запись лога в фоновом потоке
+from queue import SimpleQueue
+
+
+event_logger = logging.getLogger('QKEvents')  # Структурированный лог событий QUIK. Записи с событием в атрибуте event
+event_logger.propagate = False  # События не попадают в обычный лог
+event_logger.setLevel(logging.WARNING)  # По умолчанию выключен. События пишутся с уровнем INFO. Включается в QKLogging
+
+
+class QKJsonFormatter(logging.Formatter):
+    """Запись лога одной строкой JSON: время, название лога, сообщение и событие QUIK"""
+    def format(self, record):
+        entry = dict(t=record.created, name=record.name, msg=record.getMessage())  # Время в секундах с 01.01.1970, название лога, сообщение
+        event = getattr(record, 'event', None)  # Событие QUIK
+        if event is not None:  # Если событие задано
+            entry['event'] = event  # то записываем его целиком
+        return json.dumps(entry, ensure_ascii=False, separators=(',', ':'), default=str)  # Компактная запись. Даты и прочие значения без JSON представления переводим в строки
+
+
+class QKLogging:
+    """Асинхронный лог. Записи из потоков QUIK и BackTrader ставятся в очередь, а в файлы/консоль их пишет фоновый поток
+    Сообщения в библиотеке форматируются только тогда, когда уровень лога их пропускает
+    """
+    def __init__(self, handlers, level=logging.INFO, event_file=None):
+        """Инициализация асинхронного лога
+
+        :param list handlers: Обработчики лога: файлы, консоль и т.д. Будут вызываться из фонового потока
+        :param int level: Уровень логируемых событий. При уровне выше DEBUG отладочные сообщения не форматируются
+        :param str event_file: Файл структурированного лога событий QUIK (ответы на транзакции, сделки) в формате JSON lines. Если не задан, то события не пишутся
+        """
+        self.handlers = handlers  # Обработчики лога
+        self.level = level  # Уровень логируемых событий
+        self.event_file = event_file  # Файл лога событий QUIK
+        self.listeners = []  # Фоновые потоки записи лога
+        self.root_handlers = []  # Обработчики корневого лога до запуска. Восстанавливаются при остановке
+        self.root_level = logging.WARNING  # Уровень корневого лога до запуска
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self) -> None:
+        """Запуск асинхронного лога"""
+        root = logging.getLogger()  # Корневой лог. Все логи библиотеки передают в него записи
+        self.root_handlers, self.root_level = root.handlers[:], root.level  # Запоминаем обработчики и уровень корневого лога
+        root.handlers = [self.start_listener(self.handlers)]  # Записи ставятся в очередь
+        root.setLevel(self.level)
+        if self.event_file:  # Если нужен лог событий QUIK
+            event_handler = logging.FileHandler(self.event_file, encoding='utf-8')  # то пишем его в файл
+            event_handler.setFormatter(QKJsonFormatter())  # одной строкой JSON на событие
+            event_logger.handlers = [self.start_listener([event_handler])]  # Свой фоновый поток записи
+            event_logger.setLevel(logging.INFO)  # Включаем лог событий
+
+    def start_listener(self, handlers) -> QueueHandler:
+        """Запуск фонового потока записи лога. Возвращает обработчик, ставящий записи в очередь"""
+        queue = SimpleQueue()  # Очередь записей лога
+        listener = QueueListener(queue, *handlers, respect_handler_level=True)  # Фоновый поток записи лога. Каждый обработчик получает только записи своего уровня
+        listener.start()
+        self.listeners.append(listener)
+        return QueueHandler(queue)
+
+    def stop(self) -> None:
+        """Остановка асинхронного лога. Все записи из очереди будут записаны"""
+        root = logging.getLogger()  # Корневой лог
+        root.handlers = self.root_handlers  # Восстанавливаем обработчики корневого лога
+        root.setLevel(self.root_level)  # и его уровень. setLevel сбрасывает кэш уровней логов, иначе отладочные записи останутся включенными
+        event_logger.handlers = []  # Выключаем лог событий
+        event_logger.setLevel(logging.WARNING)
+        for listener in self.listeners:  # Пробегаемся по всем фоновым потокам записи лога
+            listener.stop()  # Дожидаемся записи очереди и останавливаем поток
+            for handler in listener.handlers:  # Пробегаемся по всем обработчикам
+                handler.close()  # Закрываем файлы
+        self.listeners = []
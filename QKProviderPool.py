@@ -0,0 +1,204 @@
+import logging  # Будем вести лог
+from threading import Thread, RLock, Event
+from time import monotonic  # Время следующей попытки создать подключение
+
+
+class QKProviderPool:
+    """Пул подключений к QUIK. Запросы распределяются по каналам в зависимости от нагрузки:
+    orders - транзакции (быстрый канал), history - загрузка истории, reference - справочные запросы и опрос лимитов, default - все остальное
+    В каждом канале одно или несколько подключений к одному или нескольким терминалам. Используется первое исправное подключение канала
+    Если исправных подключений в канале нет, то запросы канала выполняются через канал default
+    Транзакция уходит в первое исправное подключение канала orders. Если при отправке возникла ошибка подключения, то транзакция не повторяется
+    через другое подключение (она могла дойти до QUIK), ошибку получает вызывающий. Подключение считается неисправным, следующие транзакции идут через следующее исправное подключение
+    """
+    logger = logging.getLogger('QKProviderPool')  # Будем вести лог
+    routes = {  # Канал по запросу к QUIK. Запросы, которых здесь нет, выполняются через канал default
+        'send_transaction': 'orders', 'get_order_by_number': 'orders',  # Транзакции и проверка заявки
+        'get_candles_from_data_source': 'history',  # История
+        'get_money_limits': 'reference', 'get_futures_limit': 'reference', 'get_all_depo_limits': 'reference', 'get_futures_holdings': 'reference',  # Лимиты и позиции
+        'get_param_ex': 'reference', 'get_info_param': 'reference', 'get_symbol_info': 'reference',  # Параметры тикеров и терминала
+        'get_all_orders': 'reference', 'get_all_stop_orders': 'reference',  # Таблицы заявок для сверки
+    }
+    events = {'on_trans_reply': 'orders', 'on_trade': 'orders', 'on_order': 'orders', 'on_stop_order': 'orders'}  # Канал по событию QUIK. Остальные события приходят из канала default
+    no_retry = ('send_transaction',)  # Запросы, которые при ошибке нельзя повторять через другое подключение. Иначе заявка может быть выставлена дважды
+    connection_errors = (OSError, EOFError)  # Ошибки подключения. При них подключение считается неисправным
+    health_check_sec = 5  # Интервал в секундах между проверками подключений
+    retry_sec = 1  # Интервал в секундах до повторной попытки создать подключение. Удваивается после каждой неудачной попытки
+    retry_max_sec = 60  # Максимальный интервал в секундах между попытками создать подключение
+    subscriptions = {  # Событие и функция отмены по функции подписки. Подписки повторяются на подключении, куда переходит обработчик события
+        'subscribe_to_candles': ('on_new_candle', 'unsubscribe_from_candles'),  # Бары
+        'subscribe_level2_quotes': ('on_quote', 'unsubscribe_level2_quotes'),  # Стакан
+    }
+    unsubscriptions = {unsubscribe: subscribe for subscribe, (_, unsubscribe) in subscriptions.items()}  # Функция подписки по функции отмены
+
+    def __init__(self, providers):
+        """Инициализация пула подключений
+
+        :param dict providers: Подключения по каналу. Канал default обязателен. Подключение задается провайдером или функцией его создания. Функция будет вызвана при первом обращении к каналу
+        """
+        if 'default' not in providers:  # Если не задан канал по умолчанию
+            raise ValueError('В пуле подключений к QUIK должен быть задан канал default')
+        self.channels = {channel: list(items) for channel, items in providers.items()}  # Подключения или функции их создания по каналу. В порядке приоритета
+        self.healthy = {}  # Исправность по id подключения
+        self.handlers = {}  # Обработчики событий QUIK, заданные в хранилище и брокере
+        self.event_providers = {}  # Подключение, на котором стоит обработчик, по событию
+        self.methods = {}  # Функции запросов к QUIK по названию
+        self.active = {}  # Подключение по действующей подписке (функция подписки, аргументы, именованные аргументы)
+        self.retries = {}  # Время следующей попытки и интервал по каналу и номеру подключения, которое не удалось создать
+        self.lock = RLock()  # Блокировка создания подключений и переключения обработчиков событий
+        self.stop_event = Event()  # Остановка проверки подключений
+        self.health_thread = None  # Поток проверки подключений
+
+    # Подключения
+
+    def get_channel_providers(self, channel) -> list:
+        """Подключения канала. Подключения, заданные функциями, создаются при первом обращении"""
+        items = self.channels.get(channel, [])  # Подключения или функции их создания
+        created = False  # Создано новое подключение
+        with self.lock:
+            for i, item in enumerate(items):  # Пробегаемся по всем подключениям канала
+                if callable(item):  # Если подключение еще не создано
+                    retry = self.retries.get((channel, i))  # Время следующей попытки и интервал, если подключение уже не удалось создать
+                    if retry and monotonic() < retry[0]:  # Если время следующей попытки еще не наступило
+                        continue  # то подключение не создаем
+                    try:
+                        items[i] = item()  # то создаем его
+                        self.healthy[id(items[i])] = True
+                        self.retries.pop((channel, i), None)
+                        created = True
+                        self.logger.debug(f'Создано подключение {i} канала {channel}')
+                    except self.connection_errors as ex:  # Если подключиться не удалось
+                        delay = min(retry[1] * 2, self.retry_max_sec) if retry else self.retry_sec  # Интервал до следующей попытки
+                        self.retries[channel, i] = (monotonic() + delay, delay)
+                        self.logger.error(f'Не удалось создать подключение {i} канала {channel}: {ex!r}. Следующая попытка через {delay} с')
+                        continue  # то попробуем после интервала
+                self.healthy.setdefault(id(items[i]), True)  # Готовые подключения считаем исправными до первой проверки
+            if self.health_thread is None:  # Если проверка подключений еще не запущена
+                self.health_thread = Thread(target=self.check_health, daemon=True)  # то запускаем ее
+                self.health_thread.start()
+            if created:  # Если создано новое подключение
+                self.apply_handlers()  # то обработчики событий могут перейти на него
+        return [item for item in items if not callable(item)]
+
+    def get_providers(self, channel) -> list:
+        """Подключения для запроса в порядке приоритета: исправные подключения канала, затем исправные подключения канала default"""
+        providers = [provider for provider in self.get_channel_providers(channel) if self.healthy.get(id(provider))]  # Исправные подключения канала
+        if channel != 'default':  # Если канал не по умолчанию
+            providers += [provider for provider in self.get_channel_providers('default') if self.healthy.get(id(provider)) and provider not in providers]  # то резервом будут подключения канала по умолчанию
+        return providers or self.get_channel_providers('default')  # Если исправных подключений нет, то пробуем все подключения канала по умолчанию
+
+    def get_provider(self, channel):
+        """Подключение канала с наибольшим приоритетом"""
+        providers = self.get_providers(channel)  # Подключения в порядке приоритета
+        if not providers:  # Если ни одно подключение не создано
+            raise ConnectionError(f'Нет подключений к QUIK для канала {channel}')
+        return providers[0]
+
+    def set_healthy(self, provider, healthy, reason='') -> None:
+        """Изменение исправности подключения. Обработчики событий переносятся на исправные подключения"""
+        if self.healthy.get(id(provider)) == healthy:  # Если исправность не изменилась
+            return  # то выходим, дальше не продолжаем
+        self.healthy[id(provider)] = healthy
+        if healthy:
+            self.logger.info('Подключение к QUIK восстановлено')
+        else:
+            self.logger.warning(f'Подключение к QUIK неисправно: {reason}')
+        self.apply_handlers()  # Переносим обработчики событий
+
+    def check_health(self) -> None:
+        """Поток проверки подключений"""
+        while not self.stop_event.wait(self.health_check_sec):  # Пока пул не закрыт
+            for items in self.channels.values():  # Пробегаемся по всем каналам
+                for provider in [item for item in items if not callable(item)]:  # Пробегаемся по всем созданным подключениям канала
+                    try:
+                        healthy = provider.is_connected()['data'] == 1  # Терминал подключен к серверу QUIK
+                        reason = 'терминал не подключен к серверу QUIK'
+                    except Exception as ex:  # Если запрос не прошел
+                        healthy, reason = False, repr(ex)  # то подключение неисправно
+                    self.set_healthy(provider, healthy, reason)
+
+    # Запросы
+
+    def __getattr__(self, name):
+        """Запрос к QUIK через канал запроса или атрибут подключения по умолчанию"""
+        if name.startswith('__') or name in ('channels', 'methods', 'handlers', 'retries', 'active'):  # Служебные атрибуты
+            raise AttributeError(name)
+        if name in self.methods:  # Если функция запроса уже есть
+            return self.methods[name]
+        provider = self.get_provider('default')  # Подключение по умолчанию
+        value = getattr(provider, name)  # Атрибут подключения
+        if not callable(value) or name.startswith('on_') or name == 'default_handler':  # Если это не запрос (счета, валюта, обработчики)
+            return value  # то возвращаем его значение
+        channel = self.routes.get(name, 'default')  # Канал запроса
+
+        def call(*args, **kwargs):
+            for provider in self.get_providers(channel):  # Пробегаемся по подключениям в порядке приоритета
+                try:
+                    result = getattr(provider, name)(*args, **kwargs)  # Выполняем запрос
+                    self.track_subscription(name, args, kwargs, provider)  # Запоминаем подписку или ее отмену
+                    return result
+                except self.connection_errors as ex:  # Если подключение неисправно
+                    self.set_healthy(provider, False, repr(ex))
+                    if name in self.no_retry:  # Если запрос нельзя повторять
+                        raise  # то ошибку получит вызывающий
+            raise ConnectionError(f'Нет исправных подключений к QUIK для запроса {name} канала {channel}')
+
+        self.methods[name] = call  # Запоминаем функцию запроса
+        return call
+
+    def track_subscription(self, name, args, kwargs, provider) -> None:
+        """Учет действующих подписок, чтобы повторить их на подключении, куда перейдет обработчик события"""
+        if name in self.subscriptions:  # Если это подписка
+            with self.lock:
+                self.active[name, tuple(args), tuple(sorted(kwargs.items()))] = provider  # то запоминаем подключение подписки
+        elif name in self.unsubscriptions:  # Если это отмена подписки
+            with self.lock:
+                self.active.pop((self.unsubscriptions[name], tuple(args), tuple(sorted(kwargs.items()))), None)  # то подписку больше не повторяем
+
+    def resubscribe(self, event, provider) -> None:
+        """Повтор подписок события на подключении, куда перешел обработчик события. Вызывается под блокировкой"""
+        for key, old_provider in list(self.active.items()):  # Пробегаемся по всем действующим подпискам
+            subscribe, args, kwargs = key
+            if self.subscriptions[subscribe][0] != event or old_provider is provider:  # Если подписка другого события, или она уже на этом подключении
+                continue  # то переходим к следующей подписке
+            try:
+                getattr(provider, subscribe)(*args, **dict(kwargs))  # Подписываемся на новом подключении
+            except Exception as ex:  # Если подписаться не удалось, то подписка останется на старом подключении и будет повторена при следующем переходе обработчика
+                self.logger.error(f'Не удалось повторить подписку {subscribe}{args}: {ex!r}')
+                continue
+            self.active[key] = provider
+            self.logger.info(f'Подписка {subscribe}{args} перенесена на другое подключение')
+            try:
+                getattr(old_provider, self.subscriptions[subscribe][1])(*args, **dict(kwargs))  # Отменяем подписку на старом подключении, если оно отвечает
+            except Exception as ex:
+                self.logger.debug(f'Не удалось отменить подписку {subscribe}{args} на старом подключении: {ex!r}')
+
+    def __setattr__(self, name, value):
+        """Обработчики событий QUIK ставятся на подключение канала события"""
+        if not name.startswith('on_'):  # Если это не обработчик события
+            return super(QKProviderPool, self).__setattr__(name, value)  # то это атрибут пула
+        self.handlers[name] = value  # Запоминаем обработчик
+        self.event_providers.pop(name, None)  # Обработчик нужно поставить заново
+        self.apply_handlers()
+
+    def apply_handlers(self) -> None:
+        """Установка обработчиков событий на первое исправное подключение канала события"""
+        with self.lock:
+            for event, handler in list(self.handlers.items()):  # Пробегаемся по всем обработчикам
+                providers = self.get_providers(self.events.get(event, 'default'))  # Подключения канала события
+                old_provider = self.event_providers.get(event)  # Подключение, на котором стоит обработчик
+                if not providers or old_provider is providers[0]:  # Если подключений нет, или обработчик уже стоит на нужном подключении
+                    continue  # то переходим к следующему обработчику
+                if old_provider is not None:  # Если обработчик стоял на другом подключении
+                    setattr(old_provider, event, old_provider.default_handler)  # то снимаем его
+                setattr(providers[0], event, handler)  # Ставим обработчик на подключение канала
+                self.event_providers[event] = providers[0]
+                self.resubscribe(event, providers[0])  # Без подписок на новом подключении события не придут
+
+    def close_connection_and_thread(self) -> None:
+        """Закрытие всех подключений пула"""
+        self.stop_event.set()  # Останавливаем проверку подключений
+        for items in self.channels.values():  # Пробегаемся по всем каналам
+            for provider in [item for item in items if not callable(item)]:  # Пробегаемся по всем созданным подключениям канала
+                if self.healthy.pop(id(provider), None) is not None:  # Подключение может быть задано в нескольких каналах. Закрываем его 1 раз
+                    provider.close_connection_and_thread()
@@ -0,0 +1,161 @@
+import logging  # Будем вести лог
+from collections import defaultdict, deque
+from datetime import datetime, timedelta, timezone
+from threading import Lock  # Проверки идут из потока ТС, а сделки приходят из потока событий QUIK
+from time import monotonic
+
+
+class QKRisk:
+    """Предторговые проверки рисков брокера QUIK без запросов к QUIK
+    Позиции, стоимость позиций, зарезервированные незавершенными заявками средства и прибыль/убыток за день
+    ведутся на месте по сделкам (on_trade) и изменениям статусов заявок. Проверка заявки не зависит от кол-ва заявок и позиций
+    Лимиты, которые не заданы (None), не проверяются
+    """
+    logger = logging.getLogger('QKRisk')  # Будем вести лог
+    tz_msk = timezone(timedelta(hours=3), 'MSK')  # Время МСК для смены торгового дня
+
+    def __init__(self, max_position=None, max_notional=None, max_exposure=None, max_orders_per_sec=None, max_daily_loss=None):
+        """Инициализация проверок рисков
+
+        :param float max_position: Максимальный размер позиции по тикеру в штуках с учетом незавершенных заявок
+        :param float max_notional: Максимальная стоимость позиции по тикеру с учетом незавершенных заявок
+        :param float max_exposure: Максимальная стоимость всех позиций с учетом незавершенных заявок
+        :param int max_orders_per_sec: Максимальное кол-во новых заявок за последнюю секунду
+        :param float max_daily_loss: Максимальный убыток по закрытым позициям за день. После него принимаются только заявки, сокращающие позицию
+        """
+        self.max_position = max_position  # Максимальный размер позиции по тикеру
+        self.max_notional = max_notional  # Максимальная стоимость позиции по тикеру
+        self.max_exposure = max_exposure  # Максимальная стоимость всех позиций
+        self.max_orders_per_sec = max_orders_per_sec  # Максимальное кол-во новых заявок в секунду
+        self.max_daily_loss = max_daily_loss  # Максимальный убыток за день
+        self.sizes = {}  # Размер позиции в штуках по тикеру
+        self.prices = {}  # Цена последней сделки по тикеру
+        self.notionals = {}  # Стоимость позиции по тикеру
+        self.exposure = 0.0  # Стоимость всех позиций
+        self.reserved_orders = {}  # Незавершенные заявки: тикер, покупка, остаток к исполнению в штуках, цена по номеру заявки
+        self.reserved_sizes = defaultdict(float)  # Остаток к исполнению незавершенных заявок в штуках по тикеру и направлению (покупка/продажа)
+        self.reserved = 0.0  # Средства, зарезервированные незавершенными заявками
+        self.order_times = deque()  # Время новых заявок за последнюю секунду
+        self.pnl = 0.0  # Прибыль/убыток по закрытым позициям за день
+        self.pnl_date = None  # Дата прибыли/убытка
+        self.rejected = 0  # Кол-во заявок, отклоненных проверками
+        self.lock = Lock()  # Блокировка изменения состояния
+
+    def reset(self, positions) -> None:
+        """Начальные позиции из QUIK
+
+        :param dict positions: Позиции BackTrader по названию тикера
+        """
+        with self.lock:
+            for dataname, position in positions.items():  # Пробегаемся по всем позициям
+                self.set_position(dataname, position.size, position.price)
+
+    def set_position(self, dataname, size, price) -> None:
+        """Изменение позиции и стоимости позиции по тикеру. Стоимость всех позиций изменяется на разницу"""
+        self.sizes[dataname] = size  # Размер позиции
+        self.prices[dataname] = price  # Цена последней сделки
+        notional = abs(size) * price  # Новая стоимость позиции
+        self.exposure += notional - self.notionals.get(dataname, 0.0)  # Стоимость всех позиций меняется только на изменение стоимости позиции
+        self.notionals[dataname] = notional
+
+    def check(self, order, dataname, price=None):
+        """Проверка новой заявки. Если заявка проходит проверки, то под нее резервируются средства
+
+        :param Order order: Заявка
+        :param str dataname: Название тикера
+        :param float price: Цена заявки. Для рыночных заявок - последняя известная цена
+        :return: Причина отклонения заявки или None, если заявка прошла проверки
+        """
+        size = order.size  # Размер заявки в штуках. Для продажи отрицательный
+        is_buy = size > 0  # Заявка на покупку
+        price = price or self.prices.get(dataname) or None  # Цена заявки или цена последней сделки. None - цена неизвестна
+        with self.lock:
+            now = monotonic()  # Текущее время
+            if self.max_orders_per_sec is not None:  # Если проверяем кол-во заявок в секунду
+                while self.order_times and now - self.order_times[0] >= 1:  # Пока есть заявки старше секунды
+                    self.order_times.popleft()  # удаляем их
+                if len(self.order_times) >= self.max_orders_per_sec:  # Если заявок за последнюю секунду слишком много
+                    return self.reject(f'Превышено кол-во заявок в секунду {self.max_orders_per_sec}')
+            position = self.sizes.get(dataname, 0)  # Текущая позиция
+            new_position = position + self.reserved_sizes[dataname, is_buy] * (1 if is_buy else -1) + size  # Позиция при исполнении всех заявок в этом направлении
+            increases = abs(new_position) > abs(position)  # Заявка увеличивает позицию
+            if self.max_daily_loss is not None and increases:  # Если проверяем убыток за день, и заявка увеличивает позицию
+                self.check_pnl_date()  # то за новый день убыток считается с нуля
+                if -self.pnl >= self.max_daily_loss:  # Если убыток за день достиг лимита
+                    return self.reject(f'Убыток за день {-self.pnl:.2f} достиг лимита {self.max_daily_loss}')
+            if self.max_position is not None and increases and abs(new_position) > self.max_position:  # Если позиция превысит лимит
+                return self.reject(f'Позиция {dataname} {new_position} превысит лимит {self.max_position}')
+            if price is None and increases and (self.max_notional is not None or self.max_exposure is not None):  # Если цена неизвестна, а стоимость нужно проверить
+                return self.reject(f'Нет цены {dataname} для проверки стоимости позиции. Задайте цену заявки')  # то заявку по нулевой цене не пропускаем
+            price = price or 0.0  # Без проверок стоимости резерв заявки без цены не учитывается в стоимости
+            notional = abs(new_position) * price  # Стоимость позиции при исполнении заявок
+            if self.max_notional is not None and increases and notional > self.max_notional:  # Если стоимость позиции превысит лимит
+                return self.reject(f'Стоимость позиции {dataname} {notional:.2f} превысит лимит {self.max_notional}')
+            value = abs(size) * price  # Стоимость заявки
+            if self.max_exposure is not None and increases and self.exposure + self.reserved + value > self.max_exposure:  # Если стоимость всех позиций превысит лимит
+                return self.reject(f'Стоимость всех позиций {self.exposure + self.reserved + value:.2f} превысит лимит {self.max_exposure}')
+            self.order_times.append(now)  # Заявка прошла проверки
+            self.add_reserved(order.ref, dataname, is_buy, abs(size), price)  # Резервируем под нее средства
+        return None
+
+    def reserve(self, order, dataname, price=None) -> None:
+        """Резервирование средств под неисполненный остаток незавершенной заявки без проверок. Для заявок, восстановленных из снимка
+
+        :param Order order: Заявка
+        :param str dataname: Название тикера
+        :param float price: Цена заявки. Для рыночных заявок - последняя известная цена
+        """
+        with self.lock:
+            self.add_reserved(order.ref, dataname, order.isbuy(), abs(order.executed.remsize), price or self.prices.get(dataname, 0.0))
+
+    def add_reserved(self, ref, dataname, is_buy, size, price) -> None:
+        """Резерв средств под заявку"""
+        self.reserved_orders[ref] = [dataname, is_buy, size, price]  # Тикер, покупка, остаток к исполнению, цена
+        self.reserved_sizes[dataname, is_buy] += size
+        self.reserved += size * price
+
+    def reject(self, reason) -> str:
+        """Отклонение заявки проверками"""
+        self.rejected += 1
+        return reason
+
+    def check_pnl_date(self) -> None:
+        """Обнуление прибыли/убытка при смене дня"""
+        today = datetime.now(self.tz_msk).date()  # Текущая дата на бирже
+        if today != self.pnl_date:  # Если наступил новый день
+            self.pnl, self.pnl_date = 0.0, today  # то прибыль/убыток считаем с нуля
+
+    def on_trade(self, order, dataname, position_size, price, pnl) -> None:
+        """Сделка по заявке
+
+        :param Order order: Заявка
+        :param str dataname: Название тикера
+        :param float position_size: Размер позиции после сделки
+        :param float price: Цена сделки
+        :param float pnl: Прибыль/убыток по закрытой части позиции
+        """
+        with self.lock:
+            self.set_position(dataname, position_size, price)  # Меняем позицию
+            if pnl:  # Если позиция закрылась
+                self.check_pnl_date()  # то за новый день прибыль/убыток считается с нуля
+                self.pnl += pnl  # Прибыль/убыток за день
+            reserved_order = self.reserved_orders.get(order.ref)  # Средства, зарезервированные под заявку
+            if reserved_order is not None:  # Если средства резервировались
+                remsize = min(abs(order.executed.remsize), reserved_order[2])  # Остаток к исполнению
+                self.release(reserved_order, reserved_order[2] - remsize)  # Освобождаем исполненную часть
+
+    def on_order(self, order) -> None:
+        """Изменение статуса заявки. По завершенной заявке освобождаются все зарезервированные средства"""
+        if order.alive():  # Если заявка не завершена
+            return  # то резерв не меняется, выходим, дальше не продолжаем
+        with self.lock:
+            reserved_order = self.reserved_orders.pop(order.ref, None)  # Средства, зарезервированные под заявку
+            if reserved_order is not None:  # Если средства резервировались
+                self.release(reserved_order, reserved_order[2])  # то освобождаем их
+
+    def release(self, reserved_order, size) -> None:
+        """Освобождение средств, зарезервированных под заявку"""
+        dataname, is_buy, _, price = reserved_order  # Тикер, покупка, цена заявки
+        reserved_order[2] -= size  # Уменьшаем остаток к исполнению
+        self.reserved_sizes[dataname, is_buy] -= size
+        self.reserved -= size * price
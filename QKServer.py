@@ -0,0 +1,380 @@
+import logging  # Будем вести лог
+from collections import defaultdict
+from functools import lru_cache  # Кэш справочных запросов на стороне клиента
+from itertools import count  # Номера запросов и транзакций
+from multiprocessing import AuthenticationError  # Клиент с неверным ключом подключения
+from multiprocessing.connection import Listener, Client  # Локальное межпроцессное взаимодействие
+from queue import Queue  # Очередь отправки сообщений клиенту
+from threading import Thread, Lock, Event
+from time import monotonic, time
+import os.path
+import sys
+
+
+default_address = r'\\.\pipe\BackTraderQuik' if sys.platform == 'win32' else '/tmp/BackTraderQuik.sock'  # Именованный канал Windows / Unix сокет
+default_authkey = b'BackTraderQuik'  # Ключ подключения клиентов к процессу-хранилищу по локальному адресу
+authkey_env = 'QK_SERVER_AUTHKEY'  # Переменная окружения с ключом подключения
+
+
+def get_authkey(address, authkey=None) -> bytes:
+    """Ключ подключения к процессу-хранилищу. Задается параметром или переменной окружения QK_SERVER_AUTHKEY
+    Для локального адреса (Unix сокет, именованный канал Windows) без ключа используется default_authkey. Для адреса (хост, порт) ключ обязателен
+
+    :param address: Адрес процесса-хранилища. Путь Unix сокета, имя канала Windows или кортеж (хост, порт)
+    :param authkey: Ключ подключения. Если не задан, то берется из переменной окружения
+    :return: Ключ подключения
+    """
+    if authkey is None:  # Если ключ не задан
+        authkey = os.environ.get(authkey_env) or None  # то берем его из переменной окружения
+    if authkey is None:  # Если ключа нет и в переменной окружения
+        if not isinstance(address, str):  # Если адрес сетевой (хост, порт)
+            raise ValueError(f'Для сетевого адреса процесса-хранилища {address} нужно задать ключ подключения authkey или переменную окружения {authkey_env}')
+        authkey = default_authkey  # Для локального адреса используем ключ по умолчанию
+    return authkey if isinstance(authkey, bytes) else authkey.encode()
+
+
+class QKServer:
+    """Процесс-хранилище. Держит одно подключение к QUIK и раздает бары, стаканы, сделки и ответы на транзакции процессам BackTrader
+    Подписки и запросы истории от всех процессов объединяются. Номера транзакций процессов заменяются на уникальные
+    """
+    logger = logging.getLogger('QKServer')  # Будем вести лог
+    attributes = ('accounts', 'limit_kind', 'currency', 'tz_msk')  # Атрибуты провайдера, которые клиенты получают при подключении
+    events = ('on_connected', 'on_disconnected', 'on_new_candle', 'on_quote', 'on_trans_reply', 'on_trade', 'on_order', 'on_stop_order')  # События QUIK, которые раздаются клиентам
+    trans_events = ('on_trans_reply', 'on_trade', 'on_order', 'on_stop_order')  # События по транзакциям. Отправляются только процессу, выставившему заявку
+    history_cache_sec = 5  # Время в секундах, в течение которого одинаковые запросы истории получают один ответ
+    slow_methods = ('get_candles_from_data_source',)  # Долгие запросы. Выполняются в отдельном потоке, чтобы не задерживать остальные запросы клиента
+    done_ttl_sec = 600  # Время в секундах, в течение которого номер завершенной транзакции помнится для опоздавших и повторных сделок
+    max_trans_id = 2_147_483_647  # Наибольший номер транзакции QUIK
+
+    def __init__(self, provider=None, address=default_address, authkey=None, providers=None):
+        """Инициализация процесса-хранилища
+
+        :param provider: Провайдер QuikPy или его замена для проверки. Если не задан, то будет создан при запуске
+        :param address: Адрес для подключения клиентов. Путь Unix сокета, имя канала Windows или кортеж (хост, порт)
+        :param bytes authkey: Ключ подключения клиентов. Для адреса (хост, порт) обязателен. Можно задать переменной окружения QK_SERVER_AUTHKEY
+        :param dict providers: Подключения к QUIK по каналу для пула подключений QKProviderPool. Если заданы, то история не задерживает транзакции
+        """
+        self.provider = provider  # Подключение или пул подключений к QUIK
+        self.providers = providers  # Подключения к QUIK по каналу
+        self.address = address  # Адрес для подключения клиентов
+        self.authkey = get_authkey(address, authkey)  # Ключ подключения клиентов
+        self.clients = {}  # Очереди отправки сообщений клиентам по номеру клиента
+        self.client_ids = count(1)  # Номера клиентов
+        self.candle_subscriptions = defaultdict(set)  # Номера клиентов по подписке на бары (class_code, sec_code, interval)
+        self.quote_subscriptions = defaultdict(set)  # Номера клиентов по подписке на стакан (class_code, sec_code)
+        self.trans_ids = count(self.get_first_trans_id())  # Номера транзакций процесса-хранилища. Не повторяются после перезапуска
+        self.transactions = {}  # Номер клиента, номер транзакции клиента и признак новой заявки по номеру транзакции процесса-хранилища
+        self.done = {}  # Время завершения транзакции по номеру транзакции процесса-хранилища
+        self.history = {}  # Запросы истории: событие получения, время получения, результат, ошибка
+        self.lock = Lock()  # Блокировка подписок, транзакций и запросов истории
+        self.listener = None  # Прием подключений клиентов
+
+    def serve_forever(self) -> None:
+        """Запуск процесса-хранилища. Прием подключений клиентов до остановки"""
+        if self.provider is None and self.providers:  # Если провайдер не задан, но заданы подключения по каналам
+            from BackTraderQuik.QKProviderPool import QKProviderPool
+            self.provider = QKProviderPool(self.providers)  # то запросы распределяются по каналам
+        elif self.provider is None:  # Если провайдер не задан
+            from QuikPy import QuikPy  # Библиотеку подключаем только тогда, когда она нужна
+            self.provider = QuikPy()  # то подключаемся к QUIK
+        for event in self.events:  # Пробегаемся по всем событиям QUIK
+            setattr(self.provider, event, self.get_event_handler(event))  # Раздаем события клиентам
+        if isinstance(self.address, str) and not self.address.startswith('\\\\') and os.path.exists(self.address):  # Если остался Unix сокет от прошлого запуска
+            os.remove(self.address)  # то удаляем его
+        self.listener = Listener(self.address, authkey=self.authkey)  # Принимаем подключения клиентов
+        self.logger.info(f'Процесс-хранилище запущен по адресу {self.address}')
+        try:
+            while True:
+                try:
+                    conn = self.listener.accept()  # Ждем подключения клиента
+                except AuthenticationError as ex:  # Если клиент подключается с неверным ключом
+                    self.logger.warning(f'Клиент не подключен: {ex!r}')
+                    continue  # то ждем следующего клиента
+                Thread(target=self.serve_client, args=(conn,), daemon=True).start()  # Обслуживаем клиента в потоке
+        except OSError:  # Прием подключений остановлен
+            pass
+        finally:
+            self.provider.close_connection_and_thread()  # Закрываем подключение к QUIK
+            self.logger.info('Процесс-хранилище остановлен')
+
+    def stop(self) -> None:
+        """Остановка приема подключений клиентов"""
+        if self.listener:  # Если прием подключений запущен
+            self.listener.close()  # то останавливаем его
+
+    # Клиенты
+
+    def serve_client(self, conn) -> None:
+        """Обслуживание клиента: выполнение запросов и отправка ответов"""
+        client_id = next(self.client_ids)  # Номер клиента
+        queue = Queue()  # Очередь отправки сообщений клиенту. Медленный клиент не задерживает события QUIK для остальных
+        self.clients[client_id] = queue
+        Thread(target=self.send_to_client, args=(conn, queue), daemon=True).start()  # Отправляем сообщения клиенту в потоке
+        self.logger.info(f'Подключен клиент {client_id}')
+        try:
+            while True:
+                request = conn.recv()  # Ждем запрос клиента: номер запроса, функция, аргументы
+                if request[1] in self.slow_methods:  # Если запрос долгий
+                    Thread(target=self.execute_request, args=(queue, client_id, *request), daemon=True).start()  # то выполняем его в потоке. Транзакции клиента его не ждут
+                else:  # Остальные запросы выполняем по порядку
+                    self.execute_request(queue, client_id, *request)
+        except (EOFError, OSError):  # Клиент отключился
+            self.logger.info(f'Отключен клиент {client_id}')
+        finally:
+            self.remove_client(client_id)  # Отменяем подписки и транзакции клиента
+            queue.put(None)  # Останавливаем поток отправки сообщений
+
+    def execute_request(self, queue, client_id, request_id, method, args, kwargs) -> None:
+        """Выполнение запроса клиента и отправка ответа или ошибки"""
+        try:
+            queue.put((request_id, self.execute(client_id, method, args, kwargs), None))  # Выполняем запрос и отправляем ответ
+        except Exception as ex:  # Если при выполнении запроса возникла ошибка
+            self.logger.error(f'Клиент {client_id}. Ошибка запроса {method}: {ex!r}')
+            queue.put((request_id, None, repr(ex)))  # то отправляем ошибку
+
+    def send_to_client(self, conn, queue) -> None:
+        """Поток отправки сообщений клиенту"""
+        for message in iter(queue.get, None):  # Пока не пришел сигнал остановки
+            try:
+                conn.send(message)  # Отправляем ответ или событие
+            except (EOFError, OSError):  # Клиент отключился
+                break
+            except Exception as ex:  # Если сообщение нельзя передать (например, не сериализуется)
+                self.logger.error(f'Ошибка отправки сообщения клиенту: {ex!r}')
+                if message[0] is not None:  # Если это ответ на запрос
+                    conn.send((message[0], None, repr(ex)))  # то клиент получит ошибку вместо ответа
+        conn.close()
+
+    def remove_client(self, client_id) -> None:
+        """Отмена подписок и транзакций отключившегося клиента"""
+        self.clients.pop(client_id, None)
+        for guid, client_ids in list(self.candle_subscriptions.items()):  # Пробегаемся по всем подпискам на бары
+            if client_id in client_ids:  # Если клиент был подписан
+                self.execute(client_id, 'unsubscribe_from_candles', guid, {})  # то отменяем его подписку
+        for guid, client_ids in list(self.quote_subscriptions.items()):  # Пробегаемся по всем подпискам на стаканы
+            if client_id in client_ids:  # Если клиент был подписан
+                self.execute(client_id, 'unsubscribe_level2_quotes', guid, {})  # то отменяем его подписку
+        with self.lock:
+            self.transactions = {trans_id: client_trans for trans_id, client_trans in self.transactions.items() if client_trans[0] != client_id}
+            self.done = {trans_id: done for trans_id, done in self.done.items() if trans_id in self.transactions}
+
+    # Запросы
+
+    def execute(self, client_id, method, args, kwargs):
+        """Выполнение запроса клиента"""
+        if method == 'get_attributes':  # Атрибуты провайдера
+            return {name: getattr(self.provider, name) for name in self.attributes if hasattr(self.provider, name)}
+        if method in ('subscribe_to_candles', 'unsubscribe_from_candles', 'is_subscribed'):  # Подписка на бары
+            return self.subscription(self.candle_subscriptions, client_id, method, args, 'subscribe_to_candles', 'unsubscribe_from_candles')
+        if method in ('subscribe_level2_quotes', 'unsubscribe_level2_quotes', 'is_subscribed_level2_quotes'):  # Подписка на стакан
+            return self.subscription(self.quote_subscriptions, client_id, method, args, 'subscribe_level2_quotes', 'unsubscribe_level2_quotes')
+        if method == 'get_candles_from_data_source':  # История
+            return self.get_history(args, kwargs)
+        if method == 'send_transaction':  # Транзакция
+            transaction = dict(args[0])  # Копия транзакции, т.к. будем менять номер
+            if 'TRANS_ID' in transaction:  # Если задан номер транзакции
+                with self.lock:
+                    trans_id = next(self.trans_ids)  # Уникальный номер транзакции для всех клиентов
+                    self.transactions[trans_id] = (client_id, int(transaction['TRANS_ID']), transaction.get('ACTION') in ('NEW_ORDER', 'NEW_STOP_ORDER'))  # Запоминаем клиента и номер его транзакции
+                transaction['TRANS_ID'] = str(trans_id)
+            return self.call_provider('send_transaction', (transaction,), kwargs)
+        return self.call_provider(method, args, kwargs)  # Остальные запросы передаем в QUIK без изменений
+
+    def call_provider(self, method, args, kwargs):
+        """Запрос к QUIK. Общей блокировки нет: запросы разных клиентов выполняются одновременно, как запросы из разных потоков одного процесса
+        С пулом подключений история и транзакции идут по разным подключениям, и долгий запрос истории не задерживает заявки
+        """
+        return getattr(self.provider, method)(*args, **kwargs)
+
+    def subscription(self, subscriptions, client_id, method, args, subscribe, unsubscribe):
+        """Подписка/отмена подписки клиента. В QUIK подписка одна на всех клиентов"""
+        guid = tuple(args)  # Идентификатор подписки
+        with self.lock:
+            client_ids = subscriptions[guid]  # Клиенты подписки
+            if method == subscribe:  # Подписка
+                first = len(client_ids) == 0  # Первый клиент подписки
+                client_ids.add(client_id)
+            elif method == unsubscribe:  # Отмена подписки
+                client_ids.discard(client_id)
+                first = len(client_ids) == 0  # Последний клиент подписки
+                if first:  # Если клиентов подписки не осталось
+                    del subscriptions[guid]  # то подписку удаляем
+            else:  # Проверка подписки
+                return {'data': client_id in client_ids}
+        if first:  # Если подписка/отмена подписки нужна в QUIK
+            self.logger.debug(f'{method} {guid}')
+            return self.call_provider(method, args, {})
+        return {'data': True}
+
+    def get_history(self, args, kwargs):
+        """История. Одинаковые запросы от клиентов объединяются в один запрос к QUIK"""
+        key = (tuple(args), tuple(sorted(kwargs.items())))  # Запрос
+        with self.lock:
+            now = monotonic()
+            self.history = {k: entry for k, entry in self.history.items() if entry['time'] is None or now - entry['time'] < self.history_cache_sec}  # Удаляем устаревшие ответы
+            entry = self.history.get(key)  # Такой же запрос
+            owner = entry is None  # Запрос к QUIK будет выполнять этот клиент
+            if owner:  # Если такого запроса нет
+                entry = self.history[key] = dict(event=Event(), time=None, result=None, error=None)
+        if owner:  # Если запрос выполняет этот клиент
+            try:
+                entry['result'] = self.call_provider('get_candles_from_data_source', args, kwargs)
+            except Exception as ex:  # Ошибку получат все клиенты с таким же запросом
+                entry['error'] = ex
+            entry['time'] = monotonic()
+            entry['event'].set()  # Ответ получен
+        else:  # Если такой же запрос уже выполняется/выполнен
+            self.logger.debug(f'История {args} взята из запроса другого клиента')
+            entry['event'].wait()  # то ждем ответа на него
+        if entry['error']:
+            raise entry['error']
+        return entry['result']
+
+    # События
+
+    def get_event_handler(self, event):
+        """Обработчик события QUIK"""
+        return lambda data: self.on_event(event, data)
+
+    def on_event(self, event, data) -> None:
+        """Раздача события QUIK клиентам"""
+        if event == 'on_new_candle':  # Новый бар
+            bar = data['data']
+            client_ids = self.candle_subscriptions.get((bar['class'], bar['sec'], bar['interval']), ())  # Только подписанным клиентам
+        elif event == 'on_quote':  # Стакан
+            quote = data['data']
+            client_ids = self.quote_subscriptions.get((quote['class_code'], quote['sec_code']), ())  # Только подписанным клиентам
+        elif event in self.trans_events and int(data['data'].get('trans_id', 0)):  # Событие по транзакции
+            trans_id = int(data['data']['trans_id'])  # Номер транзакции процесса-хранилища
+            with self.lock:
+                self.remove_done_transactions()  # Удаляем номера транзакций, по которым сделок больше не будет
+                client_trans = self.transactions.get(trans_id)  # Клиент, номер его транзакции, новая заявка
+                if client_trans and trans_id not in self.done and self.is_transaction_done(event, data['data'], client_trans[2]):  # Если транзакция завершена
+                    self.done[trans_id] = monotonic()  # то помним ее номер еще done_ttl_sec секунд. Сделки могут прийти позже изменения заявки и повторно
+            if client_trans:  # Если это транзакция клиента
+                data = dict(data, data=dict(data['data'], trans_id=client_trans[1]))  # Возвращаем номер транзакции клиента
+                client_ids = (client_trans[0],)  # Только клиенту, выставившему заявку
+            else:  # Если транзакция неизвестна (клиент отключился, прошлый запуск процесса-хранилища)
+                data = dict(data, data=dict(data['data'], trans_id=0))  # Номер транзакции процесса-хранилища клиенты могут принять за свой. Отправляем как заявку не из автоторговли
+                client_ids = tuple(self.clients)  # Всем клиентам
+        else:  # Остальные события, в т.ч. по заявкам, выставленным не из автоторговли
+            client_ids = tuple(self.clients)  # Всем клиентам
+        for client_id in tuple(client_ids):
+            queue = self.clients.get(client_id)
+            if queue:  # Если клиент подключен
+                queue.put((None, event, data))  # Событие без номера запроса
+
+    def remove_done_transactions(self) -> None:
+        """Удаление номеров транзакций, завершенных более done_ttl_sec секунд назад. Вызывается под блокировкой"""
+        now = monotonic()
+        for trans_id in [trans_id for trans_id, done in self.done.items() if now - done > self.done_ttl_sec]:  # Пробегаемся по устаревшим транзакциям
+            del self.done[trans_id]
+            self.transactions.pop(trans_id, None)
+
+    @classmethod
+    def get_first_trans_id(cls) -> int:
+        """Первый номер транзакции процесса-хранилища. Берется из текущего времени в десятых долях секунды,
+        чтобы после перезапуска номера не совпадали с номерами транзакций прошлого запуска
+        """
+        return int(time() * 10) % (cls.max_trans_id // 2) + 1  # Половина диапазона остается на рост номеров
+
+    @staticmethod
+    def is_transaction_done(event, data, is_order) -> bool:
+        """Последнее событие по транзакции
+
+        :param str event: Событие по транзакции
+        :param dict data: Данные события
+        :param bool is_order: Транзакция выставляет заявку или стоп заявку. По заявке после ответа на транзакцию приходят сделки и изменения заявки
+        """
+        if event == 'on_trans_reply':  # Ответ на транзакцию
+            status = int(data.get('status', 0))  # Статус транзакции: 0, 1 - в пути, 3 - выполнена, остальные - ошибка
+            return status not in (0, 1, 3) or status == 3 and not is_order  # Ошибка транзакции или выполненная транзакция без заявки (снятие)
+        flags = int(data.get('flags', 0))  # Флаги заявки/стоп заявки
+        if event == 'on_order':  # Изменение заявки
+            return not flags & 0b1  # Заявка не активна (исполнена или снята)
+        if event == 'on_stop_order':  # Изменение стоп заявки
+            return not flags & 0b1 and bool(flags & 0b10)  # Стоп заявка снята. Сработавшая стоп заявка переходит в лимитную заявку с тем же номером транзакции
+        return False  # Сделки не завершают транзакцию
+
+
+class QKProviderClient:
+    """Провайдер, работающий через процесс-хранилище QKServer вместо собственного подключения к QUIK. Повторяет функции QuikPy"""
+    logger = logging.getLogger('QKProviderClient')  # Будем вести лог
+    cached_methods = ('get_symbol_info', 'dataname_to_class_sec_codes', 'class_sec_codes_to_dataname',
+                      'quik_price_to_price', 'price_to_quik_price', 'price_to_valid_price', 'lots_to_size', 'size_to_lots')  # Справочные функции. Результат зависит только от аргументов
+    cache_size = 100_000  # Кол-во запоминаемых результатов справочных функций
+    timeout = 60  # Время ожидания ответа в секундах
+
+    def __init__(self, address=default_address, authkey=None):
+        """Подключение к процессу-хранилищу
+
+        :param address: Адрес процесса-хранилища. Путь Unix сокета, имя канала Windows или кортеж (хост, порт)
+        :param bytes authkey: Ключ подключения. Для адреса (хост, порт) обязателен. Можно задать переменной окружения QK_SERVER_AUTHKEY
+        """
+        self.conn = Client(address, authkey=get_authkey(address, authkey))  # Подключаемся к процессу-хранилищу
+        self.send_lock = Lock()  # Запросы отправляются из разных потоков
+        self.request_ids = count(1)  # Номера запросов
+        self.requests = {}  # Ожидаемые ответы по номеру запроса
+        self.reader = Thread(target=self.read, daemon=True)  # Поток получения ответов и событий
+        self.reader.start()
+        self.cached_call = lru_cache(maxsize=self.cache_size)(self.call)  # Запросы справочных функций запоминаются
+        self.attributes = self.call('get_attributes', (), {})  # Атрибуты провайдера: счета, вид лимита, валюта, часовой пояс
+        self.logger.info(f'Подключение к процессу-хранилищу {address}')
+
+    def __getattr__(self, name):
+        """Атрибуты провайдера и функции QuikPy, выполняемые в процессе-хранилище"""
+        if name.startswith('__') or name in ('conn', 'attributes', 'cached_call'):  # Служебные атрибуты
+            raise AttributeError(name)
+        if name in self.attributes:  # Если это атрибут провайдера
+            return self.attributes[name]
+        if name.startswith('on_'):  # Если обработчик события не задан
+            return self.default_handler  # то используем обработчик по умолчанию
+        if name in self.cached_methods:  # Если это справочная функция
+            return lambda *args, **kwargs: self.cached_call(name, args, tuple(sorted(kwargs.items())))  # Именованные аргументы кортежем, чтобы их можно было запомнить
+        return lambda *args, **kwargs: self.call(name, args, kwargs)
+
+    def default_handler(self, data):
+        """Обработчик событий по умолчанию"""
+        pass
+
+    def call(self, method, args, kwargs):
+        """Выполнение функции QuikPy в процессе-хранилище"""
+        request_id = next(self.request_ids)  # Номер запроса
+        request = self.requests[request_id] = [Event(), None, None]  # Событие получения ответа, ответ, ошибка
+        with self.send_lock:
+            self.conn.send((request_id, method, tuple(args), dict(kwargs)))  # Отправляем запрос
+        if not request[0].wait(self.timeout):  # Если ответ не пришел
+            self.requests.pop(request_id, None)
+            raise TimeoutError(f'Процесс-хранилище не ответил на запрос {method}')
+        if request[2]:  # Если при выполнении запроса возникла ошибка
+            raise RuntimeError(f'Ошибка запроса {method} в процессе-хранилище: {request[2]}')
+        return request[1]
+
+    def read(self) -> None:
+        """Поток получения ответов и событий из процесса-хранилища"""
+        try:
+            while True:
+                message = self.conn.recv()  # Ответ (номер запроса, результат, ошибка) или событие (None, событие, данные)
+                if message[0] is None:  # Если пришло событие QUIK
+                    _, event, data = message
+                    try:
+                        getattr(self, event)(data)  # то вызываем обработчик события
+                    except Exception as ex:
+                        self.logger.error(f'Ошибка обработчика события {event}: {ex!r}')
+                    continue
+                request = self.requests.pop(message[0], None)  # Запрос по номеру
+                if request:  # Если ответ еще ожидается
+                    request[1], request[2] = message[1], message[2]
+                    request[0].set()  # Ответ получен
+        except (EOFError, OSError):  # Процесс-хранилище отключился, или клиент закрыл подключение
+            if not self.conn.closed:  # Если подключение закрыл не клиент
+                self.logger.warning('Процесс-хранилище отключился')
+
+    def close_connection_and_thread(self) -> None:
+        """Отключение от процесса-хранилища"""
+        self.conn.close()
+
+
+if __name__ == '__main__':  # Точка входа при запуске этого скрипта
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', datefmt='%d.%m.%Y %H:%M:%S', level=logging.INFO)
+    QKServer().serve_forever()  # Запускаем процесс-хранилище до остановки
@@ -0,0 +1,66 @@
+import logging  # Будем вести лог
+from array import array  # Значения бара для записи в общую память
+from multiprocessing import shared_memory  # Общая память процессов
+from uuid import uuid4  # Имена блоков общей памяти должны быть уникальными
+
+
+class QKSharedHistory:
+    """История в общей памяти. Загружается один раз в родительском процессе. Процессы оптимизации подключаются к ней без копирования
+    Бар хранится готовыми значениями линий BackTrader: дата и время, цены открытия/максимума/минимума/закрытия, объем
+    """
+    logger = logging.getLogger('QKSharedHistory')  # Будем вести лог
+    fields = 6  # Кол-во значений бара
+
+    def __init__(self, shm, owner=False):
+        """Инициализация истории в общей памяти
+
+        :param SharedMemory shm: Блок общей памяти
+        :param bool owner: Блок создан в этом процессе. Только владелец освобождает общую память
+        """
+        self.shm = shm  # Блок общей памяти
+        self.owner = owner  # Блок создан в этом процессе
+        self.values = shm.buf.cast('d')  # Значения без копирования. Первое значение - кол-во бар
+        self.count = int(self.values[0])  # Кол-во бар
+
+    @classmethod
+    def create(cls, rows):
+        """Создание истории в общей памяти
+
+        :param list rows: Значения линий BackTrader по барам
+        :return: История в общей памяти
+        """
+        shm = shared_memory.SharedMemory(name=f'qk_{uuid4().hex[:16]}', create=True, size=(1 + len(rows) * cls.fields) * 8)  # Блок общей памяти под кол-во бар и значения бар
+        data = array('d', [len(rows)])  # Кол-во бар
+        for row in rows:  # Пробегаемся по всем барам
+            data.extend(row)  # Добавляем значения бара
+        values = shm.buf.cast('d')  # Значения без копирования
+        values[:len(data)] = data  # Записываем все значения за один раз
+        values.release()  # Освобождаем представление, иначе блок нельзя будет закрыть
+        cls.logger.debug(f'В общую память {shm.name} загружено бар: {len(rows)}')
+        return cls(shm, True)
+
+    @classmethod
+    def attach(cls, name):
+        """Подключение к истории в общей памяти по имени блока"""
+        return cls(shared_memory.SharedMemory(name=name))
+
+    @property
+    def name(self) -> str:
+        """Имя блока общей памяти"""
+        return self.shm.name
+
+    def __len__(self):
+        return self.count
+
+    def get_row(self, i) -> tuple:
+        """Значения линий BackTrader бара по номеру"""
+        start = 1 + i * self.fields  # Первое значение бара
+        return tuple(self.values[start:start + self.fields])
+
+    def close(self) -> None:
+        """Отключение от общей памяти. Владелец также освобождает общую память"""
+        self.values.release()  # Освобождаем представление, иначе блок нельзя будет закрыть
+        self.shm.close()  # Отключаемся от блока
+        if self.owner:  # Если блок создан в этом процессе
+            self.shm.unlink()  # то освобождаем общую память
+            self.logger.debug(f'Общая память {self.shm.name} освобождена')
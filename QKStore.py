@@ -1,12 +1,11 @@
 import logging  # Будем вести лог
 from collections import deque
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from threading import Lock  # Подписки меняются из разных данных
 
 from backtrader.metabase import MetaParams
 from backtrader.utils.py3 import with_metaclass
 
-from QuikPy import QuikPy
-
 
 class MetaSingleton(MetaParams):
     """Метакласс для создания Singleton классов"""
@@ -28,27 +27,84 @@ class QKStore(with_metaclass(MetaSingleton, object)):
 
     BrokerCls = None  # Класс брокера будет задан из брокера
     DataCls = None  # Класс данных будет задан из данных
+    DepthDataCls = None  # Класс данных стакана будет задан из данных стакана
+    tz_msk = timezone(timedelta(hours=3), 'MSK')  # Время МСК без обращения к QUIK
 
     @classmethod
     def getdata(cls, *args, **kwargs):
         """Возвращает новый экземпляр класса данных с заданными параметрами"""
         return cls.DataCls(*args, **kwargs)
 
+    @classmethod
+    def getdepthdata(cls, *args, **kwargs):
+        """Возвращает новый экземпляр класса данных стакана с заданными параметрами"""
+        return cls.DepthDataCls(*args, **kwargs)
+
     @classmethod
     def getbroker(cls, *args, **kwargs):
         """Возвращает новый экземпляр класса брокера с заданными параметрами"""
         return cls.BrokerCls(*args, **kwargs)
 
-    def __init__(self, provider=QuikPy()):
+    def __init__(self, provider=None, address=None, providers=None, authkey=None):
+        """Инициализация хранилища
+
+        :param provider: Провайдер QuikPy. Если не задан, то будет создан при первом обращении
+        :param address: Адрес процесса-хранилища QKServer. Если задан, то вместо собственного подключения к QUIK используется подключение процесса-хранилища
+        :param dict providers: Подключения к QUIK по каналу для пула подключений QKProviderPool. Если заданы, то запросы распределяются по каналам
+        :param bytes authkey: Ключ подключения к процессу-хранилищу. Для адреса (хост, порт) обязателен. Можно задать переменной окружения QK_SERVER_AUTHKEY
+        """
         super(QKStore, self).__init__()
         self.notifs = deque()  # Уведомления хранилища
-        self.provider = provider  # Подключаемся к провайдеру QuikPy
-        self.new_bars = []  # Новые бары по всем подпискам на тикеры из QUIK
+        self._provider = provider  # Провайдер QuikPy
+        self.address = address  # Адрес процесса-хранилища
+        self.authkey = authkey  # Ключ подключения к процессу-хранилищу
+        self.providers = providers  # Подключения к QUIK по каналу
+        self.bar_buffers = {}  # Буферы новых бар данных по guid подписки/расписания
+        self.unrouted_bars = 0  # Кол-во новых бар, для которых нет буфера (данные остановлены или не запущены)
+        self.order_books = {}  # Стаканы по подпискам на тикеры из QUIK
+        self.order_book_subscribers = {}  # Кол-во данных, получающих стакан, по подписке на тикер
+        self.subscriptions_lock = Lock()  # Блокировка подписок
+        self.datas = {}  # Данные тикеров в cerebro по названию. Нужны брокеру для восстановления заявок из снимка
+        self.bar_listeners = []  # Функции, которые вызываются для каждого нового бара по подписке. Вызываются из потока обработки событий QUIK
+
+    def __reduce__(self):
+        """В процессе оптимизации используется свое хранилище. Подключение к QUIK не передается между процессами"""
+        return QKStore, ()
+
+    @property
+    def provider(self):
+        """Провайдер QuikPy. Подключение к QUIK создается при первом обращении, а не при импорте или создании хранилища"""
+        if self._provider is None:  # Если подключения к QUIK еще нет
+            if self.address:  # Если работаем через процесс-хранилище
+                from BackTraderQuik.QKServer import QKProviderClient
+                self.logger.debug(f'Подключение к процессу-хранилищу {self.address}')
+                self._provider = QKProviderClient(self.address, self.authkey)  # то подключаемся к нему
+            elif self.providers:  # Если работаем через пул подключений
+                from BackTraderQuik.QKProviderPool import QKProviderPool
+                self.logger.debug(f'Создание пула подключений к QUIK по каналам {list(self.providers)}')
+                self._provider = QKProviderPool(self.providers)  # Подключения будут созданы при первом обращении к каналу
+            else:  # Если работаем с собственным подключением к QUIK
+                from QuikPy import QuikPy  # Библиотеку подключаем только тогда, когда она нужна
+                self.logger.debug('Создание подключения к QUIK')
+                self._provider = QuikPy()  # Подключаемся к провайдеру QuikPy
+            self.set_handlers()  # Ставим обработчики событий хранилища
+        return self._provider
+
+    @property
+    def has_provider(self) -> bool:
+        """Подключение к QUIK создано"""
+        return self._provider is not None
 
     def start(self):
-        self.provider.on_connected = lambda data: self.logger.info(data)  # Соединение терминала с сервером QUIK
-        self.provider.on_disconnected = lambda data: self.logger.info(data)  # Отключение терминала от сервера QUIK
-        self.provider.on_new_candle = self.on_new_candle  # Обработчик новых баров по подписке из QUIK
+        if self.has_provider:  # Если подключение к QUIK уже создано. Иначе обработчики будут поставлены при его создании
+            self.set_handlers()  # то ставим обработчики событий хранилища
+
+    def set_handlers(self):
+        """Установка обработчиков событий хранилища"""
+        self._provider.on_connected = lambda data: self.logger.info(data)  # Соединение терминала с сервером QUIK
+        self._provider.on_disconnected = lambda data: self.logger.info(data)  # Отключение терминала от сервера QUIK
+        self._provider.on_new_candle = self.on_new_candle  # Обработчик новых баров по подписке из QUIK
+        self._provider.on_quote = self.on_quote  # Обработчик изменения стакана по подписке из QUIK
 
     def put_notification(self, msg, *args, **kwargs):
         self.notifs.append((msg, args, kwargs))
@@ -59,8 +115,23 @@ class QKStore(with_metaclass(MetaSingleton, object)):
         return [notif for notif in iter(self.notifs.popleft, None)]
 
     def stop(self):
-        self.provider.on_new_candle = self.provider.default_handler  # Возвращаем обработчик по умолчанию
-        self.provider.close_connection_and_thread()  # Закрываем соединение для запросов и поток обработки функций обратного вызова
+        self.close()  # Закрываем подключение к QUIK
+
+    def close(self):
+        """Закрытие подключения к QUIK, если оно было создано. При следующем обращении к провайдеру будет создано новое подключение"""
+        if not self.has_provider:  # Если подключения к QUIK не было
+            return  # то закрывать нечего, выходим, дальше не продолжаем
+        self._provider.on_new_candle = self._provider.default_handler  # Возвращаем обработчик по умолчанию
+        self._provider.on_quote = self._provider.default_handler  # Возвращаем обработчик по умолчанию
+        self._provider.close_connection_and_thread()  # Закрываем соединение для запросов и поток обработки функций обратного вызова
+        self._provider = None  # Подключения больше нет
+
+    def dataname_to_class_sec_codes(self, dataname) -> tuple:
+        """Код режима торгов и тикер из названия тикера. Для названия в формате <Код режима торгов>.<Тикер> к QUIK не обращаемся"""
+        if '.' in dataname:  # Если задан код режима торгов
+            class_code, sec_code = dataname.split('.', 1)  # то разбираем название тикера
+            return class_code, sec_code
+        return self.provider.dataname_to_class_sec_codes(dataname)  # Иначе код режима торгов ищем в QUIK
 
     def on_new_candle(self, data):
         bar = data['data']  # Данные бара
@@ -71,7 +142,68 @@ class QKStore(with_metaclass(MetaSingleton, object)):
         bar = dict(datetime=self.get_bar_open_date_time(bar),  # Собираем дату и время открытия бара
                    open=bar['open'], high=bar['high'], low=bar['low'], close=bar['close'],  # Цены QUIK
                    volume=int(bar['volume']))  # Объем в лотах. Бар из подписки
-        self.new_bars.append(dict(guid=guid, data=bar))
+        self.put_new_bar(guid, bar)
+
+    def register_bar_buffer(self, guid, bar_buffer):
+        """Регистрация буфера новых бар данных. Каждые данные получают все бары подписки/расписания в свой буфер"""
+        self.bar_buffers[guid] = self.bar_buffers.get(guid, ()) + (bar_buffer,)  # Кортеж заменяется целиком. Поток событий QUIK всегда видит его целым
+
+    def unregister_bar_buffer(self, guid, bar_buffer):
+        """Отмена регистрации и закрытие буфера новых бар данных"""
+        bar_buffers = tuple(buffer for buffer in self.bar_buffers.get(guid, ()) if buffer is not bar_buffer)  # Остальные буферы подписки/расписания
+        if bar_buffers:  # Если буферы остались
+            self.bar_buffers[guid] = bar_buffers  # то оставляем их
+        else:  # Если буферов не осталось
+            self.bar_buffers.pop(guid, None)  # то новые бары подписки/расписания больше никто не получает
+        bar_buffer.close()  # Закрываем буфер
+
+    def put_new_bar(self, guid, bar):
+        """Добавление нового бара по подписке/расписанию в буферы данных"""
+        bar_buffers = self.bar_buffers.get(guid)  # Буферы данных подписки/расписания
+        if bar_buffers:  # Если есть данные, получающие бары
+            for bar_buffer in bar_buffers:  # Пробегаемся по всем буферам
+                bar_buffer.put(bar)  # Добавляем бар в буфер
+        else:  # Если бар никто не получает
+            self.unrouted_bars += 1  # то он не сохраняется. Память не растет после остановки данных
+        for listener in self.bar_listeners:  # Пробегаемся по всем функциям получения новых бар
+            listener(guid, bar)  # Передаем им новый бар
+
+    def subscribe_order_book(self, guid, order_book):
+        """Подписка на стакан тикера. В QUIK подписка одна на все данные тикера
+
+        :param tuple guid: Идентификатор подписки (код режима торгов, тикер)
+        :param order_book: Стакан, если по тикеру его еще нет
+        :return: Стакан тикера. Все данные тикера получают один стакан с наибольшим запрошенным кол-вом уровней
+        """
+        with self.subscriptions_lock:
+            subscribers = self.order_book_subscribers.get(guid, 0)  # Кол-во данных, получающих стакан
+            if subscribers == 0:  # Если это первые данные тикера
+                self.order_books[guid] = order_book  # то стакан будет обновляться по подписке
+                if not self.provider.is_subscribed_level2_quotes(*guid)['data']:  # Если не было подписки на стакан
+                    self.provider.subscribe_level2_quotes(*guid)  # то подписываемся на стакан
+            else:  # Если стакан тикера уже есть
+                self.order_books[guid].resize(order_book.depth)  # то уровней в нем должно хватать и этим данным
+            self.order_book_subscribers[guid] = subscribers + 1
+            return self.order_books[guid]
+
+    def unsubscribe_order_book(self, guid) -> None:
+        """Отмена подписки на стакан тикера. В QUIK подписка отменяется, когда стакан тикера больше никто не получает"""
+        with self.subscriptions_lock:
+            subscribers = self.order_book_subscribers.get(guid, 0) - 1  # Кол-во данных, получающих стакан, после отмены
+            if subscribers > 0:  # Если стакан получают другие данные
+                self.order_book_subscribers[guid] = subscribers  # то подписку оставляем
+                return
+            self.order_book_subscribers.pop(guid, None)
+            self.order_books.pop(guid, None)  # Стакан больше не отслеживаем
+            if self.has_provider:  # Если подключение к QUIK еще есть
+                self.provider.unsubscribe_level2_quotes(*guid)  # то отменяем подписку в QUIK
+
+    def on_quote(self, data):
+        quote = data['data']  # Стакан
+        order_book = self.order_books.get((quote['class_code'], quote['sec_code']))  # Стакан по идентификатору подписки
+        if order_book is None:  # Если стакан по тикеру не отслеживается
+            return  # то выходим, дальше не продолжаем
+        order_book.update(quote.get('bid'), quote.get('offer'), datetime.now(self.tz_msk).replace(tzinfo=None))  # Обновляем массивы стакана на месте
 
     @staticmethod
     def get_bar_open_date_time(bar):
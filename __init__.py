@@ -1,3 +1,13 @@
+from .QKLogging import *
 from .QKStore import *
+from .QKHistory import *
+from .QKSharedHistory import *
+from .QKBarBuffer import *
+from .QKRisk import *
 from .QKData import *  # Также подключает данные в хранилище
+from .QKHistoryIO import *  # Пакетная выгрузка/загрузка истории
 from .QKBroker import *  # Также подключает брокера в хранилище
+from .QKDepthData import *  # Также подключает данные стакана в хранилище
+from .QKServer import *  # Процесс-хранилище и провайдер для работы через него
+from .QKProviderPool import *  # Пул подключений к QUIK
+from .QKAsync import *  # Асинхронный интерфейс хранилища и брокера
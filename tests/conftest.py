@@ -0,0 +1,26 @@
+import pytest
+
+from BackTraderQuik import QKStore, QKData
+from BackTraderQuik.tests.provider import StandInProvider
+
+
+@pytest.fixture
+def provider():
+    """Замена провайдера QuikPy"""
+    return StandInProvider()
+
+
+@pytest.fixture
+def store(provider):
+    """Новое хранилище с заменой провайдера. Хранилище - Singleton, поэтому для каждой проверки создается заново"""
+    QKStore._singleton = None
+    yield QKStore(provider=provider)
+    QKStore._singleton = None
+
+
+@pytest.fixture
+def datapath(tmp_path, monkeypatch):
+    """Временная папка файлов истории данных"""
+    path = f'{tmp_path}/'
+    monkeypatch.setattr(QKData, 'datapath', path)
+    return path
@@ -0,0 +1,79 @@
+from datetime import timedelta, timezone
+
+
+class StandInProvider:
+    """Замена провайдера QuikPy для проверок без QUIK. Запоминает все запросы, отвечает заданными результатами"""
+    tz_msk = timezone(timedelta(hours=3), 'MSK')  # Время МСК
+    limit_kind = 0  # День лимита
+    currency = 'SUR'  # Валюта
+
+    def __init__(self, **results):
+        """Инициализация замены провайдера
+
+        :param results: Ответы на запросы по названию функции QuikPy. Ответ может быть функцией аргументов запроса
+        """
+        self.accounts = [dict(account_id=0, class_codes=['TQBR', 'SPBFUT'], futures=False, client_code='c', firm_id='f', trade_account_id='t')]  # Счета
+        self.results = dict(get_money_limits=[], get_all_depo_limits=[], get_futures_holdings=[], get_all_orders=[], get_all_stop_orders=[],
+                            get_param_ex={'param_value': '100'}, get_quote_level2={'bid': [], 'offer': []}, is_subscribed=False, is_subscribed_level2_quotes=False,
+                            is_connected=1, get_candles_from_data_source=[])  # Ответы по умолчанию
+        self.results.update(results)
+        self.calls = []  # Запросы: функция, аргументы
+
+    def __getattr__(self, name):
+        """Запрос к QUIK"""
+        if name.startswith('__') or name in ('results', 'calls'):  # Служебные атрибуты
+            raise AttributeError(name)
+        if name.startswith('on_'):  # Если обработчик события не задан
+            return self.default_handler
+
+        def call(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            result = self.results.get(name)
+            return {'data': result(*args, **kwargs) if callable(result) else result}
+        return call
+
+    def called(self, name) -> list:
+        """Аргументы всех запросов функции"""
+        return [args for method, args, kwargs in self.calls if method == name]
+
+    def default_handler(self, data):
+        pass
+
+    def send_transaction(self, transaction):
+        self.calls.append(('send_transaction', (transaction,), {}))
+        return {'cmd': 'send_transaction', 'data': transaction}
+
+    def close_connection_and_thread(self):
+        self.calls.append(('close_connection_and_thread', (), {}))
+
+    def get_symbol_info(self, class_code, sec_code):
+        self.calls.append(('get_symbol_info', (class_code, sec_code), {}))
+        return {'min_price_step': 0.01, 'scale': 2}  # Как в QuikPy: параметры тикера без обертки data
+
+    @staticmethod
+    def dataname_to_class_sec_codes(dataname):
+        return tuple(dataname.split('.', 1)) if '.' in dataname else ('TQBR', dataname)
+
+    @staticmethod
+    def class_sec_codes_to_dataname(class_code, sec_code):
+        return f'{class_code}.{sec_code}'
+
+    @staticmethod
+    def quik_price_to_price(class_code, sec_code, price):
+        return price
+
+    @staticmethod
+    def price_to_quik_price(class_code, sec_code, price):
+        return price
+
+    @staticmethod
+    def price_to_valid_price(class_code, sec_code, price):
+        return price
+
+    @staticmethod
+    def lots_to_size(class_code, sec_code, size):
+        return size
+
+    @staticmethod
+    def size_to_lots(class_code, sec_code, size):
+        return size
@@ -0,0 +1,57 @@
+import asyncio
+from threading import Thread
+from types import SimpleNamespace
+
+from backtrader import Order
+
+from BackTraderQuik import QKAsyncBroker
+
+
+def test_finished_waiters_are_removed():
+    async def scenario():
+        abroker = QKAsyncBroker(SimpleNamespace(order_listeners=[]), SimpleNamespace(loop=asyncio.get_running_loop()))
+        order = SimpleNamespace(ref=1, status=Order.Submitted)
+        try:
+            await asyncio.wait_for(abroker.wait_order(order, 'completed'), 0.01)  # Ожидание по таймауту
+        except asyncio.TimeoutError:
+            pass
+        waiter = abroker.wait_order(order, 'completed')
+        waiter.cancel()  # Отмененное ожидание
+        await asyncio.sleep(0)
+        assert abroker.waiters == {}
+        future = abroker.wait_order(order, 'completed')
+        order.status = Order.Completed
+        abroker.put_order_notification(order)
+        assert await future is order
+        assert abroker.waiters == {}
+    asyncio.run(scenario())
+
+
+class RacingOrder:
+    """Заявка, статус которой меняется в потоке событий QUIK сразу после первой проверки"""
+    def __init__(self, abroker):
+        self.abroker = abroker
+        self.ref = 1
+        self.checked = False
+        self.current = Order.Submitted
+
+    @property
+    def status(self):
+        status = self.current
+        if not self.checked:  # Первая проверка статуса
+            self.checked = True
+            self.current = Order.Completed  # Заявка исполнена
+            Thread(target=self.abroker.on_order_notification, args=(self,)).start()  # Уведомление из потока событий QUIK
+        return status
+
+    def clone(self):
+        return self
+
+
+def test_status_change_during_wait_registration_is_not_lost():
+    async def scenario():
+        abroker = QKAsyncBroker(SimpleNamespace(order_listeners=[]), SimpleNamespace(loop=asyncio.get_running_loop()))
+        order = RacingOrder(abroker)
+        assert await asyncio.wait_for(abroker.wait_order(order, 'completed'), 5) is order
+        assert abroker.waiters == {}
+    asyncio.run(scenario())
@@ -0,0 +1,67 @@
+from datetime import datetime, timedelta
+from threading import Thread
+
+import pytest
+
+from BackTraderQuik import QKBarBuffer, QKData
+
+
+def bars(count, minute=0):
+    """Новые бары"""
+    return [dict(datetime=datetime(2026, 10, 19, 10) + timedelta(minutes=minute + i), close=i) for i in range(count)]
+
+
+def drain(buffer) -> list:
+    """Все бары из буфера"""
+    result = []
+    while (bar := buffer.get()) is not None:
+        result.append(bar)
+    return result
+
+
+def test_drop_oldest():
+    buffer = QKBarBuffer('test', 3, 'drop_oldest')
+    for bar in bars(5):
+        buffer.put(bar)
+    assert [bar['close'] for bar in drain(buffer)] == [2, 3, 4]
+    assert buffer.dropped == 2
+
+
+def test_coalesce_replaces_updates_and_last_bar():
+    buffer = QKBarBuffer('test', 2, 'coalesce')
+    first, second, third = bars(3)
+    buffer.put(first)
+    buffer.put(dict(first, close=10))  # Изменение того же бара
+    buffer.put(second)
+    buffer.put(third)  # Буфер заполнен
+    assert [bar['close'] for bar in drain(buffer)] == [10, 2]
+    assert buffer.coalesced == 2
+
+
+def test_block_waits_for_reader():
+    buffer = QKBarBuffer('test', 2, 'block', block_timeout_sec=5)
+    writer = Thread(target=lambda: [buffer.put(bar) for bar in bars(4)])
+    writer.start()
+    received = []
+    while len(received) < 4:
+        bar = buffer.get()
+        if bar is not None:
+            received.append(bar['close'])
+    writer.join()
+    assert received == [0, 1, 2, 3] and buffer.dropped == 0
+
+
+def test_close_releases_blocked_writer():
+    buffer = QKBarBuffer('test', 1, 'block', block_timeout_sec=5)
+    buffer.put(bars(1)[0])
+    writer = Thread(target=buffer.put, args=(bars(1, 1)[0],))
+    writer.start()
+    buffer.close()
+    writer.join(1)
+    assert not writer.is_alive() and len(buffer) == 0
+
+
+def test_block_rejected_for_subscription(store):
+    with pytest.raises(ValueError):
+        QKData(dataname='TQBR.SBER', live_bars=True, overflow='block')
+    QKData(dataname='TQBR.SBER', live_bars=True, schedule=object(), overflow='block')  # По расписанию бары добавляет поток данных
@@ -0,0 +1,87 @@
+import json
+from datetime import datetime
+from threading import Thread
+from types import SimpleNamespace
+
+import pytest
+from backtrader import Cerebro, Order, date2num
+from backtrader.order import OrderBase
+
+from BackTraderQuik import QKStore, QKBroker, QKData
+
+
+def restored_broker(provider, tmp_path, orders, **kwargs):
+    """Запущенный брокер с заявками из снимка"""
+    snapshot_file = f'{tmp_path}/snapshot.json'
+    with open(snapshot_file, 'w', encoding='utf-8') as file:
+        json.dump(dict(dt='2026-10-19T10:00:00', next_ref=max(order['ref'] for order in orders) + 1, orders=orders, ocos=[], pcs={}, trade_nums={}, positions={}), file)
+    data = QKData(dataname='TQBR.SBER')
+    Cerebro().adddata(data, name='TQBR.SBER')  # Данные регистрируются в хранилище по названию
+    broker = QKBroker(snapshot_file=snapshot_file, **kwargs)
+    broker.start()
+    return broker
+
+
+def snapshot_order(ref, size, price, status=Order.Accepted):
+    """Заявка в снимке"""
+    return dict(ref=ref, dataname='TQBR.SBER', buy=True, size=size, price=price, pricelimit=None, exectype=Order.Limit, status=status,
+                parent=None, transmit=True, executed_size=0, executed_price=0.0, info=dict(account_id=0))
+
+
+def trade(trans_id, trade_num, qty, price):
+    """Сделка из QUIK"""
+    return {'data': dict(trade_num=trade_num, order_num=777, trans_id=trans_id, class_code='TQBR', sec_code='SBER', qty=qty, flags=0, price=price)}
+
+
+def test_restored_orders_are_reserved_in_risk(store, provider, tmp_path):
+    provider.results['get_all_orders'] = [dict(trans_id=5, order_num=777, flags=0b1)]  # Заявка активна в QUIK
+    broker = restored_broker(provider, tmp_path, [snapshot_order(5, 10, 100.0)], max_position=15)
+    assert broker.risk.reserved == 1000.0
+    assert broker.risk.reserved_sizes['TQBR.SBER', True] == 10
+    assert broker.risk.check(SimpleNamespace(ref=6, size=10), 'TQBR.SBER', 100.0) is not None  # С учетом остатка восстановленной заявки позиция превысит лимит
+    broker.on_trade(trade(5, 1, 4, 100.0))
+    assert broker.risk.reserved == 600.0 and broker.risk.sizes['TQBR.SBER'] == 4
+    broker.on_trade(trade(5, 2, 6, 100.0))
+    assert broker.orders[5].status == Order.Completed
+    assert broker.risk.reserved == 0.0 and broker.risk.sizes['TQBR.SBER'] == 10
+
+
+def test_save_snapshot_waits_for_quik_handlers(store, provider, tmp_path):
+    provider.results['get_all_orders'] = [dict(trans_id=5, order_num=777, flags=0b1)]
+    broker = restored_broker(provider, tmp_path, [snapshot_order(5, 10, 100.0)])
+    broker.trade_nums['TQBR.SBER'] = [1]
+    with broker.lock:  # Обработчик событий QUIK меняет состояние
+        saver = Thread(target=broker.save_snapshot)
+        saver.start()
+        saver.join(0.1)
+        assert saver.is_alive()  # Снимок ждет окончания обработки
+        broker.trade_nums['TQBR.SBER'].append(2)
+    saver.join()
+    with open(broker.p.snapshot_file, encoding='utf-8') as file:
+        snapshot = json.load(file)
+    assert snapshot['trade_nums'] == {'TQBR.SBER': [1, 2]}
+    assert [order['ref'] for order in snapshot['orders']] == [5]
+
+
+def test_new_refs_follow_snapshot_without_patching_backtrader(store, provider, tmp_path):
+    provider.results['get_all_orders'] = [dict(trans_id=50, order_num=777, flags=0b1)]
+    refbasis = OrderBase.refbasis
+    broker = restored_broker(provider, tmp_path, [snapshot_order(50, 10, 100.0)])
+    assert OrderBase.refbasis is refbasis  # Номера заявок других брокеров и ТС не меняются
+    data = broker.orders[50].data
+    data._start()
+    data.forward()  # Бар, на котором ТС выставляет заявку
+    data.datetime[0], data.close[0] = date2num(datetime(2026, 10, 19, 10)), 100.0
+    order = broker.buy(None, data, 1, 100.0, exectype=Order.Limit)
+    assert order.ref == 51 and broker.orders[51] is order
+    assert provider.called('send_transaction')[-1][0]['TRANS_ID'] == '51'
+
+
+def test_snapshot_is_rejected_over_server(tmp_path):
+    QKStore._singleton = None
+    try:
+        QKStore(address=f'{tmp_path}/qk.sock')  # Хранилище через процесс-хранилище. Подключение создается при первом обращении
+        with pytest.raises(ValueError):
+            QKBroker(snapshot_file=f'{tmp_path}/snapshot.json')
+    finally:
+        QKStore._singleton = None
@@ -0,0 +1,139 @@
+from datetime import datetime, timedelta
+import sys
+
+from backtrader import Cerebro, Strategy, TimeFrame, num2date
+
+from BackTraderQuik import QKStore, QKData, QKHistory
+
+
+def bar(dt, open_, high, low, close, volume):
+    """Новый бар по подписке"""
+    return dict(datetime=dt, open=open_, high=high, low=low, close=close, volume=volume)
+
+
+def live_data(store, monkeypatch, now, **kwargs):
+    """Запущенные данные по подписке с заданным текущим временем на бирже"""
+    monkeypatch.setattr(QKData, 'get_quik_date_time_now', lambda self: now[0])
+    data = QKData(dataname='TQBR.SBER', timeframe=TimeFrame.Minutes, live_bars=True, **kwargs)
+    Cerebro().adddata(data)  # Окружение данных
+    data._start()
+    return data
+
+
+def load(data) -> list:
+    """Все бары, которые данные отправят в ТС из буфера: дата/время, close, volume, кол-во бар в линиях"""
+    loaded = []
+    while data.bar_buffer.peek() is not None:  # Пока в буфере есть бары
+        if data.next():  # Если данные отправили бар
+            loaded.append((num2date(data.datetime[0]), data.close[0], data.volume[0], len(data)))
+    return loaded
+
+
+def test_intrabar_doji_first_tick_does_not_drop_bar(store, datapath, monkeypatch):
+    t0 = datetime(2026, 10, 19, 10, 0)
+    now = [t0 + timedelta(seconds=10)]
+    data = live_data(store, monkeypatch, now, intrabar=True)
+    store.put_new_bar(data.guid, bar(t0, 100, 100, 100, 100, 1))  # Первое изменение бара - дожи 4-х цен
+    assert load(data) == [(t0, 100, 1, 1)]
+    store.put_new_bar(data.guid, bar(t0, 100, 101, 100, 101, 2))
+    assert load(data) == [(t0, 101, 2, 1)]  # Бар обновился на месте
+    now[0] = t0 + timedelta(seconds=61)
+    store.put_new_bar(data.guid, bar(t0, 100, 101, 100, 101, 3))  # Закрытый бар
+    store.put_new_bar(data.guid, bar(t0 + timedelta(minutes=1), 101, 101, 101, 101, 1))  # Дожи следующего бара
+    assert load(data) == [(t0, 101, 3, 1), (t0 + timedelta(minutes=1), 101, 1, 2)]
+    assert [b['datetime'] for b in data.history.get_bars()] == [t0]  # Закрытый бар сохранен в файл
+    data.stop()
+
+
+def test_intrabar_closed_doji_is_filtered(store, datapath, monkeypatch):
+    t0 = datetime(2026, 10, 19, 10, 0)
+    now = [t0 + timedelta(seconds=70)]
+    data = live_data(store, monkeypatch, now, intrabar=True)
+    store.put_new_bar(data.guid, bar(t0, 100, 100, 100, 100, 1))  # Закрытый дожи 4-х цен
+    store.put_new_bar(data.guid, bar(t0 + timedelta(minutes=1), 100, 102, 100, 102, 1))
+    assert load(data) == [(t0 + timedelta(minutes=1), 102, 1, 1)]
+    assert data.dt_last_open == t0  # Дожи пропущен как закрытый бар, его изменения больше не придут
+    data.stop()
+
+
+def test_offline_share_history_uses_file_only(datapath):
+    QKStore._singleton = None
+    try:
+        store = QKStore()  # Хранилище без подключения к QUIK. QuikPy в проверках не установлен
+        history = QKHistory(datapath, 'TQBR.SBER_M1')
+        history.append([bar(datetime(2025, 10, 20, 10, minute), 100, 101, 99, 100 + minute, 1) for minute in range(3)])
+        data = QKData(dataname='TQBR.SBER', timeframe=TimeFrame.Minutes, offline=True)
+        shared = data.share_history()
+        try:
+            assert len(shared) == 3
+            assert shared.get_row(2)[4] == 102
+            assert not store.has_provider  # Подключение к QUIK не создавалось
+        finally:
+            data.unshare_history()
+    finally:
+        QKStore._singleton = None
+
+
+def test_intrabar_stale_updates_do_not_query_quik(store, provider, datapath, monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(sys.modules['BackTraderQuik.QKData'], 'monotonic', lambda: clock[0])
+    provider.results['get_info_param'] = lambda name: '19.10.2026' if name == 'TRADEDATE' else '10:00:10'
+    t0 = datetime(2026, 10, 19, 10, 0)
+    data = QKData(dataname='TQBR.SBER', timeframe=TimeFrame.Minutes, live_bars=True, intrabar=True)
+    Cerebro().adddata(data)
+    data._start()
+    data.live_mode = True  # Время берется из QUIK
+    for volume in range(1, 6):  # Изменения бара, которые заменяет следующее изменение
+        store.put_new_bar(data.guid, bar(t0, 100, 101, 100, 101, volume))
+    for _ in range(5):  # Повторы последнего изменения
+        store.put_new_bar(data.guid, bar(t0, 100, 101, 100, 101, 5))
+    assert load(data) == [(t0, 101, 5, 1)]
+    assert len(provider.called('get_info_param')) == 2  # Время QUIK запрошено один раз: дата и время
+    clock[0] += data.quik_time_sec
+    store.put_new_bar(data.guid, bar(t0, 100, 101, 100, 101, 5))
+    assert load(data) == []
+    assert len(provider.called('get_info_param')) == 4  # Через секунду время запрошено снова
+    data.stop()
+
+
+def test_intrabar_late_closed_bar_replaces_lines(store, datapath, monkeypatch):
+    t0, t1 = datetime(2026, 10, 19, 10, 0), datetime(2026, 10, 19, 10, 1)
+    now = [t0 + timedelta(seconds=50)]
+    data = live_data(store, monkeypatch, now, intrabar=True)
+    store.put_new_bar(data.guid, bar(t0, 100, 101, 100, 101, 1))
+    assert load(data) == [(t0, 101, 1, 1)]
+    now[0] = t1 + timedelta(seconds=10)
+    store.put_new_bar(data.guid, bar(t1, 102, 102, 102, 102, 1))  # Изменение следующего бара пришло раньше закрытого бара
+    assert load(data) == [(t1, 102, 1, 2)]
+    store.put_new_bar(data.guid, bar(t0, 100, 103, 99, 103, 4))  # Закрытый бар с окончательными значениями
+    assert load(data) == []  # В ТС повторно не отправляется
+    assert (num2date(data.datetime[-1]), data.high[-1], data.low[-1], data.close[-1], data.volume[-1]) == (t0, 103, 99, 103, 4)  # Линии совпадают с историей
+    assert (num2date(data.datetime[0]), data.close[0]) == (t1, 102)
+    assert data.history.get_bars()[-1]['close'] == 103
+    data.stop()
+
+
+class Optimized(Strategy):
+    """Стратегия для оптимизации"""
+    params = (('period', 1),)
+
+
+def test_share_history_warns_when_optdatas_preloads(datapath, caplog):
+    QKStore._singleton = None
+    try:
+        QKStore()
+        QKHistory(datapath, 'TQBR.SBER_M1').append([bar(datetime(2025, 10, 20, 10, minute), 100, 101, 99, 100, 1) for minute in range(3)])
+        data = QKData(dataname='TQBR.SBER', timeframe=TimeFrame.Minutes, offline=True)
+        data.share_history()
+        try:
+            for optdatas, warnings in ((False, 0), (True, 1)):
+                caplog.clear()
+                cerebro = Cerebro(stdstats=False)
+                cerebro.adddata(data)
+                cerebro.optstrategy(Optimized, period=[1, 2])
+                assert len(cerebro.run(maxcpus=2, optdatas=optdatas)) == 2
+                assert len([record for record in caplog.records if 'optdatas' in record.getMessage()]) == warnings
+        finally:
+            data.unshare_history()
+    finally:
+        QKStore._singleton = None
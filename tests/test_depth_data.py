@@ -0,0 +1,37 @@
+from BackTraderQuik import QKDepthData
+
+
+def quote(bid):
+    """Изменение стакана из QUIK"""
+    return {'data': dict(class_code='TQBR', sec_code='SBER', bid=[dict(price=str(bid), quantity='5')], offer=[dict(price='105', quantity='1')])}
+
+
+def test_shared_order_book_survives_first_stop(store, provider):
+    first, second = QKDepthData(dataname='TQBR.SBER'), QKDepthData(dataname='TQBR.SBER')
+    first.start()
+    second.start()
+    assert first.order_book is second.order_book
+    assert len(provider.called('subscribe_level2_quotes')) == 1
+    first.stop()
+    assert provider.called('unsubscribe_level2_quotes') == []
+    store.on_quote(quote(99))
+    assert second.order_book.bid_prices[0] == 99
+    second.stop()
+    assert provider.called('unsubscribe_level2_quotes') == [('TQBR', 'SBER')]
+    assert ('TQBR', 'SBER') not in store.order_books
+
+
+def test_shared_order_book_has_largest_depth(store, provider):
+    levels = [dict(price=str(100 - i), quantity='1') for i in range(10)]  # 10 уровней покупки. Лучшая цена в QUIK последняя
+    provider.results['get_quote_level2'] = {'bid': levels[::-1], 'offer': [dict(price='101', quantity='1')]}
+    small, large = QKDepthData(dataname='TQBR.SBER', depth=3), QKDepthData(dataname='TQBR.SBER', depth=8)
+    small.start()
+    large.start()
+    assert small.order_book is large.order_book and large.order_book.depth == 8
+    assert large.order_book.bid_count == 8 and list(large.order_book.bid_prices) == [100.0 - i for i in range(8)]
+    medium = QKDepthData(dataname='TQBR.SBER', depth=5)
+    medium.start()
+    assert medium.order_book is large.order_book and large.order_book.depth == 8  # Меньшая глубина стакан не уменьшает
+    for data in (small, large, medium):
+        data.stop()
+    assert provider.called('unsubscribe_level2_quotes') == [('TQBR', 'SBER')]
@@ -0,0 +1,31 @@
+from datetime import datetime
+
+from BackTraderQuik import QKHistory
+
+
+def bar(dt, close=100.0):
+    """Бар истории"""
+    return dict(datetime=dt, open=close, high=close, low=close, close=close, volume=1)
+
+
+def test_concurrent_appends_keep_index_entries(tmp_path):
+    path = f'{tmp_path}/'
+    first, second = QKHistory(path, 'TQBR.SBER_M1', 'month'), QKHistory(path, 'TQBR.SBER_M1', 'month')  # Экземпляры загрузили пустой индекс
+    first.append([bar(datetime(2026, 1, 5, 10))])
+    second.append([bar(datetime(2026, 2, 5, 10))])  # Индекс второго экземпляра не знает о разделе первого
+    first.append([bar(datetime(2026, 2, 5, 10, 1))])
+    index = QKHistory(path, 'TQBR.SBER_M1', 'month').index  # Индекс из файла
+    assert sorted(index) == ['2026-01', '2026-02']
+    assert index['2026-02']['rows'] == 2 and index['2026-02']['sorted']
+    assert [b['datetime'] for b in second.get_bars()] == [datetime(2026, 1, 5, 10), datetime(2026, 2, 5, 10), datetime(2026, 2, 5, 10, 1)]
+
+
+def test_get_bars_reads_partition_files_missing_from_index(tmp_path):
+    path = f'{tmp_path}/'
+    history = QKHistory(path, 'TQBR.SBER_M1', 'month')
+    history.append([bar(datetime(2026, 1, 5, 10))])
+    other = QKHistory(path, 'TQBR.SBER_M1', 'month')
+    other.write_file(other.get_partition_file_name('2026-03'), [bar(datetime(2026, 3, 2, 10), 101.0)])  # Файл-раздел записан без индекса
+    bars = history.get_bars(datetime(2026, 3, 1))
+    assert [(b['datetime'], b['close']) for b in bars] == [(datetime(2026, 3, 2, 10), 101.0)]
+    assert [b['datetime'] for b in history.get_bars()] == [datetime(2026, 1, 5, 10), datetime(2026, 3, 2, 10)]
@@ -0,0 +1,48 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from BackTraderQuik import QKHistory, QKData, QKHistoryIO
+
+np = pytest.importorskip('numpy')  # Без NumPy выгрузка/загрузка не работает
+
+
+def source_history(datapath, partition=None) -> QKHistory:
+    """История с барами в двух месяцах"""
+    history = QKHistory(datapath, 'TQBR.SBER_M1', partition, QKData.delimiter, QKData.dt_format)
+    start = datetime(2026, 1, 31, 23, 58)
+    history.append([dict(datetime=start + timedelta(minutes=i), open=100.0 + i, high=101.5 + i, low=99.25 + i, close=100.5 + i, volume=10 + i) for i in range(5)])
+    return history
+
+
+@pytest.mark.parametrize('fmt', ['npz', 'parquet'])
+def test_round_trip(tmp_path, fmt):
+    if fmt == 'parquet':
+        pytest.importorskip('pyarrow')
+    source, target = f'{tmp_path}/source/', f'{tmp_path}/target/'
+    bars = source_history(source, 'month').get_bars()
+    assert QKHistoryIO.export_all(f'{tmp_path}/export', fmt, source) == {'TQBR.SBER_M1': 5}
+    assert QKHistoryIO.import_all(f'{tmp_path}/export', target, 'month') == {'TQBR.SBER_M1': 5}
+    history = QKHistory(target, 'TQBR.SBER_M1', 'month', QKData.delimiter, QKData.dt_format)
+    assert history.get_bars() == bars
+    assert sorted(history.index) == ['2026-01', '2026-02']
+    assert QKHistoryIO.import_all(f'{tmp_path}/export', target) == {'TQBR.SBER_M1': 0}  # Бары уже есть в истории
+
+
+def test_text_files_match_history(tmp_path):
+    expected = source_history(f'{tmp_path}/expected/')  # История, записанная QKHistory
+    io = QKHistoryIO.open('TQBR.SBER_M1', f'{tmp_path}/actual/')
+    assert io.write_arrays(QKHistoryIO.open('TQBR.SBER_M1', f'{tmp_path}/expected/').read_arrays()) == 5
+    with open(expected.file_name, 'rb') as file:
+        expected_bytes = file.read()
+    with open(io.history.file_name, 'rb') as file:
+        assert file.read() == expected_bytes
+
+
+def test_invalid_bars_are_skipped(tmp_path):
+    io = QKHistoryIO.open('TQBR.SBER_M1', f'{tmp_path}/')
+    arrays = dict(datetime=np.array(['2026-01-05T10:00', '2026-01-05T10:01', 'NaT'], dtype='datetime64[s]'),
+                  open=np.array([100.0, 100.0, 100.0]), high=np.array([101.0, 99.0, 101.0]), low=np.array([99.0, 98.0, 99.0]),
+                  close=np.array([100.5, 98.5, 100.5]), volume=np.array([1, 1, 1]))  # Второй бар: high ниже open/close. Третий без даты
+    assert io.write_arrays(arrays) == 1
+    assert [bar['datetime'] for bar in io.history.get_bars()] == [datetime(2026, 1, 5, 10)]
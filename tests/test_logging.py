@@ -0,0 +1,35 @@
+import json
+import logging
+
+from BackTraderQuik import QKLogging
+from BackTraderQuik.QKLogging import event_logger
+
+
+class ListHandler(logging.Handler):
+    """Обработчик, запоминающий сообщения"""
+    def __init__(self, level):
+        super().__init__(level)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def test_handler_levels_are_respected_through_queue():
+    debug, warning = ListHandler(logging.DEBUG), ListHandler(logging.WARNING)
+    logger = logging.getLogger('QKBroker')
+    with QKLogging([debug, warning], level=logging.DEBUG):
+        logger.debug('debug %s', 1)
+        logger.warning('warning %s', 2)
+    assert debug.messages == ['debug 1', 'warning 2']
+    assert warning.messages == ['warning 2']  # Отладочное сообщение не прошло уровень обработчика
+    assert not logger.isEnabledFor(logging.DEBUG)  # Уровень корневого лога восстановлен вместе с кэшем уровней
+
+
+def test_event_file_gets_json_lines(tmp_path):
+    event_file = tmp_path / 'events.jsonl'
+    with QKLogging([ListHandler(logging.INFO)], event_file=str(event_file)):
+        event_logger.getChild('QKBroker').info('on_trade', extra=dict(event={'trade_num': 1}))
+    event_logger.getChild('QKBroker').info('on_trade', extra=dict(event={'trade_num': 2}))  # Лог событий выключен
+    entries = [json.loads(line) for line in event_file.read_text(encoding='utf-8').splitlines()]
+    assert [(entry['msg'], entry['event']) for entry in entries] == [('on_trade', {'trade_num': 1})]
@@ -0,0 +1,81 @@
+import sys
+
+import pytest
+
+from BackTraderQuik import QKProviderPool
+from BackTraderQuik.tests.provider import StandInProvider
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Время пула подключений, которое двигает проверка"""
+    now = [1000.0]
+    monkeypatch.setattr(sys.modules['BackTraderQuik.QKProviderPool'], 'monotonic', lambda: now[0])
+    return now
+
+
+def test_failed_factory_retries_with_backoff(clock):
+    attempts = []
+
+    def factory():
+        attempts.append(clock[0])
+        if len(attempts) < 3:  # Первые две попытки неудачные
+            raise ConnectionRefusedError
+        return StandInProvider()
+    pool = QKProviderPool({'default': [StandInProvider()], 'history': [factory]})
+    try:
+        for _ in range(10):  # Частые обращения к каналу
+            pool.get_channel_providers('history')
+        assert len(attempts) == 1  # До интервала повторная попытка не делается
+        clock[0] += pool.retry_sec
+        pool.get_channel_providers('history')
+        clock[0] += pool.retry_sec  # Интервал удвоился
+        assert pool.get_channel_providers('history') == []
+        assert len(attempts) == 2
+        clock[0] += pool.retry_sec
+        assert len(pool.get_channel_providers('history')) == 1
+        assert len(attempts) == 3 and pool.retries == {}
+    finally:
+        pool.close_connection_and_thread()
+
+
+def test_transaction_is_not_resent_but_next_goes_to_healthy_connection():
+    broken, spare = StandInProvider(), StandInProvider()
+
+    def send_transaction(transaction):
+        raise ConnectionResetError
+    broken.send_transaction = send_transaction
+    pool = QKProviderPool({'default': [StandInProvider()], 'orders': [broken, spare]})
+    try:
+        with pytest.raises(ConnectionResetError):
+            pool.send_transaction({'TRANS_ID': '1'})
+        assert spare.called('send_transaction') == []  # Транзакция не отправлена повторно
+        pool.send_transaction({'TRANS_ID': '2'})
+        assert spare.called('send_transaction') == [({'TRANS_ID': '2'},)]
+    finally:
+        pool.close_connection_and_thread()
+
+
+def test_subscriptions_follow_handlers_on_failover():
+    first, second = StandInProvider(), StandInProvider()
+    pool = QKProviderPool({'default': [first, second]})
+    try:
+        bars = []
+        pool.on_new_candle = bars.append
+        pool.subscribe_to_candles('TQBR', 'SBER', 1)
+        pool.subscribe_level2_quotes('TQBR', 'SBER')
+        pool.subscribe_to_candles('TQBR', 'GAZP', 1)
+        pool.unsubscribe_from_candles('TQBR', 'GAZP', 1)  # Отмененная подписка не повторяется
+        pool.set_healthy(first, False, 'проверка')  # Обработчик бар переходит на второе подключение
+        assert second.on_new_candle == bars.append
+        assert second.called('subscribe_to_candles') == [('TQBR', 'SBER', 1)]
+        assert second.called('subscribe_level2_quotes') == []  # Обработчика стакана нет, подписка останется на первом подключении
+        assert first.called('unsubscribe_from_candles') == [('TQBR', 'GAZP', 1), ('TQBR', 'SBER', 1)]
+        pool.on_quote = print  # Обработчик стакана ставится на исправное подключение
+        assert second.called('subscribe_level2_quotes') == [('TQBR', 'SBER')]
+        pool.set_healthy(first, True)  # Обработчики возвращаются на первое подключение
+        assert first.called('subscribe_to_candles') == [('TQBR', 'SBER', 1), ('TQBR', 'GAZP', 1), ('TQBR', 'SBER', 1)]
+        assert first.called('subscribe_level2_quotes') == [('TQBR', 'SBER'), ('TQBR', 'SBER')]
+        assert second.called('unsubscribe_from_candles') == [('TQBR', 'SBER', 1)] and second.called('unsubscribe_level2_quotes') == [('TQBR', 'SBER')]
+    finally:
+        pool.close_connection_and_thread()
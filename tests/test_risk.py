@@ -0,0 +1,78 @@
+import sys
+from types import SimpleNamespace
+
+import pytest
+from backtrader import Order
+
+from BackTraderQuik import QKRisk
+
+
+def order(ref, size, remsize=None, status=Order.Accepted):
+    """Заявка с размером и неисполненным остатком"""
+    return SimpleNamespace(ref=ref, size=size, executed=SimpleNamespace(remsize=size if remsize is None else remsize), status=status,
+                           isbuy=lambda: size > 0, alive=lambda: status in (Order.Created, Order.Submitted, Order.Accepted, Order.Partial))
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Время проверок рисков, которое двигает проверка"""
+    now = [1000.0]
+    monkeypatch.setattr(sys.modules['BackTraderQuik.QKRisk'], 'monotonic', lambda: now[0])
+    return now
+
+
+def test_notional_limit():
+    risk = QKRisk(max_notional=1000)
+    risk.reset({'TQBR.SBER': SimpleNamespace(size=5, price=100.0)})
+    assert risk.check(order(1, 5), 'TQBR.SBER', 100.0) is None  # Позиция 10 по 100
+    assert risk.check(order(2, 1), 'TQBR.SBER', 100.0) is not None  # Позиция 11 по 100 превысит лимит
+    assert risk.check(order(3, -8), 'TQBR.SBER', 100.0) is None  # Заявка сокращает позицию
+    assert risk.rejected == 1
+
+
+def test_exposure_limit_counts_positions_and_reserves():
+    risk = QKRisk(max_exposure=2000)
+    risk.reset({'TQBR.SBER': SimpleNamespace(size=5, price=100.0)})  # Стоимость позиций 500
+    assert risk.check(order(1, 10), 'TQBR.GAZP', 100.0) is None  # Резерв 1000
+    assert risk.exposure == 500.0 and risk.reserved == 1000.0
+    assert risk.check(order(2, 6), 'TQBR.LKOH', 100.0) is not None  # 500 + 1000 + 600 > 2000
+    assert risk.check(order(3, 5), 'TQBR.LKOH', 100.0) is None  # 500 + 1000 + 500 = 2000
+
+
+def test_unknown_price_is_rejected_for_value_limits():
+    risk = QKRisk(max_notional=1000, max_exposure=5000)
+    assert risk.check(order(1, 1), 'TQBR.SBER') is not None  # Рыночная заявка без цены и без сделок по тикеру
+    assert risk.reserved == 0.0
+    risk.reset({'TQBR.SBER': SimpleNamespace(size=1, price=100.0)})  # Цена последней сделки известна
+    assert risk.check(order(2, 1), 'TQBR.SBER') is None
+    assert risk.reserved == 100.0
+    assert QKRisk(max_position=10).check(order(3, 1), 'TQBR.SBER') is None  # Без проверок стоимости цена не нужна
+
+
+def test_orders_per_sec_limit(clock):
+    risk = QKRisk(max_orders_per_sec=2)
+    assert risk.check(order(1, 1), 'TQBR.SBER', 100.0) is None
+    assert risk.check(order(2, 1), 'TQBR.SBER', 100.0) is None
+    assert risk.check(order(3, 1), 'TQBR.SBER', 100.0) is not None
+    clock[0] += 1  # Прошла секунда
+    assert risk.check(order(4, 1), 'TQBR.SBER', 100.0) is None
+
+
+def test_reserve_and_release_round_trip():
+    risk = QKRisk(max_position=10)
+    buy = order(1, 10)
+    assert risk.check(buy, 'TQBR.SBER', 100.0) is None
+    assert risk.reserved == 1000.0 and risk.reserved_sizes['TQBR.SBER', True] == 10
+    buy.executed.remsize = 6  # Исполнено 4
+    risk.on_trade(buy, 'TQBR.SBER', 4, 99.0, 0.0)
+    assert risk.reserved == 600.0 and risk.reserved_sizes['TQBR.SBER', True] == 6
+    assert risk.sizes['TQBR.SBER'] == 4 and risk.exposure == 396.0
+    buy.status = Order.Canceled  # Остаток снят
+    buy.alive = lambda: False
+    risk.on_order(buy)
+    assert risk.reserved == 0.0 and risk.reserved_sizes['TQBR.SBER', True] == 0 and risk.reserved_orders == {}
+    sell = order(2, -4)
+    assert risk.check(sell, 'TQBR.SBER', 101.0) is None  # Продажа сокращает позицию
+    sell.executed.remsize = 0
+    risk.on_trade(sell, 'TQBR.SBER', 0, 101.0, 8.0)  # Позиция закрыта с прибылью
+    assert risk.reserved == 0.0 and risk.exposure == 0.0 and risk.pnl == 8.0
@@ -0,0 +1,118 @@
+from multiprocessing import AuthenticationError
+from queue import Queue
+from threading import Thread, Event
+from time import sleep, time as real_time
+import sys
+
+import pytest
+
+from BackTraderQuik.QKServer import QKServer, QKProviderClient, authkey_env
+from BackTraderQuik.tests.provider import StandInProvider
+
+
+def start_server(address, authkey=None) -> QKServer:
+    """Запущенный процесс-хранилище с заменой провайдера"""
+    server = QKServer(StandInProvider(), address, authkey)
+    Thread(target=server.serve_forever, daemon=True).start()
+    while server.listener is None:  # Ждем начала приема подключений
+        sleep(0.01)
+    return server
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = start_server(f'{tmp_path}/qk.sock')
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def client(server):
+    client = QKProviderClient(server.address)
+    yield client
+    client.close_connection_and_thread()
+
+
+def test_cached_calls_accept_kwargs(server, client):
+    assert client.get_symbol_info(class_code='TQBR', sec_code='SBER') == {'min_price_step': 0.01, 'scale': 2}
+    assert client.get_symbol_info(class_code='TQBR', sec_code='SBER') == {'min_price_step': 0.01, 'scale': 2}  # Из кэша
+    assert [call for call in server.provider.calls if call[0] == 'get_symbol_info'] == [('get_symbol_info', ('TQBR', 'SBER'), {})]
+    assert client.lots_to_size('TQBR', 'SBER', size=10) == 10
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Время процесса-хранилища, которое двигает проверка"""
+    now = [1000.0]
+    monkeypatch.setattr(sys.modules['BackTraderQuik.QKServer'], 'monotonic', lambda: now[0])
+    return now
+
+
+def test_transaction_ids_are_remapped_and_forgotten(server, client, clock):
+    events = Queue()
+    client.on_trans_reply = client.on_order = client.on_trade = events.put
+    client.send_transaction({'TRANS_ID': '42', 'ACTION': 'NEW_ORDER'})
+    trans_id = int(server.provider.called('send_transaction')[-1][0]['TRANS_ID'])  # Номер транзакции процесса-хранилища
+    server.on_event('on_trans_reply', {'data': dict(trans_id=trans_id, status=3)})  # Заявка зарегистрирована
+    assert events.get(timeout=5)['data']['trans_id'] == 42
+    server.on_event('on_order', {'data': dict(trans_id=trans_id, flags=0)})  # Заявка исполнена
+    assert events.get(timeout=5)['data']['trans_id'] == 42
+    server.on_event('on_trade', {'data': dict(trans_id=trans_id, trade_num=1)})  # Сделка пришла после изменения заявки
+    assert events.get(timeout=5)['data']['trans_id'] == 42
+    clock[0] += server.done_ttl_sec + 1
+    server.on_event('on_trade', {'data': dict(trans_id=trans_id, trade_num=1)})  # Повторная сделка после забывания номера
+    assert events.get(timeout=5)['data']['trans_id'] == 0  # Чужой номер не попадает в процесс как номер его заявки
+    assert server.transactions == {} and server.done == {}
+    client.send_transaction({'TRANS_ID': '43', 'ACTION': 'NEW_ORDER'})
+    trans_id = int(server.provider.called('send_transaction')[-1][0]['TRANS_ID'])
+    server.on_event('on_trans_reply', {'data': dict(trans_id=trans_id, status=6)})  # Заявка не прошла проверку лимитов
+    assert events.get(timeout=5)['data']['trans_id'] == 43
+    clock[0] += server.done_ttl_sec + 1
+    server.on_event('on_order', {'data': dict(trans_id=1, flags=0)})  # Заявка другой программы
+    assert events.get(timeout=5)['data']['trans_id'] == 0
+    assert server.transactions == {}
+
+
+def test_transaction_ids_are_not_reused_after_restart(tmp_path, monkeypatch):
+    first = QKServer(StandInProvider(), f'{tmp_path}/qk.sock')
+    ids = [next(first.trans_ids) for _ in range(5)]
+    monkeypatch.setattr(sys.modules['BackTraderQuik.QKServer'], 'time', lambda: real_time() + 1)  # Перезапуск через секунду
+    assert next(QKServer(StandInProvider(), f'{tmp_path}/qk.sock').trans_ids) > max(ids)
+    assert 1 < ids[0] < QKServer.max_trans_id // 2 + 1
+
+
+def test_history_does_not_block_transactions(server, client):
+    started, release = Event(), Event()
+
+    def history(*args, **kwargs):
+        started.set()
+        release.wait(5)
+        return []
+    server.provider.results['get_candles_from_data_source'] = history  # Долгий запрос истории
+    Thread(target=client.get_candles_from_data_source, args=('TQBR', 'SBER', 1), daemon=True).start()
+    assert started.wait(5)
+    try:
+        assert client.send_transaction({'TRANS_ID': '1', 'ACTION': 'NEW_ORDER'})['cmd'] == 'send_transaction'  # Транзакция не ждет историю
+    finally:
+        release.set()
+
+
+def test_network_address_requires_authkey(monkeypatch):
+    monkeypatch.delenv(authkey_env, raising=False)
+    with pytest.raises(ValueError):
+        QKServer(StandInProvider(), ('127.0.0.1', 0))
+    monkeypatch.setenv(authkey_env, 'secret')
+    assert QKServer(StandInProvider(), ('127.0.0.1', 0)).authkey == b'secret'
+
+
+def test_wrong_authkey_does_not_stop_server():
+    server = start_server(('127.0.0.1', 0), b'secret')
+    try:
+        address = server.listener.address  # Порт выбран при запуске
+        with pytest.raises(AuthenticationError):
+            QKProviderClient(address, b'wrong')
+        client = QKProviderClient(address, b'secret')
+        assert client.accounts == server.provider.accounts
+        client.close_connection_and_thread()
+    finally:
+        server.stop()
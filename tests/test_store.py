@@ -0,0 +1,58 @@
+import os
+import subprocess
+import sys
+from datetime import datetime
+from types import ModuleType
+
+from backtrader import Cerebro, TimeFrame
+
+from BackTraderQuik import QKStore, QKData
+from BackTraderQuik.tests.provider import StandInProvider
+
+
+def test_import_does_not_load_quikpy():
+    code = 'import sys, BackTraderQuik; assert "QuikPy" not in sys.modules'  # Библиотека QuikPy подключается только при первом обращении к QUIK
+    subprocess.run([sys.executable, '-c', code], env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)), check=True)  # Новый процесс с путями этого процесса
+
+
+def test_provider_is_created_on_first_use(monkeypatch):
+    created = []
+
+    class QuikPy(StandInProvider):
+        def __init__(self):
+            super().__init__()
+            created.append(self)
+    module = ModuleType('QuikPy')
+    module.QuikPy = QuikPy
+    monkeypatch.setitem(sys.modules, 'QuikPy', module)  # Подключение к QUIK, которое запоминает создание
+    QKStore._singleton = None
+    try:
+        store = QKStore()
+        data = QKData(dataname='TQBR.SBER', timeframe=TimeFrame.Minutes)
+        Cerebro().adddata(data)
+        assert created == [] and not store.has_provider  # Хранилище и данные созданы без подключения к QUIK
+        assert data.class_code == 'TQBR' and store.tz_msk.utcoffset(None).total_seconds() == 3 * 3600
+        store.provider.get_info_param('SERVERTIME')  # Первое обращение к QUIK
+        assert len(created) == 1 and store.provider is created[0]
+        store.close()
+        assert not store.has_provider
+    finally:
+        QKStore._singleton = None
+
+
+class NoTimeZoneProvider(StandInProvider):
+    """Подключение, к часовому поясу которого обращаться нельзя"""
+    @property
+    def tz_msk(self):
+        raise AssertionError('Часовой пояс берется из хранилища без обращения к QUIK')
+
+
+def test_quik_time_fallback_does_not_touch_provider():
+    QKStore._singleton = None
+    try:
+        store = QKStore(provider=NoTimeZoneProvider(get_info_param=''))  # QUIK вернул пустые дату и время
+        data = QKData(dataname='TQBR.SBER', timeframe=TimeFrame.Minutes)
+        data.live_mode = True
+        assert abs((data.get_quik_date_time_now() - datetime.now(store.tz_msk).replace(tzinfo=None)).total_seconds()) < 5
+    finally:
+        QKStore._singleton = None